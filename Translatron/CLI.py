@@ -33,6 +33,10 @@ def index(args):
     from Translatron.Indexing.NLTKIndexer import runIndexerCLITool
     runIndexerCLITool(args)
 
+def stopwords(args):
+    from Translatron.Indexing.HeavyHitters import runStopwordsCLITool
+    runStopwordsCLITool(args)
+
 
 def importDocuments(args):
     from Translatron.DocumentImport.PMC import runPMCImporterCLITool
@@ -61,7 +65,14 @@ def importEntities(args):
 def runServer(args):
     "Run the main translatron server. Does not terminate."
     from Translatron.Server import startTranslatron
-    startTranslatron(http_port=args.http_port)
+    startTranslatron(http_port=args.http_port, tokenizer=args.tokenizer,
+                     cacheSize=int(args.cache_mb * 1024 * 1024), nerAutomatonFile=args.ner_automaton,
+                     maxConcurrentRequests=args.max_requests, requestTimeout=args.request_timeout,
+                     maxConnections=args.db_connections, nerProcesses=args.ner_processes)
+
+def buildNERAutomaton(args):
+    from Translatron.Server.AliasAutomaton import runBuildAutomatonCLITool
+    runBuildAutomatonCLITool(args)
 
 
 def repl(dbargs):
@@ -75,7 +86,10 @@ def __getDumpFilenames(args):
     entitiesFilename = prefix  + ".entities.ydf" + suffix
     docidxFilename = prefix  + ".docidx.ydf" + suffix
     entityidxidxFilename = prefix  + ".entityidx.ydf" + suffix
-    return (documentsFilename, entitiesFilename, docidxFilename, entityidxidxFilename)
+    docidxHeavyFilename = prefix  + ".docidx-heavy.ydf" + suffix
+    entityidxHeavyFilename = prefix  + ".entityidx-heavy.ydf" + suffix
+    return (documentsFilename, entitiesFilename, docidxFilename, entityidxidxFilename,
+            docidxHeavyFilename, entityidxHeavyFilename)
 
 def exportDump(args):
     #Setup raw YakDB connection
@@ -93,9 +107,13 @@ def exportDump(args):
     if not args.no_document_idx:
         print (blue("Dumping document index table to " + filenames[2], bold=True))
         dumpYDF(conn, filenames[2], 3)
+        print (blue("Dumping high-frequency document index table to " + filenames[4], bold=True))
+        dumpYDF(conn, filenames[4], 7)
     if not args.no_entity_idx:
         print (blue("Dumping entity index table to " + filenames[3], bold=True))
         dumpYDF(conn, filenames[3], 4)
+        print (blue("Dumping high-frequency entity index table to " + filenames[5], bold=True))
+        dumpYDF(conn, filenames[5], 8)
 
 def restoreDump(args):
     #Setup raw YakDB connection
@@ -104,6 +122,12 @@ def restoreDump(args):
     #Filenames to dump to
     filenames = __getDumpFilenames(args)
     #NOTE: Partial & incremental restore is supported
+    from Translatron import DocumentDB
+    conn.put(5, {DocumentDB.indexGenerationKey: DocumentDB.newIndexGeneration()})
+    #The compact document index is not dumped, it must be rebuilt (index --bulk) after a restore
+    if not (args.no_documents and args.no_document_idx):
+        from Translatron.Indexing import CompactPostings
+        conn.delete(5, [CompactPostings.compactIndexValidKey])
     #Restory every table if the corresponding file exists
     if not args.no_documents:
         if not os.path.isfile(filenames[0]):
@@ -123,12 +147,19 @@ def restoreDump(args):
         else: #It's a regular file
             print (blue("Restoring document index table from " + filenames[2], bold=True))
             importYDFDump(conn, filenames[2], 3)
+        #Only present if a posting cap has been used
+        if os.path.isfile(filenames[4]):
+            print (blue("Restoring high-frequency document index table from " + filenames[4], bold=True))
+            importYDFDump(conn, filenames[4], 7)
     if not args.no_entity_idx:
         if not os.path.isfile(filenames[3]):
             print (red("Can't find document index table file " + filenames[3], bold=True))
         else: #It's a regular file
             print (blue("Restoring entity index table from " + filenames[3], bold=True))
             importYDFDump(conn, filenames[3], 4)
+        if os.path.isfile(filenames[5]):
+            print (blue("Restoring high-frequency entity index table from " + filenames[5], bold=True))
+            importYDFDump(conn, filenames[5], 8)
 
 def compact(args):
     "Compact one ore more table"
@@ -139,15 +170,19 @@ def compact(args):
     if not args.no_documents:
         print (blue("Compacting document table... ", bold=True))
         conn.compactRange(1)
+        conn.compactRange(5)
     if not args.no_entities:
         print (blue("Compacting entity table... ", bold=True))
         conn.compactRange(2)
     if not args.no_document_idx:
         print (blue("Compacting document index table... ", bold=True))
         conn.compactRange(3)
+        conn.compactRange(6)
+        conn.compactRange(7)
     if not args.no_entity_idx:
         print (blue("Compacting entity index table... ", bold=True))
         conn.compactRange(4)
+        conn.compactRange(8)
 
 
 def truncate(args):
@@ -156,6 +191,8 @@ def truncate(args):
     if not args.yes_i_know_what_i_am_doing:
         print (red("This will delete all your Translatron data. If you are sure, please use --yes-i-know-what-i-am-doing ", bold=True))
         return
+    from Translatron import DocumentDB
+    from Translatron.Indexing import CompactPostings
     #Setup raw YakDB connection
     conn = YakDB.Connection()
     conn.connect(args.req_endpoint)
@@ -165,6 +202,30 @@ def truncate(args):
         print (blue("Truncating document table... ", bold=True))
         if args.hard: conn.truncateTable(1)
         else: conn.deleteRange(1, None, None, None)
+    #Document state: Content hashes would cause the documents to be skipped on re-import,
+    # index records and dirty markers refer to the documents, entities and index tables
+    statePrefixes = set()
+    if not args.no_documents:
+        statePrefixes.update([DocumentDB.contentHashPrefix, DocumentDB.dirtyDocumentPrefix,
+                              DocumentDB.documentIndexRecordPrefix, DocumentDB.documentLengthPrefix,
+                              DocumentDB.documentStatisticsPrefix])
+    if not args.no_entities:
+        statePrefixes.update([DocumentDB.entityHashPrefix, DocumentDB.dirtyEntityPrefix,
+                              DocumentDB.entityIndexRecordPrefix])
+    if not (args.no_documents and args.no_document_idx):
+        statePrefixes.update([CompactPostings.docNumberPrefix, CompactPostings.docIdPrefix,
+                              CompactPostings.compactIndexPrefix])
+    if not args.no_document_idx:
+        statePrefixes.update([DocumentDB.documentIndexRecordPrefix, DocumentDB.documentLengthPrefix,
+                              DocumentDB.documentStatisticsPrefix, DocumentDB.indexTokenizerPrefix,
+                              DocumentDB.heavyKeyPrefix(7)])
+    if not args.no_entity_idx:
+        statePrefixes.update([DocumentDB.entityIndexRecordPrefix, DocumentDB.heavyKeyPrefix(8)])
+    if args.hard and not (args.no_documents or args.no_entities):
+        conn.truncateTable(5)
+    else:
+        for prefix in statePrefixes:
+            conn.deleteRange(5, prefix, prefix[:-1] + b"\x1F", None)
     if not args.no_entities:
         print (blue("Truncating entity table... ", bold=True))
         if args.hard: conn.truncateTable(2)
@@ -173,10 +234,19 @@ def truncate(args):
         print (blue("Truncating document index table... ", bold=True))
         if args.hard: conn.truncateTable(3)
         else: conn.deleteRange(3, None, None, None)
+        if args.hard: conn.truncateTable(7)
+        else: conn.deleteRange(7, None, None, None)
+    if not (args.no_documents and args.no_document_idx):
+        print (blue("Truncating compact document index table... ", bold=True))
+        if args.hard: conn.truncateTable(6)
+        else: conn.deleteRange(6, None, None, None)
+    conn.put(5, {DocumentDB.indexGenerationKey: DocumentDB.newIndexGeneration()})
     if not args.no_entity_idx:
         print (blue("Truncating entity index table... ", bold=True))
         if args.hard: conn.truncateTable(4)
         else: conn.deleteRange(4, None, None, None)
+        if args.hard: conn.truncateTable(8)
+        else: conn.deleteRange(8, None, None, None)
 
 def initializeTranslatron(args):
     import nltk
@@ -212,6 +282,21 @@ def runTranslatronCLI():
             help="Don't print verbose info",
             action="store_true",
             dest="quiet")
+    cliOptsGroup.add_argument(
+            "--stats-json",
+            help="Append machine-readable per-stage import/index statistics (JSON lines) to this file",
+            action="store",
+            default=None,
+            dest="stats_json")
+    cliOptsGroup.add_argument(
+            "--tokenizer",
+            help="The word tokenizer for indexing and search: 'nltk' or 'regex', a fast emulation of 'nltk'. "
+                 "The document index records the tokenizer it has been built with, which is used by default. "
+                 "Changing the tokenizer of an existing index requires 'index --full' or 'index --bulk'. "
+                 "Default for new indexes: nltk",
+            choices=["regex", "nltk"],
+            default=None,
+            dest="tokenizer")
     ###
     # Create parsers for the individual commands
     ###
@@ -222,13 +307,34 @@ def runTranslatronCLI():
     # Run server
     parserRun = subparsers.add_parser("run", description="Run the Translatron server")
     parserRun.add_argument("--http-port", type=int, default=8080, help="Which port to listen on for HTTP requests")
+    parserRun.add_argument("--cache-mb", type=float, default=64.0, help="Maximum size of the search result cache shared by all connections (in MiB). 0 disables caching")
+    parserRun.add_argument("--ner-automaton", help="Use the NER alias automaton from this file instead of querying the entity index. Built from the entity index if the file does not exist")
+    parserRun.add_argument("--max-requests", type=int, default=8, help="Maximum number of websocket requests (of all clients) processed concurrently")
+    parserRun.add_argument("--request-timeout", type=float, default=30.0, help="Maximum processing time of a websocket request in seconds. 0 disables the timeout")
+    parserRun.add_argument("--db-connections", type=int, help="Size of the YakDB connection pool shared by all websocket connections. Default: --max-requests")
+    parserRun.add_argument("--ner-processes", type=int, default=0, help="Number of worker processes annotating full-length documents in parallel chunks. 0 annotates in the request thread. The workers share the --ner-automaton of the server process copy-on-write, but every worker copies the memory pages it touches, so budget up to one automaton size of memory per process")
     parserRun.set_defaults(func=runServer)
+    # NER automaton
+    parserNERAutomaton = subparsers.add_parser("build-ner-automaton", description="Build the NER alias automaton file from the entity index. Rebuild it after importing entities")
+    parserNERAutomaton.add_argument("outfile", nargs="?", default="ner-automaton.msgpack", help="The file to write the automaton to")
+    parserNERAutomaton.set_defaults(func=buildNERAutomaton)
     # Indexer
     parserIndex = subparsers.add_parser("index", description="Run the indexer for previously imported documents")
     parserIndex.add_argument("--no-documents", action="store_true", help="Do not index documents")
     parserIndex.add_argument("--no-entities", action="store_true", help="Do not index entities")
     parserIndex.add_argument("-s", "--statistics", action="store_true", help="Print token frequency statistics")
+    parserIndex.add_argument("--full", action="store_true", help="Rebuild the index from scratch instead of indexing only new and changed documents and entities")
+    parserIndex.add_argument("--bulk", action="store_true", help="Rebuild the document index (and the compact document index used by search) from scratch by merging sorted runs on disk. Writes every index key once instead of pushing single postings")
+    parserIndex.add_argument("--tmpdir", help="The directory to store the sorted runs of --bulk in (default: system temporary directory)")
+    parserIndex.add_argument("--max-postings", type=int, help="Move document index keys with more than this number of postings to a separate high-frequency table. Search ignores these tokens like stopwords. Entity aliases are never moved, so NER finds all of them")
+    parserIndex.add_argument("-w", "--workers", type=int, default=cpu_count(), help="The number of document indexer processes to use")
     parserIndex.set_defaults(func=index)
+    # Stopword suggestions
+    parserStopwords = subparsers.add_parser("stopwords", description="Suggest stopwords, i.e. the most frequent tokens in the document index that are not stopwords yet")
+    parserStopwords.add_argument("-n", "--number", type=int, default=100, help="The maximum number of stopwords to suggest")
+    parserStopwords.add_argument("--min-postings", type=int, default=0, help="Only suggest tokens with at least this number of postings")
+    parserStopwords.add_argument("--write", action="store_true", help="Add the suggested stopwords to stopwords.txt")
+    parserStopwords.set_defaults(func=stopwords)
     # Dump tables
     parserDump = subparsers.add_parser("dump", description="Export database dump")
     parserDump.add_argument("outprefix", default="translatron-dump", nargs='?', help="The file prefix to dump to. Table name and .xz is automatically appended")
@@ -267,12 +373,24 @@ def runTranslatronCLI():
     parserImportDocuments.add_argument("infile", nargs="+", help="The PMC articles.X-Y.tar.gz input file(s)")
     parserImportDocuments.add_argument("-w", "--workers", type=int, default=cpu_count(), help="The number of worker processes to use")
     parserImportDocuments.add_argument("-f", "--filter", default="", help="Prefix filter for PMC TARs. For example, use ACS_Nano here to import only that journal")
-    parserImportDocuments.add_argument("-c", "--content-filter", default="", help="Case-insensitive content filter for. For example, use Coxiella here to import only documents containing the string coxiella. Applied on the raw document.")
+    parserImportDocuments.add_argument("-a", "--parallel-archives", type=int, default=2, help="The number of archives to read in parallel")
+    parserImportDocuments.add_argument("--queue-size", type=int, default=256, help="Maximum size of raw XML (in MiB) waiting to be processed by the workers")
+    parserImportDocuments.add_argument("--checkpoint", help="Checkpoint manifest file. Documents recorded in this file are skipped, newly written ones are appended. Allows resuming an interrupted import")
+    parserImportDocuments.add_argument("--batch-mb", type=float, default=4.0, help="Flush write batches once they exceed this size (in MiB)")
+    parserImportDocuments.add_argument("--batch-delay", type=float, default=1.0, help="Flush write batches once their oldest document is older than this (in seconds)")
+    parserImportDocuments.add_argument("--no-dedup", action="store_true", help="Parse and write all documents, even if the same content has been imported before (e.g. after changing the parser)")
+    parserImportDocuments.add_argument("--index", action="store_true", help="Index documents while importing them. Avoids re-reading all documents using 'translatron index'")
+    parserImportDocuments.add_argument("-c", "--content-filter", action="append", default=[], help="Case-insensitive content filter. For example, use Coxiella here to import only documents containing the string coxiella. Applied on the raw document. May be given multiple times, documents matching any term are imported.")
+    parserImportDocuments.add_argument("--content-filter-file", help="File containing one content filter term per line (e.g. a list of gene names)")
+    parserImportDocuments.add_argument("--content-filter-regex", action="append", default=[], help="Case-insensitive regular expression content filter. May be given multiple times")
     parserImportDocuments.set_defaults(func=importDocuments)
     # Import documents/entities from
     parserImportEntities = subparsers.add_parser("import-entities", description="Import entities")
     parserImportEntities.add_argument("infile", nargs="+", help="The PMC articles.X-Y.tar.gz input file(s)")
     parserImportEntities.add_argument("-w", "--workers", type=int, default=cpu_count(), help="The number of worker processes to use")
+    parserImportEntities.add_argument("--batch-mb", type=float, default=4.0, help="Flush write batches once they exceed this size (in MiB)")
+    parserImportEntities.add_argument("--batch-delay", type=float, default=1.0, help="Flush write batches once their oldest entity is older than this (in seconds)")
+    parserImportEntities.add_argument("--index", action="store_true", help="Index entities while importing them. Avoids re-reading all entities using 'translatron index'")
     parserImportEntities.set_defaults(func=importEntities)
     # Intialize
     parserInitialize = subparsers.add_parser("initialize", description="Initialize translatron (download NLTK data)")
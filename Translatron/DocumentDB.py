@@ -3,7 +3,16 @@
 import YakDB
 from YakDB.InvertedIndex.MsgpackEntityInvertedIndex \
     import MsgpackEntityInvertedIndex
+from YakDB.InvertedIndex import InvertedIndex
+from Translatron.Indexing import CompactPostings, Ranking
 import collections
+import functools
+import hashlib
+import os
+import msgpack
+import struct
+import threading
+import time
 
 __author__ = "Uli Köhler"
 __copyright__ = "Copyright 2015 Uli Köhler"
@@ -29,6 +38,117 @@ def entityKeyExtractor(entity):
         raise DocumentInvalidException("Entity has no ID!")
     return entity["id"].encode("utf-8")
 
+def paragraphKey(docId, paragraphNo):
+    """
+    Get the document table key of a paragraph.
+    Equals the index location ID of the paragraph, see NLTKIndexer.generateLocationId()
+    """
+    return docId + b"\x1Eparagraph" + str(paragraphNo).encode("ascii")
+
+def splitDocument(doc):
+    """
+    Split a document into a metadata entry (without paragraphs, but with a
+    "numParagraphs" field) and a list of paragraphs, which are stored separately.
+    """
+    metadata = {k: v for k, v in doc.items() if k != "paragraphs"}
+    paragraphs = doc.get("paragraphs", [])
+    metadata["numParagraphs"] = len(paragraphs)
+    return metadata, paragraphs
+
+def serializeDocument(doc):
+    """
+    Serialize a document into its document table entries {key: msgpack value},
+    i.e. the metadata entry and one entry per paragraph (see splitDocument())
+    """
+    docId = documentKeyExtractor(doc)
+    metadata, paragraphs = splitDocument(doc)
+    entries = {docId: msgpack.packb(metadata)}
+    for i, paragraph in enumerate(paragraphs):
+        entries[paragraphKey(docId, i)] = msgpack.packb(paragraph)
+    return entries
+
+def serializeEntity(entity):
+    "Serialize an entity into its entity table entry {key: msgpack value}"
+    return {entityKeyExtractor(entity): msgpack.packb(entity)}
+
+def contentHash(content):
+    "Hash raw document content (bytes) for deduplication. Returns the binary SHA1 digest"
+    return hashlib.sha1(content).digest()
+
+#Key prefixes in the document state table (#5):
+#   Content hashes of imported documents (by document ID)
+contentHashPrefix = b"hash\x1E"
+#   Content hashes of imported entities (by entity ID)
+entityHashPrefix = b"entityhash\x1E"
+#   Documents & entities that are not (or not up-to-date) indexed
+dirtyDocumentPrefix = b"dirty\x1E"
+dirtyEntityPrefix = b"dirtyentity\x1E"
+#   Index records: The index keys of the currently indexed version of a document/entity
+documentIndexRecordPrefix = b"indexed\x1E"
+entityIndexRecordPrefix = b"indexedentity\x1E"
+#   Document lengths: The number of postings (uint32, big endian) of every indexed document.
+#   Used for ranking if the compact index is not current (see Ranking.rankStringPostings())
+documentLengthPrefix = b"doclength\x1E"
+#   Document statistics: The number and the total length (two int64, big endian) of the documents
+#   with a length. Every process updates its own key (see documentStatisticsKey()) in the same write
+#   as the lengths, so concurrent indexer processes don't overwrite each other's updates
+documentStatisticsPrefix = b"docstats\x1E"
+
+#   High-frequency index keys: The keys moved to a high-frequency table (see heavyKeyPrefix())
+
+#   Index generation: Changed (to a random value) whenever documents, entities or the indexes change.
+#   Used to invalidate search result caches
+indexGenerationKey = b"generation\x1Eindex"
+#   Index tokenizer: The name of the tokenizer (see Tokenizer.tokenizers) the document index has been built with
+indexTokenizerPrefix = b"tokenizer\x1E"
+indexTokenizerKey = indexTokenizerPrefix + b"documents"
+
+def newIndexGeneration():
+    "Get a new, unique index generation value"
+    return os.urandom(8)
+
+def heavyKeyPrefix(heavyTableNo):
+    "Get the document state table prefix of the keys moved to a high-frequency table (see HeavyHitters)"
+    return b"heavy" + str(heavyTableNo).encode("ascii") + b"\x1E"
+
+def documentStatisticsKey():
+    "Get the document statistics key of this process"
+    return documentStatisticsPrefix + str(os.getpid()).encode("ascii")
+
+#Serializes the document statistics updates of this process
+_documentStatisticsLock = threading.Lock()
+
+def contentHashKey(docId):
+    "Get the document state table key for the content hash of a (binary) document ID"
+    return contentHashPrefix + docId
+
+def dirtyDocumentKey(docId):
+    "Get the document state table key that marks a document as not (or not up-to-date) indexed"
+    return dirtyDocumentPrefix + docId
+
+def indexKey(level, token):
+    "Get the index table key of a token (YakDB InvertedIndex key format)"
+    if isinstance(level, str): level = level.encode("utf-8")
+    if isinstance(token, str): token = token.encode("utf-8")
+    return level + b"\x1E" + token
+
+def unpackValue(value):
+    "Deserialize a msgpack database value (with bytes keys and strings, like MsgpackEntityInvertedIndex)"
+    return msgpack.unpackb(value, raw=True)
+
+def decodeBytes(obj):
+    """
+    Recursively convert bytes keys and values to UTF-8 strings
+    (and other iterables to lists) for JSON serialization
+    """
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", "replace")
+    if isinstance(obj, dict):
+        return {decodeBytes(k): decodeBytes(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return [decodeBytes(v) for v in obj]
+    return obj
+
 def documentSerializer(obj):
     "Fixes JSON not serializing bytes, see http://www.diveintopython3.net/serializing.html"
     if isinstance(obj, bytes):
@@ -38,6 +158,118 @@ def documentSerializer(obj):
         return list(obj)
     raise TypeError(repr(obj) + ' is not JSON serializable')
 
+class AdaptiveWriteBatch(object):
+    """
+    Write batch shared by all document and entity importers.
+
+    Entries are serialized once when they are added to the batch
+    (see serializeDocument() and serializeEntity()), and the writer
+    is called with the serialized entries.
+
+    A batch is flushed once
+        - its serialized size exceeds the byte budget (maxBytes) or
+        - its oldest entry has been waiting longer than the time budget (maxDelay) or
+        - it contains chunkSize entries.
+    If adaptive is True, chunkSize is tuned automatically: It is increased as long as
+    the observed write throughput (bytes/s) increases and decreased if it drops.
+    This only makes sense for writes acknowledged by YakDB (REQ connections).
+    PUSH writes are only enqueued locally, so non-adaptive batches are flushed
+    by the byte and time budgets only.
+
+    The counters (numWrites, numFlushes, numBytes, writeTime) are public,
+    see also stats().
+    """
+    def __init__(self, writeFunction, serializeFunction, maxBytes=4*1024*1024, maxDelay=1.0,
+                 initialChunkSize=128, minChunkSize=8, maxChunkSize=100000, adaptive=True, statistics=None):
+        """
+        Keyword arguments:
+            writeFunction: Called with a list of serialized entries on every flush,
+                           e.g. db.writeSerializedEntities
+            serializeFunction: Converts an entry to a {key: msgpack value} dict, e.g. serializeEntity
+            statistics: An IngestStatistics instance to record "serialize" and "write" time in
+        """
+        self.writeFunction = writeFunction
+        self.serializeFunction = serializeFunction
+        self.statistics = statistics
+        self.maxBytes = maxBytes
+        self.maxDelay = maxDelay
+        self.minChunkSize = minChunkSize
+        self.maxChunkSize = maxChunkSize
+        self.adaptive = adaptive
+        self.chunkSize = initialChunkSize if adaptive else maxChunkSize
+        #Current batch
+        self.entries = []
+        self.batchBytes = 0
+        self.batchStartTime = None
+        #Exponentially weighted moving average of the write throughput in bytes/s
+        self.throughput = None
+        #Statistics
+        self.startTime = time.time()
+        self.numWrites = 0
+        self.numFlushes = 0
+        self.numBytes = 0
+        self.writeTime = 0.0
+    def writeEntity(self, entry):
+        "Serialize an entry and add it to the batch, flushing the batch if any budget is exceeded"
+        if not self.entries:
+            self.batchStartTime = time.time()
+        serializeStartTime = time.perf_counter()
+        serialized = self.serializeFunction(entry)
+        if self.statistics is not None:
+            self.statistics.addTime("serialize", time.perf_counter() - serializeStartTime)
+        self.entries.append(serialized)
+        self.batchBytes += sum(len(key) + len(value) for key, value in serialized.items())
+        self.numWrites += 1
+        if len(self.entries) >= self.chunkSize:
+            self.flush(adapt=self.adaptive)
+        elif self.batchBytes >= self.maxBytes or time.time() - self.batchStartTime >= self.maxDelay:
+            self.flush()
+    def writeEntities(self, entries):
+        for entry in entries:
+            self.writeEntity(entry)
+    def flush(self, adapt=False):
+        "Write all entries in the batch. Adapt the chunk size if adapt is True"
+        if not self.entries:
+            return
+        writeStartTime = time.time()
+        self.writeFunction(self.entries)
+        deltaT = max(time.time() - writeStartTime, 1e-6)
+        #Statistics
+        self.numFlushes += 1
+        self.numBytes += self.batchBytes
+        self.writeTime += deltaT
+        if self.statistics is not None:
+            self.statistics.addTime("write", deltaT)
+            self.statistics.count("flushes")
+        #Hill climbing on the throughput. Only chunk-size limited batches
+        # tell us anything about the chunk size.
+        rate = self.batchBytes / deltaT
+        if adapt:
+            if self.throughput is None or rate >= self.throughput:
+                self.chunkSize = min(self.maxChunkSize, int(self.chunkSize * 1.25) + 1)
+            else:
+                self.chunkSize = max(self.minChunkSize, int(self.chunkSize * 0.8))
+        self.throughput = rate if self.throughput is None else 0.8 * self.throughput + 0.2 * rate
+        #Start new batch
+        self.entries = []
+        self.batchBytes = 0
+    def stats(self):
+        "Get a dictionary of the batch counters"
+        deltaT = max(time.time() - self.startTime, 1e-9)
+        return {
+            "writes": self.numWrites,
+            "flushes": self.numFlushes,
+            "bytes": self.numBytes,
+            "writeTime": self.writeTime,
+            "chunkSize": self.chunkSize,
+            "writesPerSecond": self.numWrites / deltaT,
+            "bytesPerSecond": self.numBytes / deltaT,
+        }
+
+def writeBatchOptions(args):
+    "Get AdaptiveWriteBatch keyword arguments from the --batch-mb and --batch-delay CLI options"
+    return {"maxBytes": int(args.batch_mb * 1024 * 1024), "maxDelay": args.batch_delay}
+
 class YakDBDocumentDatabase(MsgpackEntityInvertedIndex):
     """
     A thin wrapper around two YakDB inverted indices:
@@ -48,23 +280,40 @@ class YakDBDocumentDatabase(MsgpackEntityInvertedIndex):
         - Uses msgpack-backed serialization
         - Consumes python objects
         - Operates on tables #1 & #3 for docs, #2 & #4 for entities
+        - Uses table #5 for document state (content hashes & documents that need to be indexed)
         - Automatically ensures the correct table open settings for index tables
         - Generates IDs by using the object's value for the 'id' key
+
+    Documents are stored paragraph-granular: The document ID key holds the
+    metadata (everything but the paragraphs, plus "numParagraphs") and each
+    paragraph is stored under its own key (see paragraphKey()).
+    This allows to load only the paragraphs around a search hit.
+    Documents stored in the old format (including "paragraphs") are still supported.
     """
 
     def __init__(self, conn=None, mode="REQ", context=None):
+        self.mode = mode
+        #heavyTableNo -> (load time, set of keys), see findHeavyKeys()
+        self.heavyKeyCache = {}
         if conn is None: self.connectToDB(mode=mode, context=context)
         else: self.conn = conn
         #Entity table (=document table): 1
         #Index table: 3
         self.docIdx = MsgpackEntityInvertedIndex(self.conn, 1, 3, keyExtractor=documentKeyExtractor, maxEntities=50)
         self.entityIdx = MsgpackEntityInvertedIndex(self.conn, 2, 4, keyExtractor=entityKeyExtractor, maxEntities=50)
+        #Compact document index: 6 (see CompactPostings)
+        #High-frequency document/entity index keys: 7/8 (see HeavyHitters)
+        self.compactDocIdx = CompactPostings.CompactDocumentIndex(self.conn, 6, 5)
         #Enforce opening the index table with the correct merge operator
         if mode == "REQ":
             self.conn.openTable(1)
             self.conn.openTable(2)
             self.conn.openTable(3, mergeOperator="NULAPPENDSET")
             self.conn.openTable(4, mergeOperator="NULAPPENDSET")
+            self.conn.openTable(5)
+            self.conn.openTable(6)
+            self.conn.openTable(7, mergeOperator="NULAPPENDSET")
+            self.conn.openTable(8, mergeOperator="NULAPPENDSET")
     def connectToDB(self, mode, context=None):
         self.conn = YakDB.Connection(context=context)
         if mode == "PUSH":
@@ -75,15 +324,361 @@ class YakDBDocumentDatabase(MsgpackEntityInvertedIndex):
             self.conn.connect("ipc:///tmp/yakserver-rep")
         return self.conn
     def writeDocument(self, doc):
-        return self.docIdx.writeEntity(doc)
+        return self.writeDocuments([doc])
     def writeDocuments(self, docs):
-        return self.docIdx.writeEntities(docs)
-    def writeEntity(self, *args, **kwargs):
-        return self.entityIdx.writeEntity(*args, **kwargs)
-    def writeEntities(self, *args, **kwargs):
-        return self.entityIdx.writeEntities(*args, **kwargs)
-    def searchDocumentsMultiTokenPrefix(self, *args, **kwargs):
-        return self.docIdx.searchMultiTokenPrefix(*args, **kwargs)
+        "Write documents, splitting them into metadata and paragraph entries"
+        self.writeSerializedDocuments([serializeDocument(doc) for doc in docs])
+    def writeSerializedDocuments(self, serializedDocs):
+        """
+        Write documents serialized using serializeDocument().
+        Paragraphs of previous versions beyond the new number of paragraphs are deleted
+        """
+        entries, numParagraphs = {}, {}
+        for serialized in serializedDocs:
+            entries.update(serialized)
+            #The metadata key is a prefix of the paragraph keys
+            numParagraphs[min(serialized)] = len(serialized) - 1
+        self.removeStaleParagraphs(numParagraphs)
+        self.conn.put(1, entries)
+        self.bumpIndexGeneration()
+    def removeStaleParagraphs(self, numParagraphs):
+        """
+        Delete the paragraph entries beyond the new number of paragraphs of documents that are
+        rewritten, given as {binary document ID: new number of paragraphs}.
+        Paragraph keys are not in numeric order ("paragraph10" < "paragraph2"), so the stale keys
+        are computed from the stored number of paragraphs. PUSH connections can't read it,
+        so all paragraph entries of the documents are deleted before they are rewritten.
+        """
+        if self.mode == "PUSH":
+            for docId in numParagraphs:
+                prefix = docId + b"\x1Eparagraph"
+                self.conn.deleteRange(1, prefix, prefix + b"\xFF", None)
+            return
+        docIds = list(numParagraphs)
+        staleKeys = []
+        for docId, value in zip(docIds, self.conn.read(1, docIds)):
+            if not value: continue #New document
+            #Documents stored in the old format have no paragraph entries
+            oldNumParagraphs = unpackValue(value).get(b"numParagraphs") or 0
+            staleKeys += [paragraphKey(docId, i) for i in range(numParagraphs[docId], oldNumParagraphs)]
+        if staleKeys:
+            self.conn.delete(1, staleKeys)
+    def bumpIndexGeneration(self):
+        "Invalidate search result caches, see indexGenerationKey"
+        self.conn.put(5, {indexGenerationKey: newIndexGeneration()})
+    def findIndexGeneration(self):
+        "Get the current index generation (None if it has never been bumped)"
+        return self.conn.read(5, [indexGenerationKey])[0] or None
+    def findIndexTokenizer(self):
+        """
+        Get the name of the tokenizer the document index has been built with.
+        Indexes built before the tokenizer was recorded have been built with nltk.
+        Returns None if the document index is empty.
+        """
+        value = self.conn.read(5, [indexTokenizerKey])[0]
+        if value:
+            return value.decode("utf-8")
+        return "nltk" if self.conn.scan(3, limit=1) or self.conn.scan(7, limit=1) else None
+    def writeIndexTokenizer(self, tokenizer):
+        "Record the name of the tokenizer the document index is built with"
+        self.conn.put(5, {indexTokenizerKey: tokenizer.encode("utf-8")})
+    def findUnchangedDocuments(self, hashes):
+        """
+        Get the set of document IDs whose content has been imported before,
+        i.e. whose recorded content hash (see contentHash()) equals the given one.
+        hashes: {binary document ID: digest}
+        """
+        if not hashes:
+            return set()
+        docIds = list(hashes)
+        values = self.conn.read(5, [contentHashKey(docId) for docId in docIds])
+        return {docId for docId, value in zip(docIds, values) if value == hashes[docId]}
+    def writeContentHashes(self, hashes):
+        "Record the content hashes of written documents. hashes: {binary document ID: digest}"
+        if hashes:
+            self.conn.put(5, {contentHashKey(docId): digest for docId, digest in hashes.items()})
+    def filterChangedEntities(self, entries):
+        """
+        Reduce entity table entries {entity ID: packed entity} to the new or changed ones,
+        i.e. the ones whose content hash differs from the recorded one (see writeEntityEntries()).
+        Returns ({entity ID: packed entity}, {entity ID: content hash}) of these entities
+        """
+        hashes = {entityId: contentHash(value) for entityId, value in entries.items()}
+        entityIds = list(hashes)
+        knownHashes = self.conn.read(5, [entityHashPrefix + entityId for entityId in entityIds])
+        changed = {entityId: hashes[entityId] for entityId, knownHash in zip(entityIds, knownHashes)
+                   if knownHash != hashes[entityId]}
+        return {entityId: entries[entityId] for entityId in changed}, changed
+    def markDocumentsDirty(self, docIds):
+        "Mark new or changed documents (binary IDs) as to be (re)indexed"
+        if docIds:
+            self.conn.put(5, {dirtyDocumentKey(docId): b"\x01" for docId in docIds})
+    def markEntitiesDirty(self, entityIds):
+        "Mark new or changed entities (binary IDs) as to be (re)indexed"
+        if entityIds:
+            self.conn.put(5, {dirtyEntityPrefix + entityId: b"\x01" for entityId in entityIds})
+    def iterateTable(self, tableNo, startKey=None, endKey=None, chunkSize=10000):
+        "Iterate the (key, value) tuples of a table in chunks of chunkSize"
+        while True:
+            entries = self.conn.scan(tableNo, startKey=startKey, endKey=endKey, limit=chunkSize)
+            for entry in entries:
+                yield entry
+            if len(entries) < chunkSize:
+                return
+            startKey = entries[-1][0] + b"\x00"
+    def iterateStateKeys(self, prefix, chunkSize=10000):
+        "Iterate the keys (without prefix) in the document state table that start with prefix"
+        for key, _ in self.iterateTable(5, prefix, prefix[:-1] + b"\x1F", chunkSize):
+            yield key[len(prefix):]
+    def clearState(self, prefix, keys=None):
+        "Delete the given keys (without prefix) or, if keys is None, all keys with the prefix from the document state table"
+        if keys is None:
+            self.conn.deleteRange(5, prefix, prefix[:-1] + b"\x1F", None)
+        elif keys:
+            self.conn.delete(5, [prefix + key for key in keys])
+    def findIndexRecords(self, prefix, ids):
+        "Get the index records for the given document/entity IDs. Missing records are returned as None"
+        values = self.conn.read(5, [prefix + key for key in ids])
+        return [unpackValue(value) if value else None for value in values]
+    def writeIndexRecords(self, prefix, records):
+        "Write index records {ID: record}"
+        if records:
+            self.conn.put(5, {prefix + key: msgpack.packb(record) for key, record in records.items()})
+    def findHeavyKeys(self, heavyTableNo, maxAge=60.0):
+        """
+        Get the set of index keys that have been moved to the given high-frequency table.
+        The set is cached for maxAge seconds
+        """
+        loadTime, keys = self.heavyKeyCache.get(heavyTableNo, (None, None))
+        if keys is None or time.time() - loadTime > maxAge:
+            keys = frozenset(self.iterateStateKeys(heavyKeyPrefix(heavyTableNo)))
+            self.heavyKeyCache[heavyTableNo] = (time.time(), keys)
+        return keys
+    def writeHeavyKeys(self, heavyTableNo, keys):
+        "Record index keys that have been moved to the given high-frequency table"
+        if keys:
+            prefix = heavyKeyPrefix(heavyTableNo)
+            self.conn.put(5, {prefix + key: b"\x01" for key in keys})
+            self.heavyKeyCache.pop(heavyTableNo, None)
+    def removeHeavyKeys(self, heavyTableNo, keys):
+        "Stop recording index keys as moved to the given high-frequency table"
+        if keys:
+            self.clearState(heavyKeyPrefix(heavyTableNo), keys)
+            self.heavyKeyCache.pop(heavyTableNo, None)
+    def writeDocumentLengths(self, lengths):
+        "Write the lengths {document ID: number of postings} of indexed documents"
+        if lengths:
+            self._updateDocumentLengths(lengths)
+    def removeDocumentLengths(self, docIds):
+        "Delete the lengths of the given documents"
+        if docIds:
+            self._updateDocumentLengths({}, docIds)
+    def _updateDocumentLengths(self, lengths, removedIds=()):
+        "Write and delete document lengths and update the document statistics of this process"
+        docIds = list(lengths) + list(removedIds)
+        with _documentStatisticsLock:
+            statisticsKey = documentStatisticsKey()
+            values = self.conn.read(5, [documentLengthPrefix + docId for docId in docIds] + [statisticsKey])
+            numDocs, totalLength = struct.unpack(">qq", values[-1]) if values[-1] else (0, 0)
+            #Replaced and removed lengths
+            for value in values[:-1]:
+                if value:
+                    numDocs -= 1
+                    totalLength -= struct.unpack(">I", value)[0]
+            numDocs += len(lengths)
+            totalLength += sum(lengths.values())
+            if removedIds:
+                self.conn.delete(5, [documentLengthPrefix + docId for docId in removedIds])
+            entries = {documentLengthPrefix + docId: struct.pack(">I", length) for docId, length in lengths.items()}
+            entries[statisticsKey] = struct.pack(">qq", numDocs, totalLength)
+            self.conn.put(5, entries)
+    def findDocumentLengths(self, docIds):
+        "Get the lengths of the given indexed documents. Missing lengths are returned as None"
+        values = self.conn.read(5, [documentLengthPrefix + docId for docId in docIds])
+        return [struct.unpack(">I", value)[0] if value else None for value in values]
+    def findDocumentStatistics(self):
+        """
+        Get (number of indexed documents, average document length) for ranking.
+        Both are None if no document lengths have been recorded (i.e. the index has
+        been built by an older version). Documents indexed by an older version are not counted.
+        """
+        numDocs, totalLength = 0, 0
+        for _, value in self.iterateTable(5, documentStatisticsPrefix, documentStatisticsPrefix[:-1] + b"\x1F"):
+            processDocs, processLength = struct.unpack(">qq", value)
+            numDocs += processDocs
+            totalLength += processLength
+        if numDocs <= 0:
+            return None, None
+        return numDocs, max(totalLength / float(numDocs), 1.0)
+    def removePostings(self, tableNo, ownerKeys, heavyTableNo=None, chunkSize=1000):
+        """
+        Remove postings from an index table (and its high-frequency table, if any).
+        ownerKeys maps document/entity IDs to the index keys their postings
+        have been written to. Removes all locations of the owner
+        (the ID itself or any ID part) from these keys.
+
+        The affected keys are read and rewritten, so postings pushed to them
+        in the meantime would be lost: This must not run concurrently with
+        any process writing to the index (see NLTKIndexer.removeIndexedVersions()).
+        """
+        owners = collections.defaultdict(set)
+        for ownerId, keys in ownerKeys.items():
+            for key in keys:
+                owners[key].add(ownerId)
+        allKeys = list(owners)
+        for i in range(0, len(allKeys), chunkSize):
+            self._removeLocations(allKeys[i:i + chunkSize], owners, tableNo, heavyTableNo)
+    def _removeLocations(self, keys, owners, tableNo, heavyTableNo=None):
+        "Remove the locations of owners[key] from the given keys, see removePostings()"
+        for table in ([tableNo] if heavyTableNo is None else [tableNo, heavyTableNo]):
+            remaining, present = {}, []
+            for key, value in zip(keys, self.conn.read(table, keys)):
+                if not value:
+                    continue
+                present.append(key)
+                locations = [location for location in value.split(b"\x00") if location and
+                             InvertedIndex.splitEntityIdPart(location)[0] not in owners[key]]
+                if locations:
+                    remaining[key] = b"\x00".join(locations)
+            #The merge operator would append to the old value, so delete it first
+            if present:
+                self.conn.delete(table, present)
+            if remaining:
+                self.conn.put(table, remaining)
+    def clearDocumentIndex(self):
+        "Delete the document index (including the compact index) and all document index state"
+        self.conn.deleteRange(3, None, None, None)
+        self.conn.deleteRange(7, None, None, None)
+        self.clearState(documentIndexRecordPrefix)
+        self.clearState(documentLengthPrefix)
+        self.clearState(documentStatisticsPrefix)
+        self.clearState(dirtyDocumentPrefix)
+        self.clearState(indexTokenizerPrefix)
+        self.clearState(heavyKeyPrefix(7))
+        self.clearCompactDocumentIndex()
+        self.bumpIndexGeneration()
+    def clearCompactDocumentIndex(self):
+        "Delete the compact document index, the document numbers and the document lengths"
+        self.clearState(CompactPostings.compactIndexPrefix)
+        self.conn.deleteRange(6, None, None, None)
+        self.clearState(CompactPostings.docNumberPrefix)
+        self.clearState(CompactPostings.docIdPrefix)
+    def invalidateCompactDocumentIndex(self):
+        "Stop using the compact document index, e.g. because documents have been (re)indexed"
+        self.conn.delete(5, [CompactPostings.compactIndexValidKey])
+    def clearEntityIndex(self):
+        "Delete the entity index and all entity index state"
+        self.conn.deleteRange(4, None, None, None)
+        self.conn.deleteRange(8, None, None, None)
+        self.clearState(entityIndexRecordPrefix)
+        self.clearState(heavyKeyPrefix(8))
+        self.clearState(dirtyEntityPrefix)
+        self.bumpIndexGeneration()
+    def findDocumentMetadata(self, docIds):
+        "Find documents by ID without loading their paragraphs. Missing documents are returned as None"
+        return self.docIdx.findEntities(docIds)
+    def findParagraphs(self, docId, paragraphNos):
+        "Load the given paragraphs of a document. Returns a list in the order of paragraphNos"
+        if not paragraphNos:
+            return []
+        values = self.conn.read(1, [paragraphKey(docId, i) for i in paragraphNos])
+        return [unpackValue(value) for value in values]
+    def assembleDocument(self, metadata):
+        "Load all paragraphs of a document metadata entry (in-place). Returns the full document"
+        if metadata is None or b"paragraphs" in metadata: #Missing or old format
+            return metadata
+        numParagraphs = metadata.pop(b"numParagraphs", 0)
+        metadata[b"paragraphs"] = self.findParagraphs(metadata[b"id"], range(numParagraphs))
+        return metadata
+    def findDocuments(self, docIds):
+        "Find full documents (including all paragraphs) by ID. Missing documents are returned as None"
+        return [self.assembleDocument(metadata)
+                for metadata in self.findDocumentMetadata(docIds)]
+    def writeEntity(self, entity, markDirty=True):
+        self.writeEntities([entity], markDirty=markDirty)
+    def writeEntities(self, entities, markDirty=True):
+        """
+        Write new or changed entities (unchanged ones are skipped).
+        Unless markDirty is False, they are marked as to be (re)indexed
+        """
+        self.writeSerializedEntities([serializeEntity(entity) for entity in entities], markDirty)
+    def writeSerializedEntities(self, serializedEntities, markDirty=True, stateDB=None):
+        """
+        Write entities serialized using serializeEntity(), see writeEntities().
+        The content hashes are looked up using stateDB (default: this database),
+        which must be in REQ mode. Returns the IDs of the written entities
+        """
+        entries = {}
+        for serialized in serializedEntities:
+            entries.update(serialized)
+        entries, hashes = (stateDB or self).filterChangedEntities(entries)
+        self.writeEntityEntries(entries, hashes, list(entries) if markDirty else [])
+        return list(entries)
+    def writeEntityEntries(self, entries, hashes, dirtyIds):
+        """
+        Write entity table entries {entity ID: packed entity}, mark the entities dirtyIds
+        as to be (re)indexed and record the content hashes {entity ID: content hash}
+        """
+        if not entries:
+            return
+        self.conn.put(2, entries)
+        self.markEntitiesDirty(dirtyIds)
+        #Hashes are written last so entities are never skipped unless they have been written
+        if hashes:
+            self.conn.put(5, {entityHashPrefix + entityId: digest for entityId, digest in hashes.items()})
+        self.bumpIndexGeneration()
+    def newDocumentWriteBatch(self, **kwargs):
+        """
+        Create a new AdaptiveWriteBatch for documents. Keyword arguments are passed to AdaptiveWriteBatch.
+        The batch size is only adapted if this connection is in REQ mode
+        """
+        kwargs.setdefault("adaptive", self.mode == "REQ")
+        return AdaptiveWriteBatch(self.writeSerializedDocuments, serializeDocument, **kwargs)
+    def newEntityWriteBatch(self, index=False, **kwargs):
+        """
+        Create a new AdaptiveWriteBatch for entities. Keyword arguments are passed to AdaptiveWriteBatch.
+        If index is True, the entities are indexed while they are written.
+        The batch size is only adapted if this connection is in REQ mode
+        """
+        if index:
+            from Translatron.Indexing.NLTKIndexer import EntityImportIndexer
+            writeFunction = EntityImportIndexer(self, kwargs.get("statistics")).writeSerializedEntities
+        elif self.mode == "REQ":
+            writeFunction = self.writeSerializedEntities
+        else: #Content hashes are read using a separate REQ connection
+            writeFunction = functools.partial(self.writeSerializedEntities,
+                                              stateDB=YakDBDocumentDatabase(mode="REQ"))
+        kwargs.setdefault("adaptive", self.mode == "REQ")
+        return AdaptiveWriteBatch(writeFunction, serializeEntity, **kwargs)
+    def searchDocumentsMultiTokenPrefix(self, tokens, levels):
+        """
+        Find documents containing all tokens (as prefix). Returns {hit location: document metadata}.
+        Uses the compact document index if it is current.
+        """
+        if not self.compactDocIdx.isCurrent():
+            return self.docIdx.searchMultiTokenPrefix(tokens, levels=levels)
+        hits = self.compactDocIdx.searchMultiTokenPrefix(tokens, levels)
+        docs = self.findDocumentMetadata([docId for docId, _ in hits])
+        return {(docId + b"\x1E" + part if part else docId): doc
+                for (docId, part), doc in zip(hits, docs) if doc is not None}
+    def rankDocuments(self, tokens, levelWeights=Ranking.defaultLevelWeights, offset=0, limit=20):
+        """
+        Find documents containing all tokens (as prefix), ranked by BM25 score (see Ranking),
+        without loading them. Uses the compact document index if it is current.
+        Returns (total number of hits, [(document ID, hit location part, score)])
+        """
+        if self.compactDocIdx.isCurrent():
+            return Ranking.rankCompactPostings(self.compactDocIdx, tokens, levelWeights, offset, limit)
+        return Ranking.rankStringPostings(self, tokens, levelWeights, offset, limit)
+    def searchDocumentsRanked(self, tokens, levelWeights=Ranking.defaultLevelWeights, offset=0, limit=20):
+        """
+        Like rankDocuments(), but loads the metadata of the documents on the requested page.
+        Returns (total number of hits, [(hit location, score, document metadata)])
+        """
+        total, hits = self.rankDocuments(tokens, levelWeights, offset, limit)
+        docs = self.findDocumentMetadata([docId for docId, _, _ in hits]) if hits else []
+        return total, [((docId + b"\x1E" + part if part else docId), score, doc)
+                       for (docId, part, score), doc in zip(hits, docs) if doc is not None]
     def searchDocumentsMultiTokenExact(self, *args, **kwargs):
         return self.docIdx.searchMultiTokenExact(*args, **kwargs)
     def searchEntitiesMultiTokenPrefix(self, *args, **kwargs):
@@ -92,8 +687,40 @@ class YakDBDocumentDatabase(MsgpackEntityInvertedIndex):
         return self.entityIdx.searchMultiTokenExact(*args, **kwargs)
     def searchEntitiesSingleTokenMultiExact(self, *args, **kwargs):
         return self.entityIdx.searchSingleTokenMultiExact(*args, **kwargs)
+    def sampleDocumentKeys(self, n=100):
+        "Get the first and the last n keys of the document table (including paragraph keys)"
+        first = self.conn.scan(1, limit=n)
+        last = self.conn.scan(1, limit=n, invert=True)
+        return [key for key, _ in first + last]
+    def sampleEntityKeys(self, n=100):
+        "Get the first and the last n keys of the entity table"
+        first = self.conn.scan(2, limit=n)
+        last = self.conn.scan(2, limit=n, invert=True)
+        return [key for key, _ in first + last]
     def iterateDocuments(self, *args, **kwargs):
-        return self.docIdx.iterateEntities(*args, **kwargs)
+        """
+        Iterate (key, document) tuples of full documents.
+        Paragraph entries directly follow their metadata entry in key order.
+        """
+        currentKey, currentDoc, paragraphs = None, None, {}
+        for key, value in self.docIdx.iterateEntities(*args, **kwargs):
+            docId, isParagraph, part = key.partition(b"\x1E")
+            if isParagraph:
+                if docId == currentKey:
+                    paragraphs[int(part[9:])] = value
+                continue
+            if currentDoc is not None:
+                yield currentKey, self._mergeParagraphs(currentDoc, paragraphs)
+            currentKey, currentDoc, paragraphs = key, value, {}
+        if currentDoc is not None:
+            yield currentKey, self._mergeParagraphs(currentDoc, paragraphs)
+    @staticmethod
+    def _mergeParagraphs(metadata, paragraphs):
+        "Add paragraphs collected by iterateDocuments() to a metadata entry"
+        if b"paragraphs" not in metadata: #Else: Old format, paragraphs are in the metadata entry
+            numParagraphs = metadata.pop(b"numParagraphs", 0)
+            metadata[b"paragraphs"] = [paragraphs.get(i, b"") for i in range(numParagraphs)]
+        return metadata
     def iterateEntities(self, *args, **kwargs):
         return self.entityIdx.iterateEntities(*args, **kwargs)
     def iterateDocumentIndex(self, *args, **kwargs):
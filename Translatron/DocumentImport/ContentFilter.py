@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-term content filter for raw documents.
+
+All plain terms are matched in a single pass using an Aho-Corasick automaton,
+so filtering by thousands of terms (e.g. a list of gene names) costs about
+as much as filtering by one. If pyahocorasick is installed, its C automaton
+is used, else a pure-Python implementation.
+
+Matching is case-insensitive (ASCII) and operates on the raw bytes.
+"""
+import re
+from collections import deque
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+class PyAhoCorasickAutomaton(object):
+    """
+    Pure-Python Aho-Corasick automaton on bytes.
+    Used if pyahocorasick is not available.
+    """
+    def __init__(self, patterns):
+        """
+        Keyword arguments:
+            patterns: An iterable of (bytes pattern, value) tuples
+        """
+        #State -> {byte: next state}
+        self.transitions = [{}]
+        #State -> failure state
+        self.fail = [0]
+        #State -> list of values of patterns ending in that state
+        self.outputs = [[]]
+        for pattern, value in patterns:
+            state = 0
+            for byte in pattern:
+                nextState = self.transitions[state].get(byte)
+                if nextState is None:
+                    nextState = len(self.transitions)
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                    self.transitions[state][byte] = nextState
+                state = nextState
+            self.outputs[state].append(value)
+        #Compute failure links (BFS order)
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for byte, nextState in self.transitions[state].items():
+                queue.append(nextState)
+                failState = self.fail[state]
+                while failState and byte not in self.transitions[failState]:
+                    failState = self.fail[failState]
+                self.fail[nextState] = self.transitions[failState].get(byte, 0)
+                self.outputs[nextState] += self.outputs[self.fail[nextState]]
+    def iter(self, data):
+        "Yield the values of all patterns occurring in data"
+        transitions, fail, outputs = self.transitions, self.fail, self.outputs
+        state = 0
+        for byte in data:
+            while state and byte not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(byte, 0)
+            if outputs[state]:
+                yield from outputs[state]
+
+class ContentFilter(object):
+    """
+    Case-insensitive filter matching many plain terms and/or regular expressions at once.
+    A document passes the filter if at least one term or regex matches.
+
+    The automaton is built lazily, so filter instances are cheap to pass to
+    worker processes.
+    """
+    def __init__(self, terms=(), regexes=()):
+        self.terms = [term for term in terms if term]
+        self.regexes = [regex for regex in regexes if regex]
+        self.automaton = None
+        self.compiledRegexes = None
+    def __bool__(self):
+        "An empty filter lets everything pass"
+        return bool(self.terms or self.regexes)
+    def __getstate__(self):
+        #Automata are rebuilt in the worker process
+        return {"terms": self.terms, "regexes": self.regexes,
+                "automaton": None, "compiledRegexes": None}
+    def _build(self):
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for term in self.terms:
+                #latin-1 maps bytes 1:1 to str, so we can match on raw bytes
+                self.automaton.add_word(term.lower().encode("utf-8").decode("latin-1"), term)
+            if self.terms:
+                self.automaton.make_automaton()
+        else:
+            self.automaton = PyAhoCorasickAutomaton(
+                (term.lower().encode("utf-8"), term) for term in self.terms)
+        self.compiledRegexes = [(regex, re.compile(regex.encode("utf-8"), re.IGNORECASE))
+                                for regex in self.regexes]
+    def _iterTermMatches(self, content):
+        if not self.terms:
+            return
+        if ahocorasick is not None:
+            for _, term in self.automaton.iter(content.decode("latin-1")):
+                yield term
+        else:
+            yield from self.automaton.iter(content)
+    def match(self, content):
+        """
+        Match raw document content (bytes) against the filter.
+        Returns the set of terms and regexes that matched.
+        The document passes the filter if the set is not empty.
+        """
+        if self.automaton is None:
+            self._build()
+        matched = set(self._iterTermMatches(content.lower()))
+        for regex, compiledRegex in self.compiledRegexes:
+            if compiledRegex.search(content) is not None:
+                matched.add(regex)
+        return matched
+
+def readTermFile(filename):
+    "Read a filter term file (one term per line, empty lines and lines starting with # are ignored)"
+    with open(filename, encoding="utf-8") as infile:
+        return [line.strip() for line in infile
+                if line.strip() and not line.startswith("#")]
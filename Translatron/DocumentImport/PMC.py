@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from ctypes import c_bool
+from ctypes import c_longlong
+from concurrent.futures import ThreadPoolExecutor
 import tarfile
 import functools
 import time
+import re
+import gzip
+import shutil
+import subprocess
+import threading
+import os
+import json
+import binascii
+from collections import defaultdict
+from queue import Empty
 from bs4 import BeautifulSoup, Comment, NavigableString
+from lxml import etree
 from Translatron import DocumentDB
+from Translatron.Statistics import IngestStatistics, StatisticsReporter
+from Translatron.DocumentImport.ContentFilter import ContentFilter, readTermFile
 from ansicolor import black, red
-from multiprocessing import Process, Queue
+import zmq
+from multiprocessing import Process, Queue, Value, Condition
 
 __author__ = "Uli Köhler"
 __copyright__ = "Copyright 2015 Uli Köhler"
@@ -20,6 +35,9 @@ __status__ = "Development"
 class DocumentUnparseableException(Exception):
     pass
 
+class WorkerCrashException(Exception):
+    pass
+
 def extractTitle(front):
     "Extract the PMC article title from a document"
     try:
@@ -73,8 +91,150 @@ def extractAuthors(front):
             except: raise DocumentUnparseableException("Name illegal: " + contrib)
     return authors
 
-def processPMCFileContent(xml):
-    "Process a string representing a PMC XML file"
+#
+# Fast path: Precompiled XPath expressions on a plain lxml.etree tree.
+# Each expression mirrors exactly one BeautifulSoup find() call above,
+#  i.e. "(descendant::x)[1]" <-> tag.find("x").
+#
+xpArticle = etree.XPath("(descendant-or-self::article)[1]")
+xpFront = etree.XPath("(descendant::front)[1]")
+xpArticleMeta = etree.XPath("(descendant::article-meta)[1]")
+xpJournalMeta = etree.XPath("(descendant::journal-meta)[1]")
+xpAbstract = etree.XPath("(descendant::abstract)[1]")
+xpArticleID = etree.XPath("(descendant::article-id[@pub-id-type=$idType])[1]")
+xpNLMTAJournal = etree.XPath("(descendant::journal-id[@journal-id-type='nlm-ta'])[1]")
+xpTitleGroup = etree.XPath("(descendant::title-group)[1]")
+xpArticleTitle = etree.XPath("(descendant::article-title)[1]")
+xpPubDate = etree.XPath("(descendant::pub-date[@pub-type=$pubType])[1]")
+xpYear = etree.XPath("(descendant::year)[1]")
+xpMonth = etree.XPath("(descendant::month)[1]")
+xpContribGroup = etree.XPath("(descendant::contrib-group)[1]")
+xpAuthors = etree.XPath("descendant::contrib[@contrib-type='author']")
+xpName = etree.XPath("(descendant::name)[1]")
+xpCollab = etree.XPath("(descendant::collab)[1]")
+xpGivenNames = etree.XPath("(descendant::given-names)[1]")
+xpSurname = etree.XPath("(descendant::surname)[1]")
+#All non-metadata paragraphs, in document order (like find_all("p") on every child).
+# BeautifulSoup's HTML parser drops the <body> tag, so its children are children of
+# the article there and paragraphs directly inside <body> are not collected.
+xpBodyParagraphs = etree.XPath("*[not(self::front) and not(self::back) and not(self::body)]/descendant::p"
+                               " | body/*/descendant::p")
+xpParagraphs = etree.XPath("descendant::p")
+#Text nodes only (comments are skipped, like BeautifulSoup's get_text())
+xpTextNodes = etree.XPath("descendant::text()")
+#Named entities other than the XML builtins need the external DTD,
+# which we don't load. Such documents are handled by BeautifulSoup.
+nonXMLEntityRegex = re.compile(rb"&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)")
+xmlParser = etree.XMLParser(no_network=True, huge_tree=True)
+#The PMC ID in the raw XML, used to find unchanged documents without parsing them
+pmcIdRegex = re.compile(rb"<article-id\s+pub-id-type\s*=\s*[\"']pmc[\"']\s*>\s*([^<\s]+)\s*</article-id>")
+
+def _first(xpath, node, **kwargs):
+    "Evaluate a [1]-XPath and return the first result or None"
+    result = xpath(node, **kwargs)
+    return result[0] if result else None
+
+def _text(node, separator=""):
+    "Equivalent of BeautifulSoup's tag.text / tag.get_text(separator)"
+    return separator.join(xpTextNodes(node))
+
+def _requireText(node, what):
+    if node is None:
+        raise DocumentUnparseableException("Can't extract %s from document" % what)
+    return _text(node)
+
+def fastExtractArticleID(front, idType="doi"):
+    "Fast-path equivalent of extractArticleID()"
+    articleMeta = _first(xpArticleMeta, front)
+    if articleMeta is None: return None
+    articleId = _first(xpArticleID, articleMeta, idType=idType)
+    return None if articleId is None else _text(articleId)
+
+def rawDocumentID(xml):
+    "Get the binary document ID (see fastProcessPMCDoc()) of a raw PMC XML document or None"
+    match = pmcIdRegex.search(xml)
+    return None if match is None else b"pmc:" + match.group(1)
+
+def fastExtractTitle(articleMeta):
+    "Fast-path equivalent of extractTitle()"
+    titleGroup = _first(xpTitleGroup, articleMeta)
+    title = None if titleGroup is None else _first(xpArticleTitle, titleGroup)
+    return _requireText(title, "title")
+
+def fastExtractPublicationDate(articleMeta):
+    "Fast-path equivalent of extractPublicationDate()"
+    for pubType in ("ppub", "epub"):
+        pubDate = _first(xpPubDate, articleMeta, pubType=pubType)
+        if pubDate is None: continue
+        year = _first(xpYear, pubDate)
+        month = _first(xpMonth, pubDate)
+        if year is not None and month is not None:
+            return _text(year) + "-" + _text(month)
+    return "Unknown"
+
+def fastExtractAuthors(articleMeta):
+    "Fast-path equivalent of extractAuthors()"
+    authors = []
+    contribGroup = _first(xpContribGroup, articleMeta)
+    if contribGroup is None: return []
+    for contrib in xpAuthors(contribGroup):
+        name = _first(xpName, contrib)
+        if name is None: #Probably a collaboration
+            authors.append(_requireText(_first(xpCollab, contrib), "collab"))
+        else: #A natural person
+            givenNames = _first(xpGivenNames, name)
+            surname = _first(xpSurname, name)
+            if givenNames is None or surname is None:
+                raise DocumentUnparseableException("Name illegal")
+            authors.append(_text(givenNames) + " " + _text(surname))
+    return authors
+
+def fastProcessPMCDoc(root):
+    "Fast-path equivalent of processPMCDoc(), operating on a lxml.etree tree"
+    article = _first(xpArticle, root)
+    if article is None:
+        raise DocumentUnparseableException("Document does not contain an article")
+    front = _first(xpFront, article)
+    articleMeta = None if front is None else _first(xpArticleMeta, front)
+    if articleMeta is None:
+        raise DocumentUnparseableException("Document does not contain article metadata")
+    abstract = _first(xpAbstract, articleMeta)
+    if abstract is None:
+        raise DocumentUnparseableException("Document does not contain an abstract")
+    pmcId = fastExtractArticleID(front, "pmc")
+    if pmcId is None:
+        raise DocumentUnparseableException("Document does not have a PMC ID")
+    journalMeta = _first(xpJournalMeta, front)
+    journal = None if journalMeta is None else _first(xpNLMTAJournal, journalMeta)
+    doc = {
+        "id": "pmc:" + pmcId,
+        "pmid": fastExtractArticleID(front, "pmid"),
+        "pmcid": "PMC" + pmcId,
+        "authors": fastExtractAuthors(articleMeta),
+        "title": fastExtractTitle(articleMeta),
+        "doi": fastExtractArticleID(front, "doi"),
+        "journal": _requireText(journal, "NLM-TA journal identifier"),
+        "pubdate": fastExtractPublicationDate(articleMeta),
+        "source": "PMC",
+    }
+    paragraphTags = xpBodyParagraphs(article) + xpParagraphs(abstract)
+    doc["paragraphs"] = [_text(p, u" ") for p in paragraphTags]
+    return doc
+
+def parsePMCXML(xml):
+    """
+    Parse a PMC XML string into a lxml.etree tree.
+    Raises etree.XMLSyntaxError (or ValueError) if the document
+    can't be handled by the fast path
+    """
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+    if nonXMLEntityRegex.search(xml) is not None:
+        raise ValueError("Document uses non-XML named entities")
+    return etree.fromstring(xml, xmlParser)
+
+def processPMCFileContentSoup(xml):
+    "Process a string representing a PMC XML file using BeautifulSoup only"
     soup = BeautifulSoup(xml, "lxml")
     try:
         return processPMCDoc(soup)
@@ -83,80 +243,546 @@ def processPMCFileContent(xml):
         print(e)
         return None
 
+def processPMCFileContent(xml):
+    """
+    Process a string representing a PMC XML file.
+    Uses the XPath fast path and falls back to BeautifulSoup
+    for documents that are not well-formed XML.
+    """
+    try:
+        root = parsePMCXML(xml)
+    except (etree.XMLSyntaxError, ValueError):
+        return processPMCFileContentSoup(xml)
+    try:
+        return fastProcessPMCDoc(root)
+    except Exception as e:
+        front = _first(xpFront, root)
+        pmcId = None if front is None else fastExtractArticleID(front, "pmc")
+        print(red("Parser exception while processsing PMC:%s" % pmcId))
+        print(e)
+        return None
+
+def openGzipStream(infile):
+    """
+    Open a .gz file for sequential reading.
+    pigz/zcat are about 5-10 times faster than the gzip module and decompress
+    in a separate process, i.e. outside the GIL. If neither tool is available,
+    we fall back to in-process decompression.
+
+    Returns a tuple (file-like object, subprocess or None)
+    """
+    for cmd in (["pigz", "-dc"], ["zcat"]):
+        if shutil.which(cmd[0]) is not None:
+            p = subprocess.Popen(cmd + [infile], stdout=subprocess.PIPE, bufsize=1024*1024)
+            return p.stdout, p
+    return gzip.open(infile, "rb"), None
+
+class ByteBoundedQueue(object):
+    """
+    A multiprocessing queue that is bounded by the total size (in bytes)
+    of the items in the queue instead of the number of items.
+    This avoids both starving workers on small documents
+    and excessive memory usage on large ones.
+    """
+    def __init__(self, maxBytes=256*1024*1024):
+        self.queue = Queue()
+        self.maxBytes = maxBytes
+        self.currentBytes = Value(c_longlong, 0, lock=False)
+        self.condition = Condition()
+    def put(self, item, size=0):
+        "Put an item into the queue, blocking while the byte budget is exceeded"
+        with self.condition:
+            #An empty queue always accepts the item, else huge items would block forever.
+            #Zero-size items (termination signals) never block.
+            while size and self.currentBytes.value > 0 and self.currentBytes.value + size > self.maxBytes:
+                self.condition.wait()
+            self.currentBytes.value += size
+        self.queue.put((size, item))
+    def get(self, timeout=None):
+        "Get the next item from the queue, blocking (up to timeout) if it is empty"
+        size, item = self.queue.get(timeout=timeout)
+        if size:
+            with self.condition:
+                self.currentBytes.value -= size
+                self.condition.notify_all()
+        return item
+    def getMany(self, maxItems, timeout=None):
+        """
+        Get up to maxItems items: Blocks (up to timeout) for the first item only,
+        then takes the items that are immediately available.
+        Stops after a termination signal (None), which is returned as the last item.
+        """
+        items = [self.get(timeout)]
+        while len(items) < maxItems and items[-1] is not None:
+            try:
+                items.append(self.get(timeout=0))
+            except Empty:
+                break
+        return items
+    def currentSize(self):
+        "Get the number of bytes currently in the queue"
+        return self.currentBytes.value
+
+class PMCImportManifest(object):
+    """
+    Checkpoint manifest that allows resuming an interrupted PMC import.
+
+    The manifest is a file containing one JSON object per line,
+    either for a committed archive member:
+        {"archive": "articles.A-B.tar.gz", "member": "A/B.nxml", "offset": 1536, "id": "pmc:123"}
+    ("id" is null for documents that could not be parsed) or for an archive
+    that has been imported completely:
+        {"archive": "articles.A-B.tar.gz", "complete": true}
+    Lines are only appended after YakDB has acknowledged the write.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        #Archive basename -> set of committed member names
+        self.committed = defaultdict(set)
+        self.completeArchives = set()
+        if os.path.isfile(filename):
+            with open(filename) as infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: #Truncated last line after a crash
+                        continue
+                    if record.get("complete"):
+                        self.completeArchives.add(record["archive"])
+                    else:
+                        self.committed[record["archive"]].add(record["member"])
+        self.outfile = open(filename, "a")
+    def isComplete(self, archive):
+        return archive in self.completeArchives
+    def isCommitted(self, archive, member):
+        return member in self.committed.get(archive, ())
+    def _append(self, records):
+        for record in records:
+            self.outfile.write(json.dumps(record) + "\n")
+        #Make sure the checkpoint survives a crash of the importer
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+    def commit(self, written, unparseable):
+        "Record written [(archive, member, offset, id)] and unparseable [(archive, member, offset)] members"
+        self._append([{"archive": archive, "member": member, "offset": offset, "id": docId}
+                      for (archive, member, offset, docId) in written] +
+                     [{"archive": archive, "member": member, "offset": offset, "id": None}
+                      for (archive, member, offset) in unparseable])
+    def markComplete(self, archive):
+        self._append([{"archive": archive, "complete": True}])
+        self.completeArchives.add(archive)
+    def close(self):
+        self.outfile.close()
+
 class PMCProcessorWorker(Process):
     """
     PMC processor with a dedicated YakDB connection that
-    is used to spread load of processing onto multiple cores
+    is used to spread load of processing onto multiple cores.
+
+    Every batch of committed documents is reported on the result queue
+    as a tuple ([(archive, member, offset, id)], [(archive, member, offset)], [(archive, member)],
+    [(archive, member)], stats), i.e. the written, unparseable, filtered and unchanged documents
+    plus an IngestStatistics snapshot of the work done since the last report.
+
+    The SHA1 hash of the raw XML is stored in the document's "contentHash" field and
+    in the document state table (by document ID). If dedup is True, documents whose content
+    has been imported before under the same ID (e.g. from another archive or an earlier release)
+    are skipped before parsing. The ID is extracted from the raw XML (see rawDocumentID()).
+    Queued documents are taken in chunks of up to chunkSize documents (without waiting
+    for more to arrive), so the known hashes are looked up once per chunk.
+    Written documents are marked as to be indexed unless they are indexed right away.
+
+    If a content filter is given, it is applied to the raw XML in the worker.
+    The filter terms that matched are stored in the document's "filterTerms" list.
+
+    If index is True, the worker also tokenizes the documents and pushes
+    the postings together with every batch of documents, so no separate
+    indexing pass is required.
+
+    Documents are written using an AdaptiveWriteBatch. batchOptions are
+    passed to its constructor.
     """
-    def __init__(self, queue):
+    def __init__(self, queue, resultQueue, index=False, contentFilter=None, batchOptions=None, dedup=True, tokenizer=None, chunkSize=64):
         super(PMCProcessorWorker, self).__init__()
         self.queue = queue
-        #Accumulates documents that will be written. Reduces number of PUT requests
-        self.writeQueue = []
-    def run(self):
-        db = DocumentDB.YakDBDocumentDatabase(mode="PUSH")
-        for data in iter( self.queue.get, None ):
-            #Convert XML string to document object
+        self.resultQueue = resultQueue
+        self.index = index
+        self.contentFilter = contentFilter
+        self.batchOptions = batchOptions or {}
+        self.dedup = dedup
+        self.tokenizer = tokenizer
+        self.chunkSize = chunkSize
+        #Archive members corresponding to the documents in the write batch
+        self.writeKeys = []
+        self.unparseable = []
+        self.filtered = []
+        self.unchanged = []
+        #Binary document ID -> content hash for the documents in the write batch
+        self.contentHashes = {}
+        #Binary document ID -> (tokens, location ID, level) tuples for the documents in the write batch
+        self.postings = {}
+    def writeDocuments(self, serializedDocs):
+        "Write function of the write batch, called with serialized documents"
+        #Postings are pushed first so they are never missing for committed documents.
+        # Documents that have been indexed before are reindexed by the indexer instead
+        dirtyIds = list(self.contentHashes)
+        if self.postings:
+            from Translatron.Indexing.NLTKIndexer import writeImportPostings
+            dirtyIds = writeImportPostings(self.db, self.pushDB, self.postings, self.statistics)
+        self.db.writeSerializedDocuments(serializedDocs)
+        self.db.markDocumentsDirty(dirtyIds)
+        #Hashes are written last so documents are never skipped unless they have been written
+        self.db.writeContentHashes(self.contentHashes)
+        self.statistics.count("documents", len(serializedDocs))
+        self.reportResults()
+    def reportResults(self):
+        "Report written, unparseable, filtered and unchanged documents to the main process"
+        self.resultQueue.put((self.writeKeys, self.unparseable, self.filtered, self.unchanged,
+                              self.statistics.takeSnapshot()))
+        self.writeKeys, self.unparseable, self.filtered, self.unchanged = [], [], [], []
+        self.postings, self.contentHashes = {}, {}
+    def flush(self):
+        self.batch.flush()
+        #Report documents that did not end up in the batch
+        # and statistics recorded after the last report (e.g. the write time)
+        if self.unparseable or self.filtered or self.unchanged or \
+                self.statistics.timers or self.statistics.counters:
+            self.reportResults()
+    def processChunk(self, items):
+        "Filter, deduplicate and parse a chunk of (archive, member, offset, raw XML) queue items"
+        candidates = []
+        for archive, member, offset, data in items:
+            # Apply content filter (if any) on the raw document
+            filterTerms = None
+            if self.contentFilter:
+                with self.statistics.timer("filter"):
+                    filterTerms = self.contentFilter.match(data)
+                if not filterTerms:
+                    self.filtered.append((archive, member))
+                    self.statistics.count("filtered")
+                    continue
+            candidates.append((archive, member, offset, data, filterTerms, DocumentDB.contentHash(data)))
+        # Skip documents that have been imported before without parsing them.
+        # One lookup for the whole chunk instead of one round trip per document
+        docIds, unchangedIds = [None] * len(candidates), set()
+        if self.dedup and candidates:
+            with self.statistics.timer("dedup"):
+                docIds = [rawDocumentID(candidate[3]) for candidate in candidates]
+                #The last version of a document in the chunk is the one that is kept
+                unchangedIds = self.db.findUnchangedDocuments({docId: candidate[-1] for docId, candidate
+                                                               in zip(docIds, candidates) if docId is not None})
+        for (archive, member, offset, data, filterTerms, digest), docId in zip(candidates, docIds):
+            if docId in unchangedIds:
+                self.unchanged.append((archive, member))
+                self.statistics.count("unchanged")
+                continue
+            self.processDocument(archive, member, offset, data, filterTerms, digest)
+    def processDocument(self, archive, member, offset, data, filterTerms, digest):
+        "Parse a new or changed document and add it to the write batch"
+        #Convert XML string to document object
+        with self.statistics.timer("parse"):
             doc = processPMCFileContent(data)
-            if doc is None: continue #Parse error
-            self.writeQueue.append(doc)
-            #Write if write queue size has been reached
-            if len(self.writeQueue) >= 128:
-                db.writeDocuments(self.writeQueue)
-                self.writeQueue.clear()
+        if doc is None: #Parse error
+            self.unparseable.append((archive, member, offset))
+            self.statistics.count("parseErrors")
+            return
+        if self.contentFilter:
+            doc["filterTerms"] = sorted(filterTerms)
+        doc["contentHash"] = binascii.hexlify(digest).decode("ascii")
+        self.contentHashes[doc["id"].encode("utf-8")] = digest
+        self.writeKeys.append((archive, member, offset, doc["id"]))
+        if self.index:
+            from Translatron.Indexing.NLTKIndexer import tokenizeDocument
+            with self.statistics.timer("tokenize"):
+                docId = doc["id"].encode("utf-8")
+                self.postings[docId] = [(list(tokens), locationId, level) for (tokens, locationId, level)
+                                        in tokenizeDocument(docId, doc["title"], doc["paragraphs"], self.tokenizer)]
+        #Writes if any budget of the batch is exceeded
+        self.batch.writeEntity(doc)
+    def run(self):
+        context = zmq.Context()
+        #REQ/REP mode: Writes are acknowledged by YakDB before they are reported as committed
+        self.db = DocumentDB.YakDBDocumentDatabase(mode="REQ", context=context)
+        self.statistics = IngestStatistics()
+        self.batch = DocumentDB.AdaptiveWriteBatch(self.writeDocuments, DocumentDB.serializeDocument,
+                                                   statistics=self.statistics, **self.batchOptions)
+        #Postings are high-volume, so they use a separate PUSH connection
+        if self.index:
+            self.pushDB = DocumentDB.YakDBDocumentDatabase(mode="PUSH", context=context)
+        while True:
+            try:
+                with self.statistics.timer("queueWait"):
+                    items = self.queue.getMany(self.chunkSize, timeout=self.batch.maxDelay)
+            except Empty: #Idle: Don't keep documents waiting longer than the time budget
+                self.flush()
+                continue
+            #A termination signal is always the last item of a chunk
+            terminate = items[-1] is None
+            if terminate:
+                items.pop()
+            self.processChunk(items)
+            if terminate:
+                break
         #Flush remaining
-        if self.writeQueue:
-            db.writeDocuments(self.writeQueue)
+        self.flush()
+        #Closes all sockets, waiting until pushed postings have been sent
+        context.destroy()
 
 class PMCTARParser(object):
-    def __init__(self, numWorkers=8):
-        "Initialize a new multithreaded PMC TAR parser"
-        #Worker queue
-        self.queue = Queue(maxsize=1024)
-        #Start worker processes
+    def __init__(self, numWorkers=8, numReaders=2, maxQueueBytes=256*1024*1024, manifest=None, maxRetries=2, maxRestarts=32, index=False, contentFilter=None, batchOptions=None, statisticsFile=None, dedup=True, tokenizer=None):
+        """
+        Initialize a new multithreaded PMC TAR parser
+
+        Keyword arguments:
+            numWorkers: The number of parser/writer processes
+            numReaders: The number of archives that are read in parallel
+            maxQueueBytes: Maximum size of the raw XML waiting for the workers
+            manifest: A PMCImportManifest to skip committed and record new documents, or None
+            maxRetries: How often documents lost by crashed workers are retried
+            maxRestarts: How often crashed workers are restarted before giving up
+            index: Whether to index the documents while importing them
+            contentFilter: A ContentFilter applied to the raw documents by the workers, or None
+            batchOptions: Keyword arguments for the workers' AdaptiveWriteBatch
+            statisticsFile: File to write periodic per-stage statistics (JSON lines) to, or None
+            dedup: Whether to skip documents whose content has been imported before
+            tokenizer: The name of the tokenizer to use if index is True, None for the default
+        """
         self.numWorkers = numWorkers
+        self.numReaders = numReaders
+        self.maxQueueBytes = maxQueueBytes
+        self.manifest = manifest
+        self.maxRetries = maxRetries
+        self.maxRestarts = maxRestarts
+        self.index = index
+        self.contentFilter = contentFilter
+        self.batchOptions = batchOptions
+        self.statisticsFile = statisticsFile
+        self.dedup = dedup
+        self.tokenizer = tokenizer
+        self.numRestarts = 0
+        #Set if the import is aborted. Stops reader threads
+        self.aborted = False
+        #Worker queue and commit notifications from the workers
+        self.queue = ByteBoundedQueue(maxQueueBytes)
+        self.resultQueue = Queue()
+        self.workers = []
+        #Documents that have been queued but not yet been committed.
+        # (archive, member) -> queue item. Used to retry documents from crashed workers.
+        self.pending = {}
+        self.pendingLock = threading.Lock()
+        #Statistics. The read counter is shared by the reader threads only.
+        self.readCount = 0
+        self.writtenCount = 0
+        self.unparseableCount = 0
+        self.filteredCount = 0
+        self.unchangedCount = 0
+        #Per-stage statistics, merged over all readers and workers
+        self.statistics = IngestStatistics()
+        self.statisticsLock = threading.Lock()
+    def iteratePMCTarGZEntries(self, infile, filterStr=""):
+        "Iterate (TarFile, TarInfo) for XML files inside a PMC .tar.gz that pass the given prefix filter"
+        fin, proc = openGzipStream(infile)
+        try:
+            with tarfile.open(fileobj=fin, mode='r|') as tarIn:
+                for entry in tarIn:
+                    if not entry.isfile():
+                        if entry.name.startswith(filterStr):
+                            print("Processing %s ..." % entry.name)
+                        else:
+                            print("Skipping %s ..." % entry.name)
+                        continue
+                    #Apply prefix fiter
+                    if not entry.name.startswith(filterStr): continue
+                    yield tarIn, entry
+        finally:
+            #Wait for decompressor to exit
+            if proc is not None:
+                proc.stdout.close()
+                proc.wait()
     def iteratePMCTarGZ(self, infile, filterStr=""):
         "Iterate XML files inside a PMC .tar.gz that pass the given prefix filter"
-        with tarfile.open(infile, 'r|gz') as tarIn:
-            for entry in tarIn:
-                if not entry.isfile():
-                    if entry.name.startswith(filterStr):
-                        print("Processing %s ..." % entry.name)
-                    else:
-                        print("Skipping %s ..." % entry.name)
-                    continue
-                #Apply prefix fiter
-                if not entry.name.startswith(filterStr): continue
-                #Open entry as file-like object
-                fin = tarIn.extractfile(entry)
-                yield fin
-    def processPMCTarGZ(self, infile, filterStr="", contentFilterStr=None):
-        "Process a .tar.gz containing PMC XMLs, e.g. articles.A-B.tar.gz"
+        for tarIn, entry in self.iteratePMCTarGZEntries(infile, filterStr):
+            #Open entry as file-like object
+            yield tarIn.extractfile(entry)
+    def readPMCTarGZ(self, infile, filterStr=""):
+        """
+        Reader thread: Feed XML files from one PMC .tar.gz into the worker queue.
+        Only streams bytes, all processing (including content filtering) is done by the workers
+        """
+        archive = os.path.basename(infile)
+        if self.manifest is not None and self.manifest.isComplete(archive):
+            print("Skipping %s (already imported)" % archive)
+            return
+        #Read time includes waiting for the decompressor
+        readStartTime = time.perf_counter()
+        for tarIn, entry in self.iteratePMCTarGZEntries(infile, filterStr):
+            if self.aborted: return
+            #Skip committed documents without reading or parsing them
+            if self.manifest is not None and self.manifest.isCommitted(archive, entry.name):
+                continue
+            #TARs are sequential streams, so we need to .read() NOW
+            content = tarIn.extractfile(entry).read()
+            # Process asynchronously
+            item = (archive, entry.name, entry.offset, content)
+            with self.pendingLock:
+                self.pending[(archive, entry.name)] = item
+                self.readCount += 1
+            putStartTime = time.perf_counter()
+            self.queue.put(item, len(content))
+            #Statistics
+            with self.statisticsLock:
+                self.statistics.addTime("read", putStartTime - readStartTime)
+                self.statistics.addTime("queueFull", time.perf_counter() - putStartTime)
+                self.statistics.count("bytesRead", len(content))
+            readStartTime = time.perf_counter()
+    def startWorker(self):
+        worker = PMCProcessorWorker(self.queue, self.resultQueue, index=self.index,
+                                    contentFilter=self.contentFilter, batchOptions=self.batchOptions,
+                                    dedup=self.dedup, tokenizer=self.tokenizer)
+        worker.start()
+        return worker
+    def superviseWorkers(self):
+        "Restart crashed worker processes. Returns the number of restarted workers"
+        numRestarted = 0
+        for i, worker in enumerate(self.workers):
+            if worker.exitcode: #None: running, 0: regular exit
+                if self.numRestarts >= self.maxRestarts:
+                    raise WorkerCrashException("Worker processes crashed %d times, giving up" % self.numRestarts)
+                self.numRestarts += 1
+                print(red("Worker process %d died with exit code %d, restarting" % (worker.pid, worker.exitcode)))
+                self.workers[i] = self.startWorker()
+                numRestarted += 1
+        return numRestarted
+    def handleResults(self, timeout):
+        "Process all available commit notifications. Waits up to timeout for the first one"
+        try:
+            result = self.resultQueue.get(timeout=timeout)
+        except Empty:
+            return False
+        while result is not None:
+            written, unparseable, filtered, unchanged, statistics = result
+            with self.statisticsLock:
+                self.statistics.merge(statistics)
+            with self.pendingLock:
+                for (archive, member, _, _) in written:
+                    self.pending.pop((archive, member), None)
+                for (archive, member, _) in unparseable:
+                    self.pending.pop((archive, member), None)
+                for key in filtered + unchanged:
+                    self.pending.pop(key, None)
+            self.writtenCount += len(written)
+            self.unparseableCount += len(unparseable)
+            self.filteredCount += len(filtered)
+            self.unchangedCount += len(unchanged)
+            if self.manifest is not None:
+                self.manifest.commit(written, unparseable)
+            try:
+                result = self.resultQueue.get_nowait()
+            except Empty:
+                result = None
+        return True
+    def waitForWorkers(self):
+        "Supervise workers until all of them have exited after receiving their termination signal"
+        while True:
+            self.handleResults(timeout=0.5)
+            #A crashed worker might already have consumed its termination signal
+            for i in range(self.superviseWorkers()):
+                self.queue.put(None)
+            if not any(worker.is_alive() for worker in self.workers):
+                break
+        for worker in self.workers:
+            worker.join()
+        #Workers flush the result queue before exiting
+        while self.handleResults(timeout=0.1):
+            pass
+    def abort(self, futures):
+        "Stop all readers and workers. Committed documents stay in the manifest"
+        self.aborted = True
+        for worker in self.workers:
+            worker.terminate()
+        #Unblock readers waiting for free space in the queue
+        while not all(future.done() for future in futures):
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+    def retryPending(self):
+        "Re-process documents that have been lost by crashed workers. Returns False if there are none"
+        with self.pendingLock:
+            items = list(self.pending.values())
+        if not items:
+            return False
+        print(red("Retrying %d documents lost by crashed workers" % len(items)))
+        #Fresh queue: The old one might contain surplus termination signals
+        self.queue = ByteBoundedQueue(self.maxQueueBytes)
+        self.workers = [self.startWorker() for i in range(self.numWorkers)]
+        def feed():
+            for item in items:
+                self.queue.put(item, len(item[3]))
+            for i in range(self.numWorkers):
+                self.queue.put(None)
+        threading.Thread(target=feed, daemon=True).start()
+        self.waitForWorkers()
+        return True
+    def printProgress(self, startTime):
+        "Print aggregate statistics over all readers and workers"
+        deltaT = max(time.time() - startTime, 1e-9)
+        print("Read %d documents (%.1f docs/s), wrote %d documents (%.1f docs/s), queue: %.1f MiB"
+              % (self.readCount, self.readCount / deltaT, self.writtenCount, self.writtenCount / deltaT,
+                 self.queue.currentSize() / (1024. * 1024.)))
+    def processPMCTarGZs(self, infiles, filterStr="", progressInterval=10.0):
+        """
+        Process multiple .tar.gz files containing PMC XMLs, e.g. articles.A-B.tar.gz.
+        Up to numReaders archives are read in parallel, all feeding the same worker pool.
+        Returns after all documents have been written.
+        """
         startTime = time.time()
-        docCount = 0
+        reporter = StatisticsReporter("import-documents", self.statisticsFile)
         #Start worker processes
-        for i in range(self.numWorkers):
-            PMCProcessorWorker(self.queue).start()
-        #Process tar files
-        for filelike in self.iteratePMCTarGZ(infile, filterStr):
-            if filelike is not None:
-                #TARs are sequential streams, so we need to .read() NOW,
-                # even if a thread pool (as opposed to a process pool)
-                # would be used
-                content = filelike.read()
-                # Apply content filter (if any)
-                if contentFilterStr:
-                    if contentFilterStr not in content.lower():
-                        continue
-                # Process asynchronously
-                self.queue.put(content)
-                docCount += 1
-        #Terminate worker processes (asynchronously)
-        for i in range(self.numWorkers):
-            self.queue.put(None)
+        self.workers = [self.startWorker() for i in range(self.numWorkers)]
+        #Read archives in parallel. Decompression happens in subprocesses,
+        # so reader threads are sufficient here.
+        lastProgress = startTime
+        with ThreadPoolExecutor(max_workers=self.numReaders) as executor:
+            futures = {executor.submit(self.readPMCTarGZ, infile, filterStr): infile
+                       for infile in infiles}
+            try:
+                while not all(future.done() for future in futures):
+                    self.handleResults(timeout=0.5)
+                    self.superviseWorkers()
+                    if time.time() - lastProgress >= progressInterval:
+                        self.printProgress(startTime)
+                        lastProgress = time.time()
+                    with self.statisticsLock:
+                        reporter.report(self.statistics)
+                #Terminate worker processes and wait until everything is written
+                for i in range(self.numWorkers):
+                    self.queue.put(None)
+                self.waitForWorkers()
+                for i in range(self.maxRetries):
+                    if not self.retryPending(): break
+            except WorkerCrashException:
+                self.abort(futures)
+                raise
+        #Mark archives as complete if they have been read successfully and nothing is missing
+        for future, infile in futures.items():
+            archive = os.path.basename(infile)
+            if future.exception() is not None:
+                print(red("Error while reading %s: %s" % (infile, future.exception())))
+            elif self.manifest is not None and not self.manifest.isComplete(archive) \
+                    and not any(key[0] == archive for key in self.pending):
+                self.manifest.markComplete(archive)
         #Stats
         endTime = time.time()
-        print("Imported %d documents in %.1f seconds" % (docCount, endTime - startTime))
+        print("Imported %d documents (%d unchanged, %d unparseable, %d filtered) in %.1f seconds"
+              % (self.writtenCount, self.unchangedCount, self.unparseableCount,
+                 self.filteredCount, endTime - startTime))
+        if self.pending:
+            print(red("%d documents could not be written. Re-run the import to retry them" % len(self.pending), bold=True))
+        reporter.finish(self.statistics)
+    def processPMCTarGZ(self, infile, filterStr=""):
+        "Process a .tar.gz containing PMC XMLs, e.g. articles.A-B.tar.gz"
+        self.processPMCTarGZs([infile], filterStr)
     def processPMCXML(self, infile):
         "Process a single PMC XML file. Does not use separate worker processes."
         #Read file content
@@ -203,11 +829,71 @@ def processPMCDoc(soup):
 
 def runPMCImporterCLITool(args):
     #Open tables with REQ/REP connection
-    DocumentDB.YakDBDocumentDatabase(mode="REQ")
+    db = DocumentDB.YakDBDocumentDatabase(mode="REQ")
+    #Imported documents must be indexed with the tokenizer of the existing index
+    tokenizer = args.tokenizer
+    if args.index:
+        from Translatron.Indexing.NLTKIndexer import resolveIndexTokenizer
+        try:
+            tokenizer = resolveIndexTokenizer(db, args.tokenizer)
+        except ValueError as ex:
+            print(red(str(ex), bold=True))
+            return
+    #Checkpoint manifest to resume interrupted imports
+    manifest = PMCImportManifest(args.checkpoint) if args.checkpoint else None
+    #Multi-term content filter, applied by the workers
+    filterTerms = list(args.content_filter)
+    if args.content_filter_file:
+        filterTerms += readTermFile(args.content_filter_file)
+    contentFilter = ContentFilter(filterTerms, args.content_filter_regex)
     #Worker threads will have individual DB connections
-    parser = PMCTARParser(numWorkers=args.workers)
+    parser = PMCTARParser(numWorkers=args.workers, numReaders=args.parallel_archives,
+                          maxQueueBytes=args.queue_size * 1024 * 1024, manifest=manifest,
+                          index=args.index, contentFilter=contentFilter,
+                          batchOptions=DocumentDB.writeBatchOptions(args),
+                          statisticsFile=args.stats_json, dedup=not args.no_dedup,
+                          tokenizer=tokenizer)
+    #All archives are fed into a single worker pool
+    tarFiles = [infile for infile in args.infile if infile.endswith(".tar.gz")]
+    if tarFiles:
+        parser.processPMCTarGZs(tarFiles, filterStr=args.filter)
     for infile in args.infile:
-        if infile.endswith(".tar.gz"):
-            parser.processPMCTarGZ(infile, filterStr=args.filter, contentFilterStr=args.content_filter.lower().encode("utf-8"))
-        elif infile.endswith(".nxml") or infile.endswith(".xml"):
+        if infile.endswith(".nxml") or infile.endswith(".xml"):
             parser.processPMCXML(infile)
+    if manifest is not None:
+        manifest.close()
+
+if __name__ == "__main__":
+    # Parity check & parse throughput benchmark: XPath fast path vs BeautifulSoup
+    # Usage: python3 -m Translatron.DocumentImport.PMC articles.A-B.tar.gz
+    import argparse
+    from ansicolor import green
+    argParser = argparse.ArgumentParser(description="Compare the PMC XPath extractor to the BeautifulSoup extractor")
+    argParser.add_argument("infile", nargs="+", help="The PMC articles.X-Y.tar.gz or .nxml file(s) to use as corpus")
+    argParser.add_argument("-n", "--limit", type=int, default=1000, help="Maximum number of documents to use")
+    args = argParser.parse_args()
+    #Read corpus into memory so only parsing is measured
+    corpus = []
+    for infile in args.infile:
+        if infile.endswith(".tar.gz"):
+            for filelike in PMCTARParser(numWorkers=1).iteratePMCTarGZ(infile):
+                corpus.append(filelike.read())
+                if len(corpus) >= args.limit: break
+        else:
+            with open(infile, "rb") as fin:
+                corpus.append(fin.read())
+        if len(corpus) >= args.limit: break
+    #Run both extractors. process_time() -> single core throughput
+    results = {}
+    for name, fn in [("BeautifulSoup", processPMCFileContentSoup), ("XPath", processPMCFileContent)]:
+        startTime = time.process_time()
+        results[name] = [fn(xml) for xml in corpus]
+        deltaT = time.process_time() - startTime
+        print(black("%s: %d documents in %.2f s (%.1f docs/s per core)"
+                    % (name, len(corpus), deltaT, len(corpus) / max(deltaT, 1e-9)), bold=True))
+    #Parity check
+    mismatches = [a for a, b in zip(results["BeautifulSoup"], results["XPath"]) if a != b]
+    for doc in mismatches:
+        print(red("Mismatch for %s" % (doc["id"] if doc else "unparseable document")))
+    if not mismatches:
+        print(green("All %d documents are identical" % len(corpus)))
@@ -9,6 +9,7 @@ http://www.nlm.nih.gov/mesh/elmesh99.pdf
 from .ParseMeSH import readMeSH
 from collections import defaultdict
 from Translatron import DocumentDB
+from Translatron.Statistics import IngestStatistics, StatisticsReporter, timedIterate
 from ansicolor import blue, red, black, green
 from .ParseMeSH import readMeSH
 import time
@@ -26,19 +27,28 @@ def meshEntryToEntity(entry):
 
 def importMeSH(args, infile):
     db = DocumentDB.YakDBDocumentDatabase(mode="PUSH")
-    # NOTE: MeSH 2015 contains only 27k entities
-    batch = db.entityIdx.newWriteBatch(chunkSize=40000)
+    statistics = IngestStatistics()
+    reporter = StatisticsReporter("import-entities", args.stats_json)
+    batch = db.newEntityWriteBatch(statistics=statistics, index=args.index,
+                                   **DocumentDB.writeBatchOptions(args))
     print(green("Starting to import entities from %s" % infile))
     # Read file
     with open(infile, "r") as infile:
         writeStartTime = time.time()
-        for mesh in readMeSH(infile):
+        for mesh in timedIterate(readMeSH(infile), statistics, "read"):
             # Write entity to database
-            batch.writeEntity(meshEntryToEntity(mesh))
+            with statistics.timer("convert"):
+                entity = meshEntryToEntity(mesh)
+            batch.writeEntity(entity)
+            statistics.count("entities")
+            reporter.report(statistics)
             # Statistics
             if batch.numWrites % 5000 == 0:
                 deltaT = time.time() - writeStartTime
                 entityWriteRate = batch.numWrites / deltaT
-                print("Wrote %d entities at %.1f e/s"
-                      % (batch.numWrites, entityWriteRate))
+                print("Wrote %d entities at %.1f e/s (%.2f MiB/s, batch size %d)"
+                      % (batch.numWrites, entityWriteRate,
+                         batch.stats()["bytesPerSecond"] / (1024. * 1024.), batch.chunkSize))
+    batch.flush()
     print("Wrote overall %d entities" % batch.numWrites)
+    reporter.finish(statistics)
@@ -13,6 +13,7 @@ from __future__ import print_function
 from .ParseUniprot import readUniprot
 from collections import defaultdict
 from Translatron import DocumentDB
+from Translatron.Statistics import IngestStatistics, StatisticsReporter, timedIterate
 from ansicolor import blue, red, black, green
 import time
 import subprocess
@@ -76,21 +77,31 @@ def uniprotEntryToEntity(entry):
 
 def importUniprot(args, infile):
     db = DocumentDB.YakDBDocumentDatabase(mode="PUSH")
-    batch = db.entityIdx.newWriteBatch(chunkSize=25000)
+    statistics = IngestStatistics()
+    reporter = StatisticsReporter("import-entities", args.stats_json)
+    batch = db.newEntityWriteBatch(statistics=statistics, index=args.index,
+                                   **DocumentDB.writeBatchOptions(args))
     print(green("Starting to import entities from %s" % infile))
     # Read uniprot file, zcat is about 5-10 times faster and
     #  distributes load over multiple cores.
     p = subprocess.Popen(["zcat", infile], stdout=subprocess.PIPE)
     writeStartTime = time.time()
-    for uniprot in readUniprot(p.stdout):
+    for uniprot in timedIterate(readUniprot(p.stdout), statistics, "read"):
         # Write entity to database
-        batch.writeEntity(uniprotEntryToEntity(uniprot))
+        with statistics.timer("convert"):
+            entity = uniprotEntryToEntity(uniprot)
+        batch.writeEntity(entity)
+        statistics.count("entities")
+        reporter.report(statistics)
         # Statistics
         if batch.numWrites % 10000 == 0:
             deltaT = time.time() - writeStartTime
             entityWriteRate = batch.numWrites / deltaT
-            print("Wrote %d entities at %.1f e/s"
-                  % (batch.numWrites, entityWriteRate))
+            print("Wrote %d entities at %.1f e/s (%.2f MiB/s, batch size %d)"
+                  % (batch.numWrites, entityWriteRate,
+                     batch.stats()["bytesPerSecond"] / (1024. * 1024.), batch.chunkSize))
+    batch.flush()
     #Wait for subprocess to exit
     p.communicate()
     print("Wrote overall %d entities" % batch.numWrites)
+    reporter.finish(statistics)
@@ -11,6 +11,7 @@ Other wikis (dewiki, ...) are also supported but untested
 import subprocess
 import time
 from Translatron import DocumentDB
+from Translatron.Statistics import IngestStatistics, StatisticsReporter, timedIterate
 from ansicolor import blue, red, black, green
 
 def readWikimediaFile(infile):
@@ -36,10 +37,13 @@ def readWikimediaFile(infile):
 
 def importWikimediaPagelist(args, infile):
     db = DocumentDB.YakDBDocumentDatabase(mode="PUSH")
-    batch = db.entityIdx.newWriteBatch(chunkSize=100000)
+    statistics = IngestStatistics()
+    reporter = StatisticsReporter("import-entities", args.stats_json)
+    batch = db.newEntityWriteBatch(statistics=statistics, index=args.index,
+                                   **DocumentDB.writeBatchOptions(args))
     print(green("Starting to import entities from %s" % infile))
     writeStartTime = time.time()
-    for (pageId, pageTitle) in readWikimediaFile(infile):
+    for (pageId, pageTitle) in timedIterate(readWikimediaFile(infile), statistics, "read"):
         # Write entity to database
         pageIdStr = pageId.decode("utf-8")
         batch.writeEntity({
@@ -49,10 +53,15 @@ def importWikimediaPagelist(args, infile):
             "type": "Encyclopedia entry",
             "ref": {"Wikipedia": [pageIdStr]},
         })
+        statistics.count("entities")
+        reporter.report(statistics)
         # Statistics
         if batch.numWrites % 10000 == 0:
             deltaT = time.time() - writeStartTime
             entityWriteRate = batch.numWrites / deltaT
-            print("Wrote %d entities at %.1f e/s"
-                  % (batch.numWrites, entityWriteRate))
+            print("Wrote %d entities at %.1f e/s (%.2f MiB/s, batch size %d)"
+                  % (batch.numWrites, entityWriteRate,
+                     batch.stats()["bytesPerSecond"] / (1024. * 1024.), batch.chunkSize))
+    batch.flush()
     print("Wrote overall %d entities" % batch.numWrites)
+    reporter.finish(statistics)
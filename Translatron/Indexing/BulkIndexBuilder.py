@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+External sort-merge bulk index builder.
+
+Instead of pushing every posting to YakDB (where the NULAPPENDSET merge
+operator folds millions of tiny appends), the indexer workers emit
+(index key, location) postings into sorted run files on disk.
+The runs are k-way merged and every index key is written exactly once,
+with its complete posting list, in key order. The compact document index
+(see CompactPostings) is written in the same pass.
+
+Run files are streams of msgpack-encoded (key, location) tuples,
+sorted and without duplicates. At most maxFanIn runs are opened at once:
+If there are more, they are merged into intermediate runs in several passes.
+"""
+import glob
+import heapq
+import itertools
+import os
+import shutil
+import struct
+import tempfile
+import time
+import msgpack
+from multiprocessing import Queue
+from Translatron import DocumentDB
+from Translatron.Indexing import CompactPostings
+from Translatron.Indexing.NLTKIndexer import DocumentIndexerWorker, tokenizeDocument, splitKeyRange
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+class SortedRunWriter(object):
+    """
+    Buffers (key, location) postings in memory and spills them
+    to a new sorted run file once maxPostings postings have been buffered.
+    """
+    def __init__(self, directory, prefix, maxPostings=2000000, statistics=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.maxPostings = maxPostings
+        self.statistics = statistics
+        self.postings = []
+        self.runs = []
+    def add(self, key, location):
+        self.postings.append((key, location))
+        if len(self.postings) >= self.maxPostings:
+            self.flush()
+    def flush(self):
+        "Write the buffered postings to a new run file"
+        if not self.postings:
+            return
+        startTime = time.perf_counter()
+        filename = os.path.join(self.directory, "%s-%06d.run" % (self.prefix, len(self.runs)))
+        packer = msgpack.Packer(use_bin_type=True)
+        with open(filename, "wb") as outfile:
+            for posting in sorted(set(self.postings)):
+                outfile.write(packer.pack(posting))
+        self.runs.append(filename)
+        self.postings = []
+        if self.statistics is not None:
+            self.statistics.addTime("spill", time.perf_counter() - startTime)
+            self.statistics.count("runs")
+
+def iterateRun(filename, bufferSize=1024*1024):
+    "Iterate the (key, location) postings of a run file"
+    with open(filename, "rb") as infile:
+        for key, location in msgpack.Unpacker(infile, raw=True, use_list=False,
+                                              read_size=bufferSize):
+            yield key, location
+
+def _groupPostings(merged):
+    "Group sorted (key, location) postings to (key, distinct locations)"
+    for key, postings in itertools.groupby(merged, key=lambda posting: posting[0]):
+        locations = []
+        for _, location in postings:
+            #Runs are sorted, so duplicates from different runs are adjacent
+            if not locations or locations[-1] != location:
+                locations.append(location)
+        yield key, locations
+
+def mergeRunFiles(filenames, outFilename):
+    "Merge sorted run files into a single run file"
+    packer = msgpack.Packer(use_bin_type=True)
+    with open(outFilename, "wb") as outfile:
+        lastPosting = None
+        for posting in heapq.merge(*[iterateRun(filename) for filename in filenames]):
+            #Runs are sorted, so duplicates from different runs are adjacent
+            if posting != lastPosting:
+                outfile.write(packer.pack(posting))
+                lastPosting = posting
+
+def mergeRuns(filenames, maxFanIn=256, statistics=None):
+    """
+    K-way merge sorted run files.
+    Yields (key, locations) tuples in key order where locations
+    is the sorted list of all distinct locations of the key.
+
+    At most maxFanIn files are open at once, more runs are first merged
+    into intermediate runs (next to the first run file), which are deleted
+    once they have been merged.
+    """
+    filenames = list(filenames)
+    intermediateRuns = set()
+    passNo = 0
+    while len(filenames) > maxFanIn:
+        startTime = time.perf_counter()
+        mergedRuns = []
+        for i in range(0, len(filenames), maxFanIn):
+            group = filenames[i:i + maxFanIn]
+            if len(group) == 1: #Nothing to merge
+                mergedRuns.append(group[0])
+                continue
+            outFilename = "%s.pass%d-%06d" % (filenames[0], passNo, len(mergedRuns))
+            mergeRunFiles(group, outFilename)
+            intermediateRuns.add(outFilename)
+            mergedRuns.append(outFilename)
+            for filename in group:
+                if filename in intermediateRuns:
+                    os.remove(filename)
+                    intermediateRuns.discard(filename)
+        filenames = mergedRuns
+        passNo += 1
+        if statistics is not None:
+            statistics.addTime("merge pass", time.perf_counter() - startTime)
+    try:
+        for key, locations in _groupPostings(heapq.merge(*[iterateRun(filename) for filename in filenames])):
+            yield key, locations
+    finally:
+        for filename in intermediateRuns:
+            os.remove(filename)
+
+class BatchedTableWriter(object):
+    "Writes entries to a table in batches of about maxBytes"
+    def __init__(self, conn, tableNo, statistics, maxBytes=4*1024*1024):
+        self.conn = conn
+        self.tableNo = tableNo
+        self.statistics = statistics
+        self.maxBytes = maxBytes
+        self.batch = {}
+        self.batchSize = 0
+        #Total size of the keys and values written
+        self.bytesWritten = 0
+    def put(self, key, value):
+        self.batch[key] = value
+        self.batchSize += len(key) + len(value)
+        if self.batchSize >= self.maxBytes:
+            self.flush()
+    def flush(self):
+        if self.batch:
+            with self.statistics.timer("write"):
+                self.conn.put(self.tableNo, self.batch)
+        self.bytesWritten += self.batchSize
+        self.batch, self.batchSize = {}, 0
+
+def writeMergedRuns(conn, tableNo, filenames, statistics, docNumbers=None, compactTableNo=6,
+                    maxPostings=None, heavyTableNo=7, maxFanIn=256):
+    """
+    Merge the given run files and write the complete posting list of every key
+    to the given index table, in key order. The table is expected to be empty.
+
+    If docNumbers ({document ID: document number}) is given, the compact
+    posting lists (see CompactPostings) are written to compactTableNo as well
+    and the document lengths (number of postings) are returned as "docLengths".
+    Keys with more than maxPostings postings are written to heavyTableNo instead
+    and returned as "heavyKeys". At most maxFanIn run files are opened at once (see mergeRuns()).
+
+    Returns a dictionary of index statistics.
+    """
+    writer = BatchedTableWriter(conn, tableNo, statistics)
+    heavyWriter = BatchedTableWriter(conn, heavyTableNo, statistics)
+    compactWriter = BatchedTableWriter(conn, compactTableNo, statistics) if docNumbers is not None else None
+    docLengths = [0] * len(docNumbers) if docNumbers is not None else None
+    numKeys, numPostings = 0, 0
+    heavyKeys = []
+    for key, locations in mergeRuns(filenames, maxFanIn, statistics):
+        if maxPostings is not None and len(locations) > maxPostings:
+            heavyWriter.put(key, b"\x00".join(locations))
+            heavyKeys.append(key)
+            statistics.count("heavy keys")
+            continue
+        writer.put(key, b"\x00".join(locations))
+        if compactWriter is not None:
+            with statistics.timer("encode"):
+                compactPostings = []
+                for location in locations:
+                    docId, _, part = location.partition(b"\x1E")
+                    docNumber = docNumbers[docId]
+                    compactPostings.append((docNumber, CompactPostings.partNumber(part)))
+                    docLengths[docNumber] += 1
+                compactWriter.put(key, CompactPostings.encodePostings(compactPostings))
+        numKeys += 1
+        numPostings += len(locations)
+    writer.flush()
+    heavyWriter.flush()
+    result = {"keys": numKeys, "postings": numPostings, "bytes": writer.bytesWritten, "heavyKeys": heavyKeys}
+    if compactWriter is not None:
+        compactWriter.flush()
+        result["compactBytes"] = compactWriter.bytesWritten
+        result["docLengths"] = docLengths
+    statistics.count("keys", numKeys)
+    statistics.count("postings", numPostings)
+    return result
+
+def assignDocumentNumbers(rwDB, statistics):
+    """
+    Assign dense document numbers (in document ID order) to all indexed documents
+    and store the mapping in the document state table. Returns {document ID: number}
+    """
+    docNumbers = {}
+    writer = BatchedTableWriter(rwDB.conn, 5, statistics)
+    for number, docId in enumerate(rwDB.iterateStateKeys(DocumentDB.documentIndexRecordPrefix)):
+        docNumbers[docId] = number
+        writer.put(CompactPostings.docNumberPrefix + docId, struct.pack(">Q", number))
+        writer.put(CompactPostings.docNumberKey(number), docId)
+    writer.flush()
+    return docNumbers
+
+class BulkDocumentIndexerWorker(DocumentIndexerWorker):
+    """
+    Document indexer worker that writes its postings to sorted run files
+    in runDirectory instead of pushing them to the database.
+    Index records and document lengths are written to the database as usual.
+    """
+    def __init__(self, taskQueue, resultQueue, runDirectory, maxRunPostings=2000000, **kwargs):
+        super(BulkDocumentIndexerWorker, self).__init__(taskQueue, resultQueue, **kwargs)
+        self.runDirectory = runDirectory
+        self.maxRunPostings = maxRunPostings
+        self.runWriter = None
+    def indexBatch(self, rwDB, pushDB, docs, statistics):
+        if self.runWriter is None:
+            self.runWriter = SortedRunWriter(self.runDirectory, "worker%d" % os.getpid(),
+                                             self.maxRunPostings, statistics)
+        records, lengths = {}, {}
+        for doc in docs:
+            with statistics.timer("tokenize"):
+                postings = list(tokenizeDocument(doc[b"id"], doc[b"title"], doc[b"paragraphs"], self.tokenizer))
+            with statistics.timer("postings"):
+                keys, docPostings = set(), set()
+                for tokens, locationId, level in postings:
+                    for token in tokens:
+                        key = DocumentDB.indexKey(level, token)
+                        keys.add(key)
+                        docPostings.add((key, locationId))
+                        self.runWriter.add(key, locationId)
+                records[doc[b"id"]] = {"keys": sorted(keys)}
+                lengths[doc[b"id"]] = len(docPostings)
+        with statistics.timer("postings"):
+            rwDB.writeIndexRecords(DocumentDB.documentIndexRecordPrefix, records)
+            rwDB.writeDocumentLengths(lengths)
+        statistics.count("documents", len(docs))
+    def finish(self, statistics):
+        if self.runWriter is not None:
+            self.runWriter.flush()
+
+def bulkBuildDocumentIndex(indexer, tmpdir=None, compact=True, maxPostings=None,
+                           progressInterval=10.0, batchSize=64):
+    """
+    Rebuild the document index of a TranslatronDocumentIndexer from scratch
+    using sorted runs in a temporary directory (in tmpdir, if given).
+    If compact is True, the compact document index is built as well.
+    Keys with more than maxPostings postings are written to the high-frequency table.
+    """
+    indexer.rwDB.clearDocumentIndex()
+    indexer.rwDB.writeIndexTokenizer(indexer.tokenizer)
+    sampleKeys = indexer.rwDB.sampleDocumentKeys()
+    if not sampleKeys:
+        print("No documents to index")
+        return
+    tasks = splitKeyRange(sampleKeys, indexer.processes * indexer.rangesPerProcess)
+    runDirectory = tempfile.mkdtemp(prefix="translatron-index-", dir=tmpdir)
+    try:
+        taskQueue, resultQueue = Queue(), Queue()
+        workers = [BulkDocumentIndexerWorker(taskQueue, resultQueue, runDirectory, batchSize=batchSize,
+                                             tokenizer=indexer.tokenizer)
+                   for i in range(indexer.processes)]
+        if not indexer.runIndexerWorkers(tasks, workers, taskQueue, resultQueue, progressInterval):
+            print("Not writing an incomplete document index, use --full to retry")
+            indexer.rwDB.clearDocumentIndex()
+            return
+        runs = sorted(glob.glob(os.path.join(runDirectory, "*.run")))
+        docNumbers = assignDocumentNumbers(indexer.rwDB, indexer.statistics) if compact else None
+        print("Merging %d sorted runs" % len(runs))
+        startTime = time.time()
+        with indexer.statistics.timer("merge"):
+            result = writeMergedRuns(indexer.rwDB.conn, 3, runs, indexer.statistics, docNumbers,
+                                     maxPostings=maxPostings)
+        print("Wrote %d index keys with %d postings in %.1f seconds, index size %.1f MB"
+              % (result["keys"], result["postings"], time.time() - startTime, result["bytes"] / 1e6))
+        indexer.rwDB.writeHeavyKeys(7, result["heavyKeys"])
+        if compact:
+            #A new build ID invalidates cached document lengths
+            indexer.rwDB.conn.put(5, {CompactPostings.docLengthsKey: CompactPostings.encodeDocLengths(result["docLengths"]),
+                                      CompactPostings.compactIndexValidKey: os.urandom(8)})
+            print("Compact index size %.1f MB (%.1f%% of the index size)"
+                  % (result["compactBytes"] / 1e6, 100. * result["compactBytes"] / max(result["bytes"], 1)))
+        indexer.rwDB.bumpIndexGeneration()
+        if indexer.reporter is not None:
+            indexer.reporter.report(indexer.statistics)
+    finally:
+        shutil.rmtree(runDirectory, ignore_errors=True)
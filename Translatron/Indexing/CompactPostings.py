@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact document index with integer document numbers.
+
+Every indexed document gets a dense document number (in document ID order).
+A posting list is stored as a sequence of varint pairs
+(document number delta, part number) sorted by (document number, part number),
+where part number 0 is the title and n + 1 is paragraph n.
+
+Multi-token search intersects the document numbers of the tokens and only
+looks up the string document IDs of the final hits. The number of postings
+of every document is stored as its length for ranking (see Ranking). If NumPy is installed,
+decoding and intersection are vectorized, else plain Python is used.
+
+The compact index is a read-optimized copy of the document index
+which is written by the bulk index builder. It is only used while it is
+current, i.e. until documents are indexed in any other way.
+
+Run this module to measure posting list size and intersection speed:
+    python3 -m Translatron.Indexing.CompactPostings
+"""
+import struct
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+#Key prefixes in the document state table (#5):
+#   Document ID -> document number
+docNumberPrefix = b"docnum\x1E"
+#   Document number (8 bytes, big endian) -> document ID
+docIdPrefix = b"docid\x1E"
+#   Compact index status. The "current" key (value: random build ID) is present if the compact index is current
+compactIndexPrefix = b"compactindex\x1E"
+compactIndexValidKey = compactIndexPrefix + b"current"
+#   Document lengths (number of postings) by document number, see encodeDocLengths()
+docLengthsKey = compactIndexPrefix + b"doclengths"
+
+def docNumberKey(number):
+    return docIdPrefix + struct.pack(">Q", number)
+
+def partNumber(part):
+    "Map a location part (b'' for the title, b'paragraphN') to its part number"
+    if not part:
+        return 0
+    if part.startswith(b"paragraph"):
+        return int(part[9:]) + 1
+    raise ValueError("Can't encode location part %r" % part)
+
+def locationPart(number):
+    "Inverse of partNumber()"
+    return b"paragraph" + str(number - 1).encode("ascii") if number else b""
+
+def encodeDocLengths(lengths):
+    "Encode a list of document lengths (indexed by document number) as native uint32 array"
+    return array("I", lengths).tobytes()
+
+def decodeDocLengths(data):
+    "Decode document lengths. Returns a NumPy uint32 array (or an array.array without NumPy)"
+    if numpy is None:
+        lengths = array("I")
+        lengths.frombytes(data)
+        return lengths
+    return numpy.frombuffer(data, dtype=numpy.uint32)
+
+def encodeVarint(value, out):
+    "Append the LEB128 varint encoding of a non-negative integer to a bytearray"
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decodeVarints(data):
+    "Decode a sequence of varints. Returns a NumPy uint64 array (or a list without NumPy)"
+    if numpy is None:
+        values, value, shift = [], 0, 0
+        for byte in data:
+            value |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+            else:
+                values.append(value)
+                value, shift = 0, 0
+        return values
+    arr = numpy.frombuffer(data, dtype=numpy.uint8)
+    if not len(arr):
+        return numpy.zeros(0, dtype=numpy.uint64)
+    ends = numpy.flatnonzero(arr < 0x80)
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    #Position of every byte within its varint
+    positions = numpy.arange(len(arr)) - numpy.repeat(starts, ends - starts + 1)
+    values = (arr & 0x7F).astype(numpy.uint64) << (7 * positions).astype(numpy.uint64)
+    return numpy.add.reduceat(values, starts)
+
+def encodePostings(postings):
+    "Encode an iterable of (document number, part number) tuples"
+    out = bytearray()
+    lastDoc = 0
+    for doc, part in sorted(set(postings)):
+        encodeVarint(doc - lastDoc, out)
+        encodeVarint(part, out)
+        lastDoc = doc
+    return bytes(out)
+
+def decodePostings(data):
+    "Decode a posting list. Returns (document numbers, part numbers)"
+    values = decodeVarints(data)
+    if numpy is None:
+        docs, doc = [], 0
+        for delta in values[0::2]:
+            doc += delta
+            docs.append(doc)
+        return docs, values[1::2]
+    return numpy.cumsum(values[0::2]), values[1::2]
+
+def firstPostings(docs, parts):
+    """
+    Reduce postings sorted by document number to the first posting of every document.
+    Returns (unique document numbers, part numbers) arrays (or a {document number: part number} dict without NumPy)
+    """
+    if numpy is None:
+        firstParts = {}
+        for doc, part in zip(docs, parts):
+            firstParts.setdefault(doc, part)
+        return firstParts
+    if not len(docs):
+        return docs, parts
+    first = numpy.empty(len(docs), dtype=bool)
+    first[0] = True
+    numpy.not_equal(docs[1:], docs[:-1], out=first[1:])
+    return docs[first], parts[first]
+
+def intersectDocuments(docSets):
+    "Intersect sorted unique document number arrays (or sets without NumPy). Returns a sorted array (or list)"
+    if numpy is None:
+        return sorted(set.intersection(*docSets))
+    docSets = sorted(docSets, key=len)
+    result = docSets[0]
+    #Binary search the (smaller) result in the other arrays
+    for docs in docSets[1:]:
+        indices = numpy.minimum(numpy.searchsorted(docs, result), len(docs) - 1)
+        result = result[docs[indices] == result]
+    return result
+
+class CompactDocumentIndex(object):
+    """
+    Search access to the compact document index.
+    """
+    def __init__(self, conn, tableNo=6, stateTableNo=5):
+        self.conn = conn
+        self.tableNo = tableNo
+        self.stateTableNo = stateTableNo
+        #(build ID, document lengths) cache
+        self.docLengths = (None, None)
+    def buildId(self):
+        "Get the build ID of the compact index or None if it is not current"
+        return self.conn.read(self.stateTableNo, [compactIndexValidKey])[0] or None
+    def isCurrent(self):
+        "Check if the compact index has been built and not invalidated since"
+        return self.buildId() is not None
+    def findDocLengths(self):
+        "Get the document lengths of the current build (cached) or None if they are not available"
+        buildId = self.buildId()
+        if buildId != self.docLengths[0]:
+            data = self.conn.read(self.stateTableNo, [docLengthsKey])[0]
+            self.docLengths = (buildId, decodeDocLengths(data) if data else None)
+        return self.docLengths[1]
+    def findDocIds(self, numbers):
+        "Map document numbers to binary document IDs"
+        return self.conn.read(self.stateTableNo, [docNumberKey(int(number)) for number in numbers])
+    def findTokenPostings(self, token, levels):
+        """
+        Prefix search for a single token on the given levels.
+        Returns (sorted unique document numbers, first hit part numbers) arrays
+        (or (set, {document number: part number}) without NumPy).
+        """
+        if isinstance(token, str): token = token.encode("utf-8")
+        postingLists = []
+        for level in levels:
+            prefix = level + b"\x1E" + token
+            #0xFF never occurs in UTF-8, so it ends the prefix range
+            for key, value in self.conn.scan(self.tableNo, startKey=prefix, endKey=prefix + b"\xFF"):
+                postingLists.append(decodePostings(value))
+        if numpy is None:
+            firstParts = firstPostings([doc for docs, _ in postingLists for doc in docs],
+                                       [part for _, parts in postingLists for part in parts])
+            return set(firstParts), firstParts
+        if not postingLists:
+            return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.uint64)
+        docs = numpy.concatenate([docs for docs, _ in postingLists])
+        parts = numpy.concatenate([parts for _, parts in postingLists])
+        if len(postingLists) > 1:
+            order = numpy.argsort(docs, kind="stable")
+            docs, parts = docs[order], parts[order]
+        return firstPostings(docs, parts)
+    def findTokenFrequencies(self, token, levelWeights):
+        """
+        Prefix search for a single token on the levels of the given {level: weight} dict.
+        Returns (sorted unique document numbers, weighted number of postings, first hit part numbers)
+        arrays (or a {document number: [weighted number of postings, part number]} dict without NumPy).
+        """
+        if isinstance(token, str): token = token.encode("utf-8")
+        postingLists = []
+        for level, weight in levelWeights.items():
+            prefix = level + b"\x1E" + token
+            for key, value in self.conn.scan(self.tableNo, startKey=prefix, endKey=prefix + b"\xFF"):
+                postingLists.append(decodePostings(value) + (weight,))
+        if numpy is None:
+            frequencies = {}
+            for docs, parts, weight in postingLists:
+                for doc, part in zip(docs, parts):
+                    entry = frequencies.get(doc)
+                    if entry is None:
+                        frequencies[doc] = [weight, part]
+                    else:
+                        entry[0] += weight
+            return frequencies
+        if not postingLists:
+            empty = numpy.zeros(0, dtype=numpy.uint64)
+            return empty, numpy.zeros(0), empty
+        docs = numpy.concatenate([docs for docs, _, _ in postingLists])
+        parts = numpy.concatenate([parts for _, parts, _ in postingLists])
+        weights = numpy.concatenate([numpy.full(len(docs), weight) for docs, _, weight in postingLists])
+        if len(postingLists) > 1:
+            order = numpy.argsort(docs, kind="stable")
+            docs, parts, weights = docs[order], parts[order], weights[order]
+        first = numpy.empty(len(docs), dtype=bool)
+        first[0] = True
+        numpy.not_equal(docs[1:], docs[:-1], out=first[1:])
+        return docs[first], numpy.add.reduceat(weights, numpy.flatnonzero(first)), parts[first]
+    def searchMultiTokenPrefix(self, tokens, levels, limit=50):
+        """
+        Find documents that contain all tokens (as prefix) on any of the levels.
+        Tokens with no hits at all are ignored.
+        Returns a list of up to limit (document ID, hit location part) tuples.
+        """
+        tokenHits = [self.findTokenPostings(token, levels) for token in tokens]
+        tokenHits = [(docs, parts) for docs, parts in tokenHits if len(docs)]
+        if not tokenHits:
+            return []
+        docs = intersectDocuments([docs for docs, _ in tokenHits])[:limit]
+        #Hit location: The first part of the document hit by the first token
+        firstDocs, firstParts = tokenHits[0]
+        if numpy is None:
+            parts = [firstParts[doc] for doc in docs]
+        else:
+            parts = firstParts[numpy.searchsorted(firstDocs, docs)].tolist()
+        return [(docId, locationPart(part))
+                for part, docId in zip(parts, self.findDocIds(docs)) if docId]
+
+def _benchmark(numDocs=1000000, numTokens=4, hitRate=0.05, rounds=20):
+    "Compare size and intersection speed of string and compact posting lists"
+    import random
+    import time
+    rng = random.Random(1)
+    docIds = [b"PMC%07d" % (1000000 + i) for i in range(numDocs)]
+    postingLists = []
+    for i in range(numTokens):
+        postingLists.append(sorted((doc, rng.randrange(20)) for doc in range(numDocs)
+                                   if rng.random() < hitRate * (i + 1)))
+    stringValues = [b"\x00".join(docIds[doc] + b"\x1Eparagraph" + str(part).encode("ascii")
+                                 for doc, part in postings) for postings in postingLists]
+    compactValues = [encodePostings((doc, part + 1) for doc, part in postings)
+                     for postings in postingLists]
+    stringSize, compactSize = sum(map(len, stringValues)), sum(map(len, compactValues))
+    print("Postings: %d, string size: %.1f MB, compact size: %.1f MB (%.1f%%)"
+          % (sum(map(len, postingLists)), stringSize / 1e6, compactSize / 1e6, 100. * compactSize / stringSize))
+    #String postings: Split locations and intersect document ID sets
+    startTime = time.perf_counter()
+    for i in range(rounds):
+        sets = [{location.partition(b"\x1E")[0] for location in value.split(b"\x00")}
+                for value in stringValues]
+        stringResult = set.intersection(*sets)
+    stringTime = (time.perf_counter() - startTime) / rounds
+    startTime = time.perf_counter()
+    for i in range(rounds):
+        docSets = []
+        for value in compactValues:
+            firstDocs = firstPostings(*decodePostings(value))
+            docSets.append(firstDocs[0] if numpy is not None else set(firstDocs))
+        compactResult = intersectDocuments(docSets)
+    compactTime = (time.perf_counter() - startTime) / rounds
+    assert len(stringResult) == len(compactResult)
+    print("Intersection of %d tokens (%d hits): string %.1f ms, compact %.1f ms (NumPy: %s)"
+          % (numTokens, len(compactResult), stringTime * 1000., compactTime * 1000., numpy is not None))
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Heavy-hitter (high-frequency token) management for the index tables.
+
+    - MisraGries: Streaming top-k token counter with bounded memory.
+      Replaces a Counter over every token of the index.
+    - suggestStopwords(): Heavy hitters of the document index that are
+      not stopwords yet, used to generate stopwords.txt entries.
+    - capPostings(): Moves index keys with more than maxPostings postings
+      to a separate high-frequency table, so single hot tokens don't
+      blow up search latency and memory. Search ignores tokens that
+      have no hits in the regular index table, like stopwords.
+      Entity alias keys are never moved (see uncappedLevels).
+"""
+from ansicolor import black
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+class MisraGries(object):
+    """
+    Weighted Misra-Gries heavy-hitter sketch with at most 2k counters.
+
+    Counts are underestimated by at most self.error, which is bounded
+    by total weight / (k + 1). Every item with more than that weight is kept.
+    """
+    def __init__(self, k=1000):
+        self.k = k
+        self.counters = {}
+        self.total = 0
+        self.error = 0
+    def add(self, item, weight=1):
+        self.total += weight
+        self.counters[item] = self.counters.get(item, 0) + weight
+        #Reducing to k counters once 2k are used makes updates amortized O(1)
+        if len(self.counters) > 2 * self.k:
+            decrement = sorted(self.counters.values(), reverse=True)[self.k]
+            self.error += decrement
+            self.counters = {item: count - decrement for item, count
+                             in self.counters.items() if count > decrement}
+    def items(self):
+        "(item, estimated count) tuples of the current heavy hitters"
+        return self.counters.items()
+    def mostCommon(self, n=None):
+        "Get the n (default: all) heaviest (item, estimated count) tuples, heaviest first"
+        return sorted(self.counters.items(), key=lambda i: i[1], reverse=True)[:n]
+
+def countPostings(value):
+    "Get the number of postings (NUL-separated locations) in an index table value"
+    return value.count(b"\x00") + 1 if value else 0
+
+def tokenHeavyHitters(rwDB, tableNo, k=1000, levels=None):
+    """
+    Stream an index table into a MisraGries sketch of (token -> number of postings).
+    Only the given levels (default: all) are counted.
+    """
+    sketch = MisraGries(k)
+    for key, value in rwDB.iterateTable(tableNo):
+        level, _, token = key.partition(b"\x1E")
+        if levels is None or level in levels:
+            sketch.add(token, countPostings(value))
+    return sketch
+
+def suggestStopwords(rwDB, stopwords, n=100, k=1000, minPostings=0):
+    """
+    Get up to n (token, estimated number of postings) tuples of the heaviest
+    document index tokens that are not in the given stopword set
+    """
+    sketch = tokenHeavyHitters(rwDB, 3, k=max(k, n), levels={b"title", b"content"})
+    return [(token, count) for token, count in sketch.mostCommon()
+            if token.decode("utf-8") not in stopwords and count >= minPostings][:n]
+
+#Index levels whose keys are never moved to the high-frequency table: NER (using the entity index
+# or the AliasAutomaton, which is built from it) needs all hits of the entity aliases,
+# e.g. all multi-token names starting with "protein"
+uncappedLevels = frozenset([b"aliases", b"cialiases"])
+
+def isCappable(key):
+    "Check if an index key may be moved to the high-frequency table (see uncappedLevels)"
+    return key.partition(b"\x1E")[0] not in uncappedLevels
+
+def capPostings(rwDB, tableNo, heavyTableNo, maxPostings, statistics=None):
+    """
+    Move all keys of an index table with more than maxPostings postings to the
+    high-frequency table. Moved keys are recorded, so new postings of them are
+    written to the high-frequency table (see NLTKIndexer.writePostings()).
+    Postings that have been added to the index table for moved keys anyway
+    (e.g. by processes that did not know the key has been moved yet)
+    are merged into the high-frequency table, regardless of their number.
+    Keys of uncappedLevels are not moved. Such keys moved by earlier versions are moved back.
+    Returns the number of moved keys.
+    """
+    heavyKeys = rwDB.findHeavyKeys(heavyTableNo, maxAge=0)
+    if not heavyKeys and rwDB.conn.scan(heavyTableNo, limit=1):
+        #High-frequency table written before moved keys were recorded
+        heavyKeys = frozenset(key for key, _ in rwDB.iterateTable(heavyTableNo, chunkSize=100))
+        rwDB.writeHeavyKeys(heavyTableNo, heavyKeys)
+    restoredKeys = sorted(key for key in heavyKeys if not isCappable(key))
+    if restoredKeys:
+        _restoreKeys(rwDB, tableNo, heavyTableNo, restoredKeys)
+        if statistics is not None:
+            statistics.count("restored keys", len(restoredKeys))
+    moved = {}
+    numMoved = 0
+    for key, value in rwDB.iterateTable(tableNo):
+        if not isCappable(key):
+            continue
+        if key in heavyKeys or countPostings(value) > maxPostings:
+            moved[key] = value
+            if len(moved) >= 1000:
+                numMoved += _moveHeavyKeys(rwDB, tableNo, heavyTableNo, moved)
+                moved = {}
+    numMoved += _moveHeavyKeys(rwDB, tableNo, heavyTableNo, moved)
+    if statistics is not None:
+        statistics.count("heavy keys", numMoved)
+    return numMoved
+
+def _moveHeavyKeys(rwDB, tableNo, heavyTableNo, entries):
+    if entries:
+        #The high-frequency table uses the NULAPPENDSET merge operator, too
+        rwDB.conn.put(heavyTableNo, entries)
+        rwDB.writeHeavyKeys(heavyTableNo, list(entries))
+        rwDB.conn.delete(tableNo, list(entries))
+        rwDB.bumpIndexGeneration()
+    return len(entries)
+
+def _restoreKeys(rwDB, tableNo, heavyTableNo, keys, chunkSize=1000):
+    "Move keys from the high-frequency table back to the index table"
+    for i in range(0, len(keys), chunkSize):
+        chunk = keys[i:i + chunkSize]
+        values = rwDB.conn.read(heavyTableNo, chunk)
+        #The index table merges the postings into the ones added since the keys have been moved
+        rwDB.conn.put(tableNo, {key: value for key, value in zip(chunk, values) if value})
+        rwDB.removeHeavyKeys(heavyTableNo, chunk)
+        rwDB.conn.delete(heavyTableNo, chunk)
+    rwDB.bumpIndexGeneration()
+
+def runStopwordsCLITool(args):
+    "Print (and optionally write) stopword suggestions using an argparse args object"
+    from Translatron import DocumentDB
+    from Translatron.Indexing.NLTKIndexer import readStopwordSet
+    rwDB = DocumentDB.YakDBDocumentDatabase(mode="REQ")
+    stopwords = readStopwordSet()
+    suggestions = suggestStopwords(rwDB, stopwords, n=args.number, minPostings=args.min_postings)
+    print(black("Stopword suggestions (token: estimated number of postings)", bold=True))
+    for token, count in suggestions:
+        print("%s: %d" % (token.decode("utf-8"), count))
+    if args.write and suggestions:
+        with open("stopwords.txt", "a") as outfile:
+            for token, _ in suggestions:
+                outfile.write("\n" + token.decode("utf-8"))
+        print("Added %d stopwords to stopwords.txt. Re-index (index --full) to apply them" % len(suggestions))
@@ -3,11 +3,16 @@ __author__ = 'uli'
 
 import Translatron.DocumentDB
 import itertools
-from ansicolor import black
-from multiprocessing import Pool
-from nltk.tokenize import word_tokenize
-from collections import Counter
+import os
+import time
+from queue import Empty
+from ansicolor import black, red
+from multiprocessing import Process, Queue
+from collections import defaultdict
 from Translatron import DocumentDB
+from Translatron.Indexing import HeavyHitters
+from Translatron.Indexing.Tokenizer import getTokenizer, defaultTokenizer
+from Translatron.Statistics import IngestStatistics, StatisticsReporter, timedIterate
 
 def readStopwordSet():
     "PyPy-compatible reader tha"
@@ -23,95 +28,530 @@ def filterToken(token):
     if token in __stopwords: return False
     return True
 
-def processParagraph(paragraph):
-    tokens = word_tokenize(paragraph.decode("utf-8"))
+def resolveIndexTokenizer(rwDB, tokenizer=None):
+    """
+    Get the tokenizer to add documents to the document index with: The one
+    the index has been built with (see DocumentDB.findIndexTokenizer()).
+    For an empty index, tokenizer (or the default tokenizer) is recorded.
+    Raises ValueError if tokenizer differs from the one of the index,
+    as queries only match the postings of a single tokenizer.
+    """
+    indexTokenizer = rwDB.findIndexTokenizer()
+    if indexTokenizer is None:
+        indexTokenizer = tokenizer or defaultTokenizer
+        rwDB.writeIndexTokenizer(indexTokenizer)
+    elif tokenizer is not None and tokenizer != indexTokenizer:
+        raise ValueError("The document index has been built with the '%s' tokenizer, not '%s'. "
+                         "Rebuild it using 'index --full' or 'index --bulk' to change the tokenizer"
+                         % (indexTokenizer, tokenizer))
+    return indexTokenizer
+
+def processParagraphs(paragraphs, tokenizer=None):
+    """
+    Tokenize a batch of paragraphs (str or bytes) using the given tokenizer
+    (see Tokenizer.tokenizers). Returns a list of filtered token lists.
+    """
+    paragraphs = [paragraph.decode("utf-8") if isinstance(paragraph, bytes) else paragraph
+                  for paragraph in paragraphs]
     #CI + remove stopwords
-    tokens = map(str.lower, tokens)
-    tokens = filter(filterToken, tokens)
-    return tokens
+    return [[token for token in map(str.lower, tokens) if filterToken(token)]
+            for tokens in getTokenizer(tokenizer)(paragraphs)]
+
+def processParagraph(paragraph, tokenizer=None):
+    return processParagraphs([paragraph], tokenizer)[0]
+
+def generateLocationId(docId, part=b""):
+    "Generate the index entity ID from the document ID and the entity part"
+    if type(part) == str: part = part.encode("utf-8")
+    return docId + b"\x1E" + part
+
+def tokenizeDocument(docId, title, paragraphs, tokenizer=None):
+    """
+    Token-split the paragraphs and the title of a document.
+    Yields (tokens, location ID, level) tuples suitable for indexDocumentTokens().
+
+    Works on both freshly parsed (str) and stored (bytes) documents.
+    The title and all paragraphs are tokenized as one batch.
+    """
+    titleTokens, *tokensNestedList = processParagraphs([title] + list(paragraphs), tokenizer)
+    # Index paragraphs
+    for i, tokens in enumerate(tokensNestedList):
+        # i <-> we are looking at tokens for the i'th paragraph
+        yield (tokens, generateLocationId(docId, b"paragraph" + str(i).encode("ascii")), "content")
+    # Index title
+    yield (titleTokens, docId, "title")
+
+def splitKeyRange(sampleKeys, numRanges, numDigits=6):
+    """
+    Split the document keyspace into up to numRanges (startKey, endKey) ranges.
+
+    Keys are interpreted as numbers whose digits are the characters occurring
+    in the sample keys (e.g. 0-9 for "pmc:1234"), so the ranges are about
+    equally large even if only few characters are used. The first range starts
+    at None and the last range ends at None, so no document is missed.
+    """
+    #Paragraph keys (docId 0x1E ...) must stay in the same range as their document
+    sampleKeys = [key.partition(b"\x1E")[0] for key in sampleKeys]
+    if not sampleKeys:
+        return [(None, None)]
+    prefix = os.path.commonprefix(sampleKeys)
+    n = len(prefix)
+    #Boundaries must not sort between a document and its paragraphs,
+    # so they only consist of characters above the separator
+    alphabet = sorted({byte for key in sampleKeys for byte in key[n:] if byte > 0x1E})
+    if not alphabet:
+        return [(None, None)]
+    base = len(alphabet)
+    def toNumber(key):
+        number = 0
+        for i in range(numDigits):
+            byte = key[n + i] if n + i < len(key) else None
+            #Index of the largest alphabet character <= byte
+            digit = sum(1 for c in alphabet if byte is not None and c <= byte) - 1
+            number = number * base + max(digit, 0)
+        return number
+    low = toNumber(min(sampleKeys))
+    high = toNumber(max(sampleKeys)) + 1
+    boundaries = []
+    for i in range(1, numRanges):
+        number = low + (high - low) * i // numRanges
+        digits = []
+        for j in range(numDigits):
+            number, digit = divmod(number, base)
+            digits.append(alphabet[digit])
+        boundary = prefix + bytes(reversed(digits))
+        if boundaries and boundary <= boundaries[-1]:
+            continue
+        boundaries.append(boundary)
+    return list(zip([None] + boundaries, boundaries + [None]))
+
+def entityPostings(entity):
+    "Get the (tokens, location ID, level) postings for the aliases of an entity"
+    postings = []
+    prefix = entity[b"id"] + b"\x1E"
+    # Index name as case-insensitive and tokensplit on whitespace.
+    name = entity[b"name"]
+    if name is not None:
+        # ALGORITHM: Index ONLY the first token but append the full name
+        # This allows efficient multi-token NER.
+        nameTokens = name.lower().split()
+        # Append the token. This is ONLY recommended for CI aliases
+        hitId = prefix + entity[b"source"] + b"\x1D" + name
+        postings.append(([nameTokens[0]], hitId, b"cialiases"))
+        # In order to be able to find the entity later, we also index the FULL
+        #  name as if it were a single token (sometimes it actually is)
+        postings.append(([name], prefix + entity[b"source"], b"aliases"))
+    # Index reference DB aliases (unsplit, case-sensitive). Includes the "main" DB ID
+    for db, aliases in entity[b"ref"].items():
+        if not aliases: # Skip empty alias list. SHOULD not occur.
+            continue
+        #Aliases must be a list, even with only one entry.
+        assert isinstance(aliases, list)
+        # Alias keys are never moved to the high-frequency table (see HeavyHitters.uncappedLevels)
+        postings.append((aliases, prefix + db, b"aliases"))
+    return postings
+
+def removeIndexedVersions(rwDB, ids, statistics, entities=False, chunkSize=4096):
+    """
+    Remove the postings and index records of the indexed versions
+    of the given documents (or entities), if any.
+
+    The shared index keys are rewritten (see DocumentDB.removePostings()), so
+    this must not run concurrently with pushing postings: Incremental indexing
+    removes all old versions in the main process before the workers start.
+    Every key is rewritten once per chunk of chunkSize IDs.
+    Returns the number of documents/entities that have been indexed before.
+    """
+    tableNo = 4 if entities else 3
+    recordPrefix = DocumentDB.entityIndexRecordPrefix if entities else DocumentDB.documentIndexRecordPrefix
+    numRemoved = 0
+    with statistics.timer("cleanup"):
+        for i in range(0, len(ids), chunkSize):
+            chunk = ids[i:i + chunkSize]
+            ownerKeys = {ownerId: record[b"keys"] for ownerId, record
+                         in zip(chunk, rwDB.findIndexRecords(recordPrefix, chunk)) if record}
+            if not ownerKeys:
+                continue
+            if not entities:
+                rwDB.invalidateCompactDocumentIndex()
+            rwDB.removePostings(tableNo, ownerKeys, heavyTableNo=tableNo + 4)
+            rwDB.clearState(recordPrefix, list(ownerKeys))
+            if not entities:
+                rwDB.removeDocumentLengths(list(ownerKeys))
+            numRemoved += len(ownerKeys)
+    if numRemoved:
+        rwDB.bumpIndexGeneration()
+    return numRemoved
+
+def writePostings(rwDB, pushDB, ownerPostings, statistics, entities=False):
+    """
+    Push the postings of a batch of documents or entities,
+    given as {ID: [(tokens, location ID, level)]}.
+
+    Records the index keys of every document/entity (and the length, i.e. the number
+    of postings, of every document) in the document state table.
+    Postings of previously indexed versions must have been removed before
+    (see removeIndexedVersions()). Postings of keys that have been moved to the
+    high-frequency table are pushed to that table (see HeavyHitters.capPostings()).
+
+    Postings are aggregated by index key, so every key of the batch is pushed once.
+    """
+    tableNo = 4 if entities else 3
+    recordPrefix = DocumentDB.entityIndexRecordPrefix if entities else DocumentDB.documentIndexRecordPrefix
+    if not entities and ownerPostings:
+        #The compact index is only written by the bulk index builder
+        rwDB.invalidateCompactDocumentIndex()
+    with statistics.timer("postings"):
+        keyLocations = defaultdict(set)
+        records, lengths = {}, {}
+        for ownerId, postings in ownerPostings.items():
+            keys, ownerPostingSet = set(), set()
+            for tokens, locationId, level in postings:
+                for token in tokens:
+                    key = DocumentDB.indexKey(level, token)
+                    keys.add(key)
+                    keyLocations[key].add(locationId)
+                    ownerPostingSet.add((key, locationId))
+            records[ownerId] = {"keys": sorted(keys)}
+            lengths[ownerId] = len(ownerPostingSet)
+        if keyLocations:
+            #The NULAPPENDSET merge operator merges the NUL-separated locations into the existing ones
+            heavyKeys = rwDB.findHeavyKeys(tableNo + 4)
+            entries, heavyEntries = {}, {}
+            for key, locations in keyLocations.items():
+                (heavyEntries if key in heavyKeys else entries)[key] = b"\x00".join(sorted(locations))
+            if entries:
+                pushDB.conn.put(tableNo, entries)
+            if heavyEntries:
+                pushDB.conn.put(tableNo + 4, heavyEntries)
+        rwDB.writeIndexRecords(recordPrefix, records)
+        if not entities:
+            rwDB.writeDocumentLengths(lengths)
+        rwDB.bumpIndexGeneration()
+
+def writeImportPostings(rwDB, pushDB, ownerPostings, statistics, entities=False):
+    """
+    Push the postings of documents (or entities) indexed while they are imported,
+    see writePostings(). Importer processes run concurrently, so they must not
+    remove postings: Previously indexed documents/entities are skipped.
+    Returns their IDs, they have to be marked dirty to be reindexed by the indexer.
+    """
+    recordPrefix = DocumentDB.entityIndexRecordPrefix if entities else DocumentDB.documentIndexRecordPrefix
+    ids = list(ownerPostings)
+    reindexIds = [ownerId for ownerId, record in zip(ids, rwDB.findIndexRecords(recordPrefix, ids)) if record]
+    skipped = set(reindexIds)
+    writePostings(rwDB, pushDB, {ownerId: postings for ownerId, postings in ownerPostings.items()
+                                 if ownerId not in skipped}, statistics, entities)
+    return reindexIds
+
+def indexDocumentBatch(rwDB, pushDB, docs, statistics, tokenizer=None):
+    """
+    Tokenize a batch of (stored) documents, push the postings
+    and remove their dirty markers
+    """
+    with statistics.timer("tokenize"):
+        docPostings = {doc[b"id"]: list(tokenizeDocument(doc[b"id"], doc[b"title"], doc[b"paragraphs"], tokenizer))
+                       for doc in docs}
+    writePostings(rwDB, pushDB, docPostings, statistics)
+    rwDB.clearState(DocumentDB.dirtyDocumentPrefix, list(docPostings))
+    statistics.count("documents", len(docs))
+
+def indexEntityBatch(rwDB, pushDB, entities, statistics):
+    """
+    Push the alias postings of a batch of (stored) entities
+    and remove their dirty markers
+    """
+    entityPostingsMap = {entity[b"id"]: entityPostings(entity) for entity in entities}
+    writePostings(rwDB, pushDB, entityPostingsMap, statistics, entities=True)
+    rwDB.clearState(DocumentDB.dirtyEntityPrefix, list(entityPostingsMap))
+    statistics.count("entities", len(entities))
+
+class DocumentIndexerWorker(Process):
+    """
+    Indexes ranges of the document table. Every worker has its own
+    scan (REQ) and index (PUSH) connection.
+
+    Tasks are taken from the task queue until None is received. A task is either
+    a (startKey, endKey) range or a list of document IDs.
+    Progress is reported on the result queue as (number of documents,
+    finished task or None, IngestStatistics snapshot) tuples.
+
+    Workers only push postings. Postings of previously indexed document
+    versions are removed before the workers are started.
+    """
+    def __init__(self, taskQueue, resultQueue, batchSize=64, tokenizer=None):
+        super(DocumentIndexerWorker, self).__init__()
+        self.taskQueue = taskQueue
+        self.resultQueue = resultQueue
+        self.batchSize = batchSize
+        self.tokenizer = tokenizer
+    def iterateTask(self, rwDB, task):
+        "Iterate the documents of a task"
+        if isinstance(task, list):
+            for docId, doc in zip(task, rwDB.findDocuments(task)):
+                if doc is None: #Deleted in the meantime
+                    rwDB.clearState(DocumentDB.dirtyDocumentPrefix, [docId])
+                    continue
+                yield doc
+        else:
+            startKey, endKey = task
+            for key, doc in rwDB.iterateDocuments(startKey=startKey, endKey=endKey):
+                yield doc
+    def run(self):
+        import zmq
+        context = zmq.Context()
+        rwDB = DocumentDB.YakDBDocumentDatabase(mode="REQ", context=context)
+        pushDB = DocumentDB.YakDBDocumentDatabase(mode="PUSH", context=context)
+        statistics = IngestStatistics()
+        while True:
+            task = self.taskQueue.get()
+            if task is None: #Termination signal
+                break
+            docs = []
+            for doc in timedIterate(self.iterateTask(rwDB, task), statistics, "read"):
+                docs.append(doc)
+                if len(docs) >= self.batchSize:
+                    self.indexBatch(rwDB, pushDB, docs, statistics)
+                    self.resultQueue.put((len(docs), None, statistics.takeSnapshot()))
+                    docs = []
+            self.indexBatch(rwDB, pushDB, docs, statistics)
+            self.resultQueue.put((len(docs), task, statistics.takeSnapshot()))
+        self.finish(statistics)
+        self.resultQueue.put((0, None, statistics.takeSnapshot()))
+        #Closes all sockets, waiting until pushed postings have been sent
+        context.destroy()
+    def indexBatch(self, rwDB, pushDB, docs, statistics):
+        "Index a batch of documents"
+        indexDocumentBatch(rwDB, pushDB, docs, statistics, self.tokenizer)
+    def finish(self, statistics):
+        "Called once after the last task has been processed"
+        pass
+
+class EntityIndexerWorker(DocumentIndexerWorker):
+    """
+    Indexes ranges of the entity table, see DocumentIndexerWorker.
+    A task is either a (startKey, endKey) range or a list of entity IDs.
+    """
+    def iterateTask(self, rwDB, task):
+        "Iterate the entities of a task"
+        if isinstance(task, list):
+            for entityId, entity in zip(task, rwDB.entityIdx.findEntities(task)):
+                if entity is None: #Deleted in the meantime
+                    rwDB.clearState(DocumentDB.dirtyEntityPrefix, [entityId])
+                    continue
+                yield entity
+        else:
+            startKey, endKey = task
+            for key, entity in rwDB.iterateEntities(startKey=startKey, endKey=endKey):
+                yield entity
+    def indexBatch(self, rwDB, pushDB, entities, statistics):
+        "Index a batch of entities"
+        indexEntityBatch(rwDB, pushDB, entities, statistics)
+
+class EntityImportIndexer(object):
+    """
+    Write function for entity write batches that indexes
+    the entities while they are imported, see YakDBDocumentDatabase.newEntityWriteBatch()
+    The number of entities indexed right away is counted as "indexedEntities".
+    """
+    def __init__(self, pushDB, statistics=None):
+        self.pushDB = pushDB
+        #Index records are read and written using a separate REQ connection
+        self.rwDB = DocumentDB.YakDBDocumentDatabase(mode="REQ")
+        self.statistics = statistics if statistics is not None else IngestStatistics()
+    def writeSerializedEntities(self, serializedEntities):
+        """
+        Index and write the new or changed ones of the entities
+        serialized using DocumentDB.serializeEntity()
+        """
+        entries = {}
+        for serialized in serializedEntities:
+            entries.update(serialized)
+        entries, hashes = self.rwDB.filterChangedEntities(entries)
+        #Postings are pushed first so they are never missing for written entities
+        entityPostingsMap = {entityId: entityPostings(DocumentDB.unpackValue(value))
+                             for entityId, value in entries.items()}
+        reindexIds = writeImportPostings(self.rwDB, self.pushDB, entityPostingsMap, self.statistics, entities=True)
+        #The importer counts the imported "entities" in the same statistics
+        self.statistics.count("indexedEntities", len(entries) - len(reindexIds))
+        #New entities are indexed already, changed ones are marked as dirty
+        self.pushDB.writeEntityEntries(entries, hashes, reindexIds)
 
 class TranslatronDocumentIndexer(object):
     """
     Wrapper class that tokenizes and indexes documents
     """
-    def __init__(self, rwDB, pushDB, processes=4):
+    def __init__(self, rwDB, pushDB, processes=4, reporter=None, rangesPerProcess=16, tokenizer=None):
         """
         Keywords arguments:
             rwDB: A connection that can be used for both read and write operations (i.e. mode == "REQ")
             pushDB: A connection that is used for high-volume low-latency indexing.
                     Does not require support for write operations. May be the same as rwDB
+            processes: The number of document indexer processes
+            reporter: An optional StatisticsReporter for periodic per-stage statistics
+            rangesPerProcess: Number of document key ranges per process. More, smaller
+                              ranges balance the load better.
+            tokenizer: The name of the tokenizer to use (see Tokenizer.tokenizers), None for the default
         """
         self.rwDB = rwDB
         self.pushDB = pushDB
         # Statistics are taken over several index... calls
         self.docCtr = 0
         self.entityCtr = 0
-        self.pool = Pool(processes)
+        self.statistics = IngestStatistics()
+        self.reporter = reporter
+        self.processes = processes
+        self.rangesPerProcess = rangesPerProcess
+        self.tokenizer = tokenizer
 
     def generateId(self, doc, part=b""):
         "Generate the index entity ID from the document and the entity part"
-        if type(part) == str: part = part.encode("utf-8")
-        return doc[b"id"] + b"\x1E" + part
+        return generateLocationId(doc[b"id"], part)
 
     def indexDocument(self, doc):
-        "Token-split a document and write the result to the index"
-        # Index paragraphs
-        tokensNestedList = self.pool.map(processParagraph, doc[b"paragraphs"])
-        for i, tokens in enumerate(tokensNestedList):
-            # i <-> we are looking at tokens for the i'th paragraph
-            locationId = self.generateId(doc, b"paragraph" + str(i).encode("ascii"))
-            self.pushDB.indexDocumentTokens(tokens, locationId, level="content")
-        # Index title
-        titleTokens = processParagraph(doc[b"title"])
-        locationId = self.generateId(doc, b"title")
-        self.pushDB.indexDocumentTokens(titleTokens, doc[b"id"], level="title")
+        "Token-split a document and write the result to the index, replacing its previous version"
+        removeIndexedVersions(self.rwDB, [doc[b"id"]], self.statistics)
+        indexDocumentBatch(self.rwDB, self.pushDB, [doc], self.statistics, self.tokenizer)
 
     def indexEntity(self, entity):
         "Index aliases for a document. Sets the document part to the DB source of the alias"
-        prefix = entity[b"id"] + b"\x1E"
-        # Index name as case-insensitive and tokensplit on whitespace.
-        name = entity[b"name"]
-        if name is not None:
-            # ALGORITHM: Index ONLY the first token but append the full name
-            # This allows efficient multi-token NER.
-            nameTokens = name.lower().split()
-            # Append the token. This is ONLY recommended for CI aliases
-            hitId = prefix + entity[b"source"] + b"\x1D" + name
-            self.pushDB.indexEntityTokens([nameTokens[0]], hitId, level=b"cialiases")
-            # In order to be able to find the entity later, we also index the FULL
-            #  name as if it were a single token (sometimes it actually is)
-            self.pushDB.indexEntityTokens([name], prefix + entity[b"source"], level=b"aliases")
-        # Index reference DB aliases (unsplit, case-sensitive). Includes the "main" DB ID
-        for db, aliases in entity[b"ref"].items():
-            if not aliases: # Skip empty alias list. SHOULD not occur.
+        self.indexEntityBatch([entity])
+
+    def indexEntityBatch(self, entities, replace=True):
+        """
+        Index the aliases of a batch of entities and remove their dirty markers.
+        If replace is True, the aliases of their previous versions are removed first
+        """
+        if replace:
+            removeIndexedVersions(self.rwDB, [entity[b"id"] for entity in entities], self.statistics, entities=True)
+        indexEntityBatch(self.rwDB, self.pushDB, entities, self.statistics)
+
+    def indexAllDocuments(self, full=False, bulk=False, tmpdir=None, maxPostings=None,
+                          progressInterval=10.0, batchSize=64):
+        """
+        Index new and changed documents (i.e. those marked as dirty by the importer),
+        removing the postings of their previous versions.
+        If full is True, the document index is rebuilt from scratch.
+        If bulk is True, the document index is rebuilt from scratch using
+        sorted runs in tmpdir (see BulkIndexBuilder). Keys with more than
+        maxPostings postings are written to the high-frequency table then.
+
+        The work is split into tasks (key ranges for full rebuilds, batches of
+        document IDs else) which are indexed by separate worker processes.
+        """
+        if full or bulk: #Keep the tokenizer of the current index unless another one is given
+            self.tokenizer = self.tokenizer or self.rwDB.findIndexTokenizer() or defaultTokenizer
+        else:
+            self.tokenizer = resolveIndexTokenizer(self.rwDB, self.tokenizer)
+        if bulk:
+            from Translatron.Indexing.BulkIndexBuilder import bulkBuildDocumentIndex
+            return bulkBuildDocumentIndex(self, tmpdir, maxPostings=maxPostings,
+                                          progressInterval=progressInterval, batchSize=batchSize)
+        if full:
+            self.rwDB.clearDocumentIndex()
+            self.rwDB.writeIndexTokenizer(self.tokenizer)
+            sampleKeys = self.rwDB.sampleDocumentKeys()
+            tasks = splitKeyRange(sampleKeys, self.processes * self.rangesPerProcess) if sampleKeys else []
+        else:
+            dirtyIds = list(self.rwDB.iterateStateKeys(DocumentDB.dirtyDocumentPrefix))
+            tasks = [dirtyIds[i:i + batchSize] for i in range(0, len(dirtyIds), batchSize)]
+            #Before any worker pushes postings, see removeIndexedVersions()
+            numRemoved = removeIndexedVersions(self.rwDB, dirtyIds, self.statistics)
+            if numRemoved:
+                print("Removed the postings of %d previously indexed documents" % numRemoved)
+        if not tasks:
+            print("No new or changed documents to index (use --full to rebuild the index)")
+            return
+        taskQueue, resultQueue = Queue(), Queue()
+        workers = [DocumentIndexerWorker(taskQueue, resultQueue, batchSize=batchSize,
+                                         tokenizer=self.tokenizer)
+                   for i in range(self.processes)]
+        self.runIndexerWorkers(tasks, workers, taskQueue, resultQueue, progressInterval)
+
+    def runIndexerWorkers(self, tasks, workers, taskQueue, resultQueue, progressInterval=10.0, entities=False):
+        """
+        Run DocumentIndexerWorker (or, if entities is True, EntityIndexerWorker) processes
+        on the given tasks. Collects their progress and statistics until all workers have finished.
+        Returns True if all tasks have been done.
+        """
+        for task in tasks:
+            taskQueue.put(task)
+        for i in range(len(workers)):
+            taskQueue.put(None)
+        for worker in workers:
+            worker.start()
+        # Collect progress until all workers have exited
+        startTime = lastProgress = time.time()
+        tasksDone = 0
+        while True:
+            try:
+                numRecords, finishedTask, snapshot = resultQueue.get(timeout=1.0)
+            except Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
                 continue
-            #Aliases must be a list, even with only one entry.
-            assert isinstance(aliases, list)
-            # DO NOT index GO IDs: Large hitsets would currently overload YakDB
-            self.pushDB.indexEntityTokens(aliases, prefix + db, level=b"aliases")
-
-    def indexAllDocuments(self):
-        for key, doc in self.rwDB.iterateDocuments():
-            self.indexDocument(doc)
-            # Stats
-            self.docCtr += 1
-            if self.docCtr % 100 == 0:
-                print ("Indexed %d documents" % self.docCtr)
-
-    def indexAllEntities(self):
-        for key, doc in self.rwDB.iterateEntities():
-            self.indexEntity(doc)
-            #Stats
-            self.entityCtr += 1
-            if self.entityCtr % 1000 == 0:
-                print ("Indexed %d entities" % self.entityCtr)
-
-    def computeTokenFrequency(self, iterateFunction):
-        "Compute token frequency in the index (returns a Counter object)"
-        ctr = Counter()
-        for level, token, entities in iterateFunction():
-            ctr[token] += len(entities)
-        return ctr
+            if entities:
+                self.entityCtr += numRecords
+            else:
+                self.docCtr += numRecords
+            self.statistics.merge(snapshot)
+            if finishedTask is not None:
+                tasksDone += 1
+            if self.reporter is not None:
+                self.reporter.report(self.statistics)
+            if time.time() - lastProgress >= progressInterval:
+                lastProgress = time.time()
+                self.printProgress(startTime, tasksDone, len(tasks), entities)
+        for worker in workers:
+            worker.join()
+        if tasksDone < len(tasks):
+            print(red("Indexer processes died, %d of %d tasks have not been indexed"
+                      % (len(tasks) - tasksDone, len(tasks)), bold=True))
+        print("Indexed %d %s in %.1f seconds" % (self.entityCtr if entities else self.docCtr,
+              "entities" if entities else "documents", time.time() - startTime))
+        return tasksDone == len(tasks)
+
+    def printProgress(self, startTime, tasksDone, numTasks, entities=False):
+        "Print document (or entity) indexing progress with a task based ETA"
+        deltaT = time.time() - startTime
+        progress = tasksDone / numTasks
+        eta = "%.0f s" % (deltaT * (1. - progress) / progress) if progress > 0 else "unknown"
+        count = self.entityCtr if entities else self.docCtr
+        print("Indexed %d %s (%.1f/s), %d of %d tasks done, ETA %s"
+              % (count, "entities" if entities else "documents", count / max(deltaT, 1e-9),
+                 tasksDone, numTasks, eta))
+
+    def indexAllEntities(self, full=False, progressInterval=10.0, batchSize=256):
+        """
+        Index new and changed entities (i.e. those marked as dirty by the importer),
+        removing the aliases of their previous versions.
+        If full is True, the entity index is rebuilt from scratch.
+
+        Like documents, entities are indexed by separate worker processes
+        (see indexAllDocuments()).
+        """
+        if full:
+            self.rwDB.clearEntityIndex()
+            sampleKeys = self.rwDB.sampleEntityKeys()
+            tasks = splitKeyRange(sampleKeys, self.processes * self.rangesPerProcess) if sampleKeys else []
+        else:
+            dirtyIds = list(self.rwDB.iterateStateKeys(DocumentDB.dirtyEntityPrefix))
+            tasks = [dirtyIds[i:i + batchSize] for i in range(0, len(dirtyIds), batchSize)]
+            #Before any worker pushes postings, see removeIndexedVersions()
+            numRemoved = removeIndexedVersions(self.rwDB, dirtyIds, self.statistics, entities=True)
+            if numRemoved:
+                print("Removed the aliases of %d previously indexed entities" % numRemoved)
+        if not tasks:
+            print("No new or changed entities to index (use --full to rebuild the index)")
+            return
+        taskQueue, resultQueue = Queue(), Queue()
+        workers = [EntityIndexerWorker(taskQueue, resultQueue, batchSize=batchSize)
+                   for i in range(self.processes)]
+        self.runIndexerWorkers(tasks, workers, taskQueue, resultQueue, progressInterval, entities=True)
+
+    def computeTokenFrequency(self, tableNo, k=1000):
+        "Compute the frequency of the heaviest tokens in an index table (returns a MisraGries sketch)"
+        return HeavyHitters.tokenHeavyHitters(self.rwDB, tableNo, k)
 
     def _printFrequencyMap(self, ctr):
         "Utility to print a counter to stdout"
@@ -121,10 +561,17 @@ class TranslatronDocumentIndexer(object):
     def printTokenFrequency(self):
         "Print the result generated by computeTokenFrequency in a human-readable manner"
         print(black("Statistics for document index", bold=True))
-        self._printFrequencyMap(self.computeTokenFrequency(self.rwDB.iterateDocumentIndex))
+        self._printFrequencyMap(self.computeTokenFrequency(3))
 
         print(black("\nStatistics for entity index", bold=True))
-        self._printFrequencyMap(self.computeTokenFrequency(self.rwDB.iterateEntityIndex)) 
+        self._printFrequencyMap(self.computeTokenFrequency(4))
+
+    def capPostings(self, maxPostings, entities=False):
+        "Move index keys with more than maxPostings postings to the high-frequency table"
+        tableNo = 4 if entities else 3
+        numMoved = HeavyHitters.capPostings(self.rwDB, tableNo, tableNo + 4, maxPostings, self.statistics)
+        print("Moved %d %s index keys with more than %d postings to the high-frequency table"
+              % (numMoved, "entity" if entities else "document", maxPostings))
 
 
 def runIndexerCLITool(args):
@@ -141,15 +588,28 @@ def runIndexerCLITool(args):
     rwDB = DocumentDB.YakDBDocumentDatabase(mode="REQ", context=context)
     pushDB = DocumentDB.YakDBDocumentDatabase(mode="PUSH", context=context)
     #Initialize indexer
-    indexer = TranslatronDocumentIndexer(rwDB, pushDB)
+    reporter = StatisticsReporter("index", args.stats_json)
+    indexer = TranslatronDocumentIndexer(rwDB, pushDB, processes=args.workers, reporter=reporter,
+                                         tokenizer=args.tokenizer)
     #Iterate over documents
     didAnything = False
     if not args.no_documents:
         didAnything = True
-        indexer.indexAllDocuments()
+        try:
+            indexer.indexAllDocuments(full=args.full, bulk=args.bulk, tmpdir=args.tmpdir,
+                                      maxPostings=args.max_postings)
+        except ValueError as ex: #Tokenizer mismatch
+            print(red(str(ex), bold=True))
+            return
+        if args.max_postings and not args.bulk: #Bulk builds apply the cap while merging
+            indexer.capPostings(args.max_postings)
     if not args.no_entities:
         didAnything = True
-        indexer.indexAllEntities()
+        indexer.indexAllEntities(full=args.full)
+        if args.max_postings:
+            indexer.capPostings(args.max_postings, entities=True)
+    if didAnything:
+        reporter.finish(indexer.statistics)
     if args.statistics:
         didAnything = True
         indexer.printTokenFrequency()
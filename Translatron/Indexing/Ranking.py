@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BM25-style ranking of document search hits.
+
+The term frequency of a token in a document is the weighted number of
+postings (title, paragraphs and metadata entries containing the token),
+where every index level has its own weight (BM25F-like).
+By default a title hit counts as much as three paragraph hits.
+
+Only numbers are ranked. The top-k hits are selected without sorting
+all hits, and only the documents on the requested page are loaded.
+Both the compact and the string index ignore the keys moved to the
+high-frequency table (see HeavyHitters), so they return the same hits.
+"""
+import heapq
+import math
+from Translatron.Indexing import CompactPostings
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+#Term frequency weight of a posting on each index level
+defaultLevelWeights = {b"title": 3.0, b"content": 1.0, b"metadata": 1.0}
+#BM25 term frequency saturation and document length normalization
+k1 = 1.2
+b = 0.75
+
+def idf(df, numDocs):
+    "BM25 inverse document frequency of a token that occurs in df of numDocs documents"
+    return math.log(1.0 + (numDocs - df + 0.5) / (df + 0.5))
+
+def bm25(tf, idfValue, lengthNorm=1.0):
+    """
+    BM25 score of a token. lengthNorm is document length / average document length.
+    Works with NumPy arrays for tf and lengthNorm as well.
+    """
+    return idfValue * tf * (k1 + 1.0) / (tf + k1 * (1.0 - b + b * lengthNorm))
+
+def topK(scores, k):
+    """
+    Get the indices of the k highest scores, highest first.
+    Uses a partial sort (argpartition / heap) instead of sorting all scores.
+    """
+    if CompactPostings.numpy is None:
+        return heapq.nlargest(k, range(len(scores)), key=scores.__getitem__)
+    numpy = CompactPostings.numpy
+    if k <= 0:
+        return []
+    if len(scores) > k:
+        #Select ties at the k-th score by index, so pages don't overlap
+        kth = -numpy.partition(-scores, k - 1)[k - 1]
+        above = numpy.flatnonzero(scores > kth)
+        indices = numpy.concatenate((above, numpy.flatnonzero(scores == kth)[:k - len(above)]))
+    else:
+        indices = numpy.arange(len(scores))
+    #Stable order for equal scores: Lower document number first
+    return indices[numpy.lexsort((indices, -scores[indices]))].tolist()
+
+def rankCompactPostings(compactIdx, tokens, levelWeights=defaultLevelWeights, offset=0, limit=20):
+    """
+    Ranked multi-token prefix search on a CompactDocumentIndex.
+    Tokens with no hits at all are ignored.
+
+    Returns (total number of hits, [(document ID, hit location part, score)]) of the requested page.
+    """
+    numpy = CompactPostings.numpy
+    tokenHits = [compactIdx.findTokenFrequencies(token, levelWeights) for token in tokens]
+    if numpy is None:
+        tokenHits = [frequencies for frequencies in tokenHits if frequencies]
+        if not tokenHits:
+            return 0, []
+        docs = CompactPostings.intersectDocuments([set(frequencies) for frequencies in tokenHits])
+        tokenDocs = [frequencies for frequencies in tokenHits]
+    else:
+        tokenHits = [hits for hits in tokenHits if len(hits[0])]
+        if not tokenHits:
+            return 0, []
+        docs = CompactPostings.intersectDocuments([hits[0] for hits in tokenHits])
+        tokenDocs = [hits[0] for hits in tokenHits]
+    docLengths = compactIdx.findDocLengths()
+    if docLengths is not None and len(docLengths):
+        numDocs = len(docLengths)
+        totalLength = sum(docLengths) if numpy is None else int(docLengths.sum(dtype=numpy.uint64))
+        averageLength = max(totalLength / float(numDocs), 1.0)
+        lengthNorms = [docLengths[int(doc)] / averageLength for doc in docs] if numpy is None \
+                      else docLengths[docs] / averageLength
+    else: #Compact index built without document lengths
+        numDocs = max(len(docs) for docs in tokenDocs) + 1
+        lengthNorms = [1.0] * len(docs) if numpy is None else 1.0
+    if numpy is None:
+        scores = [0.0] * len(docs)
+        for frequencies in tokenHits:
+            idfValue = idf(len(frequencies), numDocs)
+            for i, doc in enumerate(docs):
+                scores[i] += bm25(frequencies[doc][0], idfValue, lengthNorms[i])
+    else:
+        scores = numpy.zeros(len(docs))
+        for hitDocs, frequencies, _ in tokenHits:
+            indices = numpy.searchsorted(hitDocs, docs)
+            scores += bm25(frequencies[indices], idf(len(hitDocs), numDocs), lengthNorms)
+    page = topK(scores, offset + limit)[offset:]
+    pageDocs = [docs[i] for i in page]
+    #Hit location: The first part of the document hit by the first token
+    if numpy is None:
+        parts = [tokenHits[0][doc][1] for doc in pageDocs]
+    else:
+        firstDocs, _, firstParts = tokenHits[0]
+        parts = firstParts[numpy.searchsorted(firstDocs, pageDocs)].tolist() if pageDocs else []
+    return len(docs), [(docId, CompactPostings.locationPart(part), float(scores[i]))
+                       for i, part, docId in zip(page, parts, compactIdx.findDocIds(pageDocs)) if docId]
+
+def rankStringPostings(rwDB, tokens, levelWeights=defaultLevelWeights, offset=0, limit=20, tableNo=3):
+    """
+    Ranked multi-token prefix search on the (string) document index, used if the
+    compact document index is not current. Tokens with no hits at all are ignored.
+    Like on the compact index, keys moved to the high-frequency table (see HeavyHitters)
+    are ignored like stopwords.
+
+    The number of documents and the document lengths are read from the document state table
+    (see DocumentDB.findDocumentStatistics()). Indexes built without document lengths
+    are ranked without length normalization, estimating the number of documents
+    by the largest document frequency.
+
+    Returns (total number of hits, [(document ID, hit location part, score)]) of the requested page.
+    """
+    tokenFrequencies = []
+    for token in tokens:
+        if isinstance(token, str): token = token.encode("utf-8")
+        #Document ID -> [weighted term frequency, first hit location part]
+        frequencies = {}
+        for level, weight in levelWeights.items():
+            prefix = level + b"\x1E" + token
+            #0xFF never occurs in UTF-8, so it ends the prefix range
+            for _, value in rwDB.iterateTable(tableNo, prefix, prefix + b"\xFF"):
+                for location in value.split(b"\x00"):
+                    if not location: continue
+                    docId, _, part = location.partition(b"\x1E")
+                    entry = frequencies.get(docId)
+                    if entry is None:
+                        frequencies[docId] = [weight, part]
+                    else:
+                        entry[0] += weight
+        if frequencies:
+            tokenFrequencies.append(frequencies)
+    if not tokenFrequencies:
+        return 0, []
+    numDocs, averageLength = rwDB.findDocumentStatistics()
+    maxFrequency = max(len(frequencies) for frequencies in tokenFrequencies)
+    #Documents indexed by older versions are not counted (see findDocumentStatistics())
+    numDocs = max(numDocs, maxFrequency) if numDocs is not None else maxFrequency + 1
+    docIds = sorted(set.intersection(*[set(frequencies) for frequencies in tokenFrequencies]))
+    if averageLength is not None:
+        #Documents without a recorded length are ranked like an average document
+        lengthNorms = {docId: (length or averageLength) / averageLength
+                       for docId, length in zip(docIds, rwDB.findDocumentLengths(docIds) if docIds else [])}
+    else:
+        lengthNorms = dict.fromkeys(docIds, 1.0)
+    scores = {docId: 0.0 for docId in docIds}
+    for frequencies in tokenFrequencies:
+        idfValue = idf(len(frequencies), numDocs)
+        for docId in docIds:
+            scores[docId] += bm25(frequencies[docId][0], idfValue, lengthNorms[docId])
+    page = heapq.nsmallest(offset + limit, docIds, key=lambda docId: (-scores[docId], docId))[offset:]
+    #Hit location: The first part of the document hit by the first token
+    return len(docIds), [(docId, tokenFrequencies[0][docId][1], scores[docId]) for docId in page]
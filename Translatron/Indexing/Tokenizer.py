@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Word tokenizers for indexing and search.
+
+    - "nltk": nltk.word_tokenize (punkt sentence splitting + Treebank rules)
+    - "regex": Fast path using a few precompiled regular expressions.
+      Emulates the Treebank rules for the tokens that can pass
+      NLTKIndexer.filterToken(), i.e. alphanumeric tokens.
+      Non-alphanumeric tokens (punctuation, "3.88", "non-coding") are not returned.
+      Sentence ends are approximated (period followed by an uppercase letter)
+      instead of using punkt, so no model needs to be loaded.
+
+Both tokenizers process a batch of texts and return a list of token lists.
+
+Run this module to check parity with NLTK and to benchmark both tokenizers:
+    python3 -m Translatron.Indexing.Tokenizer articles.A-B.tar.gz
+"""
+import re
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+#Separates texts in a batch
+_batchSeparator = "\x1D"
+#Abbreviations of the punkt english model (without internal periods).
+# Punkt does not end a sentence after these, so e.g. "Dr." stays one (filtered) token
+_abbreviations = (
+    "ala ariz aug ave bros calif chg cie co col colo conn corp cos ct dec dr feb fla fri ft ga gen "
+    "ill inc jan jr kan ky lt ltd maj messrs mg mich minn mr mrs ms nev nov oct ok okla ore pa "
+    "prof rep reps sen sep sept sr st sw tenn tues va vs vt wash wed wis yr "
+    "c d e f g h k l m n p r s t v w").split()
+#Frequent sentence starters of the punkt english model. A sentence ends after an
+# abbreviation (but not an initial) if the next word is one of them and capitalized ("10 mg. The")
+_sentenceStarters = (
+    "according although among both but despite even he however i if in indeed instead it many "
+    "meanwhile moreover most nevertheless nonetheless nor sales separately similarly since so some "
+    "the there these they this though thus under when while yet").split()
+#Sentence-final periods: Followed by the end of the text or by whitespace
+# and an uppercase letter or digit (optionally after opening quotes/brackets).
+# Like punkt, this also splits "Fig." in "Fig. 2", but not "Dr." in "Dr. Smith"
+_notAfterAbbreviation = "".join(
+    "(?<!\\b(?i:%s)\\.)" % "|".join(abbr for abbr in _abbreviations if len(abbr) == length)
+    for length in sorted(set(map(len, _abbreviations)))) # Lookbehinds must have a fixed width
+_closingChars = "[\\]\\)}>\"'»”’]*"
+_openingChars = "[\"'“‘(\\[]*"
+_sentenceEndRegex = re.compile(
+    "(?<=[^.\\s])\\.(?=%s\\s*(?:\x1D|$))" % _closingChars +
+    "|(?<=[^.\\s])\\.%s(?=%s\\s+%s[A-Z0-9])" % (_notAfterAbbreviation, _closingChars, _openingChars) +
+    "|(?<=[^.\\s])(?<!\\b\\w)\\.(?=%s\\s+%s(?=[A-Z])(?i:%s)\\b)" % (_closingChars, _openingChars, "|".join(_sentenceStarters)))
+#Characters the Treebank tokenizer always splits on plus ":" and "," if not followed by a digit
+_separatorRegex = re.compile(
+    "[;@#$%&?!*\\[\\](){}<>\"«“‘„»”’`\u2012-\u2015]|[:,](?!\\d)|\\.{2,}|--")
+#Leading single quotes are split off unless they start a clitic ('s, 're, ...)
+_leadingCliticRegex = re.compile(r"'(?:re|ve|ll|m|t|s|d|n)$")
+#Trailing clitics and single quotes are split off ("cell's" -> "cell" "'s")
+_trailingCliticRegex = re.compile(r"(?<=[^'])(?:'s|'m|'d|'ll|'re|'ve|n't|')$")
+#Words the Treebank tokenizer splits into two tokens
+_contractions = {
+    "cannot": ("can", "not"),
+    "gimme": ("gim", "me"),
+    "gonna": ("gon", "na"),
+    "gotta": ("got", "ta"),
+    "lemme": ("lem", "me"),
+    "wanna": ("wan", "na"),
+}
+
+def _chunkTokens(chunk):
+    "Get the alphanumeric tokens of a lowercase, whitespace-free chunk"
+    if chunk.isalnum():
+        return _contractions.get(chunk, (chunk,))
+    if chunk[0] == "'" and not _leadingCliticRegex.match(chunk):
+        chunk = chunk[1:]
+    chunk = _trailingCliticRegex.sub("", chunk)
+    return (chunk,) if chunk.isalnum() else ()
+
+def regexTokenizeBatch(texts):
+    "Tokenize a batch of texts using the regex fast path. Returns a list of (lowercase) token lists"
+    text = _batchSeparator.join(texts)
+    text = _sentenceEndRegex.sub(" ", text)
+    text = _separatorRegex.sub(" ", text).lower()
+    return [[token for chunk in part.split() for token in _chunkTokens(chunk)]
+            for part in text.split(_batchSeparator)]
+
+def nltkTokenizeBatch(texts):
+    "Tokenize a batch of texts using nltk.word_tokenize. Returns a list of token lists"
+    from nltk.tokenize import word_tokenize
+    return [word_tokenize(text) for text in texts]
+
+tokenizers = {
+    "regex": regexTokenizeBatch,
+    "nltk": nltkTokenizeBatch,
+}
+
+defaultTokenizer = "nltk"
+
+def getTokenizer(name=None):
+    "Get a batch tokenizer function by name (see tokenizers)"
+    return tokenizers[name or defaultTokenizer]
+
+def tokenize(text, tokenizer=None):
+    "Tokenize a single text"
+    return getTokenizer(tokenizer)([text])[0]
+
+if __name__ == "__main__":
+    # Parity check & benchmark: regex fast path vs NLTK
+    # Usage: python3 -m Translatron.Indexing.Tokenizer articles.A-B.tar.gz
+    import argparse
+    import time
+    from collections import Counter
+    from ansicolor import black, green, red
+    from Translatron.DocumentImport.PMC import PMCTARParser, processPMCFileContent
+    from Translatron.Indexing.NLTKIndexer import filterToken
+    argParser = argparse.ArgumentParser(description="Compare the regex tokenizer to nltk.word_tokenize")
+    argParser.add_argument("infile", nargs="+", help="The PMC articles.X-Y.tar.gz or .nxml file(s) to use as corpus")
+    argParser.add_argument("-n", "--limit", type=int, default=1000, help="Maximum number of documents to use")
+    args = argParser.parse_args()
+    #Parse corpus into memory so only tokenization is measured
+    docs = []
+    for infile in args.infile:
+        if infile.endswith(".tar.gz"):
+            for filelike in PMCTARParser(numWorkers=1).iteratePMCTarGZ(infile):
+                docs.append(processPMCFileContent(filelike.read()))
+                if len(docs) >= args.limit: break
+        else:
+            with open(infile, "rb") as fin:
+                docs.append(processPMCFileContent(fin.read()))
+        if len(docs) >= args.limit: break
+    docs = [doc for doc in docs if doc is not None]
+    #Index build: One batch (title + paragraphs) per document
+    results = {}
+    for name in ["nltk", "regex"]:
+        tokenizerFN = tokenizers[name]
+        tokenizerFN(["Warm up"]) # Don't measure model loading
+        startTime = time.process_time()
+        results[name] = [[[token for token in map(str.lower, tokens) if filterToken(token)]
+                          for tokens in tokenizerFN([doc["title"]] + doc["paragraphs"])]
+                         for doc in docs]
+        deltaT = time.process_time() - startTime
+        print(black("%s: %d documents in %.2f s (%.1f docs/s per core)"
+                    % (name, len(docs), deltaT, len(docs) / max(deltaT, 1e-9)), bold=True))
+    #Query latency: Use the titles as queries
+    queries = [doc["title"] for doc in docs if doc["title"]]
+    for name in ["nltk", "regex"]:
+        startTime = time.perf_counter()
+        for query in queries:
+            tokenize(query, name)
+        deltaT = time.perf_counter() - startTime
+        print(black("%s: %.1f µs per query" % (name, deltaT * 1e6 / max(len(queries), 1)), bold=True))
+    #Parity check on the filtered tokens
+    numTexts = numIdentical = 0
+    missing, extra = Counter(), Counter()
+    for nltkDoc, regexDoc in zip(results["nltk"], results["regex"]):
+        for nltkTokens, regexTokens in zip(nltkDoc, regexDoc):
+            numTexts += 1
+            if nltkTokens == regexTokens:
+                numIdentical += 1
+            else:
+                missing.update(Counter(nltkTokens) - Counter(regexTokens))
+                extra.update(Counter(regexTokens) - Counter(nltkTokens))
+    numTokens = sum(len(tokens) for doc in results["nltk"] for tokens in doc)
+    print((green if numIdentical == numTexts else red)(
+        "%d of %d paragraphs/titles have identical tokens, %d of %d tokens differ"
+        % (numIdentical, numTexts, sum(missing.values()) + sum(extra.values()), numTokens)))
+    if missing:
+        print("Only NLTK: " + ", ".join("%s (%d)" % item for item in missing.most_common(20)))
+    if extra:
+        print("Only regex: " + ", ".join("%s (%d)" % item for item in extra.most_common(20)))
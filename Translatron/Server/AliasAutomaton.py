@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-memory alias automaton for database-free NER.
+
+The "aliases" and "cialiases" levels of the entity index are loaded once into
+    - a token -> hits map for case-sensitive single-token aliases and
+    - a token trie of the lowercased, whitespace-split entity names
+      for case-insensitive multi-token matching.
+A text is matched by a single pass over its tokens, walking the trie from
+every token, without any database calls. Hits have the same format as those
+found using the entity index (see TranslatronProtocol.findEntityNERHits()).
+
+The automaton is prebuilt into a msgpack file that is loaded by every
+server process:
+    translatron build-ner-automaton ner-automaton.msgpack
+    translatron run --ner-automaton ner-automaton.msgpack
+It is a snapshot of the entity index, so it must be rebuilt after importing
+or re-indexing entities.
+"""
+import msgpack
+import time
+from ansicolor import yellow
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+#Trie node key of the hits of the name ending at that node.
+# Never a token, because split() never yields empty tokens.
+_hitsKey = b""
+
+class AliasAutomaton(object):
+    """
+    Case-sensitive alias map and case-insensitive name trie of the entity index
+    """
+    def __init__(self, aliases=None, trie=None, generation=None):
+        """
+        Keyword arguments:
+            aliases: {alias: [(ID without DB prefix, DB)]}
+            trie: Nested {lowercase token: node} dicts. node[b""] lists the
+                  (name, source) hits of the name ending at node
+            generation: The index generation the automaton has been built from
+        """
+        self.aliases = aliases if aliases is not None else {}
+        self.trie = trie if trie is not None else {}
+        self.generation = generation
+    @staticmethod
+    def build(rwDB, tableNo=4):
+        "Build the automaton from the entity index"
+        generation = rwDB.findIndexGeneration()
+        automaton = AliasAutomaton(generation=generation)
+        for key, value in rwDB.iterateTable(tableNo, b"aliases\x1E", b"aliases\x1F"):
+            hits = []
+            for location in value.split(b"\x00"):
+                if not location: continue
+                entityId, _, db = location.partition(b"\x1E")
+                #Remove the DB prefix of the ID, like findEntityNERHits()
+                hits.append((entityId.partition(b":")[2], db))
+            if hits:
+                automaton.aliases[key[8:]] = hits
+        for key, value in rwDB.iterateTable(tableNo, b"cialiases\x1E", b"cialiases\x1F"):
+            for location in value.split(b"\x00"):
+                part = location.partition(b"\x1E")[2]
+                hitLoc, _, hitStr = part.rpartition(b"\x1D")
+                if not hitStr: continue #Ignore malformed entries
+                automaton.addName(hitStr, hitLoc)
+        return automaton
+    def addName(self, name, source):
+        "Add a (case-insensitive, whitespace-split) entity name to the trie"
+        node = self.trie
+        for token in name.lower().split():
+            node = node.setdefault(token, {})
+        node.setdefault(_hitsKey, []).append((name, source))
+    def save(self, filename):
+        with open(filename, "wb") as outfile:
+            outfile.write(msgpack.packb({b"generation": self.generation,
+                                         b"aliases": self.aliases, b"trie": self.trie}, use_bin_type=True))
+    @staticmethod
+    def load(filename):
+        with open(filename, "rb") as infile:
+            data = msgpack.unpackb(infile.read(), raw=True, use_list=False)
+        return AliasAutomaton(data[b"aliases"], data[b"trie"], data[b"generation"])
+    def findSpans(self, queryTokens, tokenFilter=None):
+        """
+        Find the alias hits in a list of (bytes) query tokens.
+        Single-token aliases are only searched for tokens passing tokenFilter.
+
+        Yields (start token index, end token index (exclusive), [(ID, DB) or (name, source)]).
+        Case-sensitive alias hits are yielded before name hits of the same tokens.
+        """
+        for idx, token in enumerate(queryTokens):
+            if tokenFilter is not None and not tokenFilter(token):
+                continue
+            hits = self.aliases.get(token)
+            if hits:
+                yield idx, idx + 1, hits
+        lowercaseTokens = [token.lower() for token in queryTokens]
+        for startIdx in range(len(lowercaseTokens)):
+            node = self.trie
+            for endIdx in range(startIdx, len(lowercaseTokens)):
+                node = node.get(lowercaseTokens[endIdx])
+                if node is None:
+                    break
+                hits = node.get(_hitsKey)
+                if hits:
+                    yield startIdx, endIdx + 1, hits
+    def findHits(self, queryTokens, tokenFilter=None):
+        """
+        Find the alias hits in a list of (bytes) query tokens.
+        Single-token aliases are only searched for tokens passing tokenFilter.
+
+        Returns {case-sensitive hit text: [(ID, DB) or (name, source)]}
+        """
+        results = {}
+        for startIdx, endIdx, hits in self.findSpans(queryTokens, tokenFilter):
+            #Reconstruct original (case-sensitive) version of the hit
+            csHit = b" ".join(queryTokens[startIdx:endIdx])
+            results.setdefault(csHit, []).extend(hits)
+        return results
+    def maxNameTokens(self):
+        "Get the number of tokens of the longest name in the trie"
+        depth, level = 0, [self.trie]
+        while level:
+            level = [child for node in level for token, child in node.items() if token != _hitsKey]
+            if level:
+                depth += 1
+        return max(depth, 1)
+
+def loadOrBuildAliasAutomaton(filename, rwDB):
+    """
+    Load an automaton file or, if it does not exist, build it from the entity index and save it.
+    Warns if the automaton is older than the current index generation.
+    """
+    try:
+        automaton = AliasAutomaton.load(filename)
+    except FileNotFoundError:
+        print(yellow("Building NER alias automaton %s" % filename))
+        startTime = time.time()
+        automaton = AliasAutomaton.build(rwDB)
+        automaton.save(filename)
+        print(yellow("Built NER alias automaton with %d aliases in %.1f seconds"
+                     % (len(automaton.aliases), time.time() - startTime)))
+        return automaton
+    if automaton.generation != rwDB.findIndexGeneration():
+        print(yellow("NER alias automaton %s is older than the database. Rebuild it using 'translatron build-ner-automaton'" % filename))
+    return automaton
+
+def runBuildAutomatonCLITool(args):
+    "Build an alias automaton file using an argparse args object"
+    from Translatron import DocumentDB
+    rwDB = DocumentDB.YakDBDocumentDatabase(mode="REQ")
+    startTime = time.time()
+    automaton = AliasAutomaton.build(rwDB)
+    automaton.save(args.outfile)
+    print("Built NER alias automaton with %d aliases in %.1f seconds"
+          % (len(automaton.aliases), time.time() - startTime))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process-wide pool of YakDB REQ connections for the server.
+
+Connections share a single ZMQ context, are opened at server startup
+(not while handling a websocket handshake) and are reused by all
+websocket connections. A connection is only used by one thread at a time,
+because REQ sockets must strictly alternate send and receive.
+Idle connections are health-checked before reuse and replaced if broken,
+as are connections whose request timed out (see connection()).
+"""
+import threading
+import time
+from contextlib import contextmanager
+from collections import deque
+import zmq
+from ansicolor import yellow, red
+from Translatron.DocumentDB import YakDBDocumentDatabase
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+class ConnectionPoolTimeout(Exception):
+    "Raised if no pooled connection became available in time"
+    pass
+
+class ConnectionPool(object):
+    """
+    Bounded pool of YakDBDocumentDatabase instances.
+
+    Connections that have been idle for more than healthCheckInterval seconds
+    are checked with a cheap request (which must be answered within
+    healthCheckTimeout seconds) before they are handed out again.
+    """
+    def __init__(self, maxSize=8, healthCheckInterval=30.0, healthCheckTimeout=2.0):
+        self.maxSize = maxSize
+        self.healthCheckInterval = healthCheckInterval
+        self.healthCheckTimeout = healthCheckTimeout
+        self.context = zmq.Context()
+        #Idle (db, time of release) tuples, most recently used last
+        self.idle = deque()
+        self.numConnections = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        #Statistics
+        self.numCreated = 0
+        self.numDiscarded = 0
+    def _connect(self):
+        db = YakDBDocumentDatabase(mode="REQ", context=self.context)
+        self.numCreated += 1
+        return db
+    def _close(self, db):
+        try:
+            db.conn.socket.close(linger=0)
+        except Exception:
+            pass
+    def prefill(self, n=None):
+        "Open up to n (default: maxSize) connections in advance"
+        n = self.maxSize if n is None else min(n, self.maxSize)
+        with self.condition:
+            while self.numConnections < n:
+                self.idle.append((self._connect(), time.time()))
+                self.numConnections += 1
+        print(yellow("Opened %d pooled YakDB connections" % self.numConnections))
+    def isHealthy(self, db):
+        "Check if a connection is answering requests"
+        socket = db.conn.socket
+        socket.setsockopt(zmq.RCVTIMEO, int(self.healthCheckTimeout * 1000))
+        try:
+            db.findIndexGeneration()
+            return True
+        except Exception as ex:
+            print(red("Discarding broken YakDB connection: %s" % ex))
+            return False
+        finally:
+            socket.setsockopt(zmq.RCVTIMEO, -1)
+    def acquire(self, timeout=None):
+        """
+        Get a connection from the pool, opening a new one if less than maxSize are open.
+        Waits up to timeout seconds (None: forever) for a connection to be released.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.condition:
+                while not self.idle and self.numConnections >= self.maxSize:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise ConnectionPoolTimeout("No YakDB connection available after %.1f seconds" % timeout)
+                    self.condition.wait(remaining)
+                if self.idle:
+                    db, releaseTime = self.idle.pop()
+                else: #Reserve the slot, connect outside of the lock
+                    db, releaseTime = None, None
+                    self.numConnections += 1
+            if db is None:
+                try:
+                    return self._connect()
+                except:
+                    self._discardSlot()
+                    raise
+            if time.time() - releaseTime < self.healthCheckInterval or self.isHealthy(db):
+                return db
+            self._close(db)
+            self._discardSlot()
+    def release(self, db, broken=False):
+        """
+        Return a connection to the pool.
+        Broken connections (e.g. after a failed request) are closed instead.
+        """
+        if broken or self.closed:
+            self._close(db)
+            self._discardSlot()
+            return
+        db.conn.socket.setsockopt(zmq.RCVTIMEO, -1)
+        with self.condition:
+            self.idle.append((db, time.time()))
+            self.condition.notify()
+    def _discardSlot(self):
+        with self.condition:
+            self.numConnections -= 1
+            self.numDiscarded += 1
+            self.condition.notify()
+    @contextmanager
+    def connection(self, timeout=None, receiveTimeout=None):
+        """
+        Context manager acquiring a connection and releasing it afterwards.
+        If receiveTimeout is given, requests raise zmq.Again if YakDB
+        does not reply within receiveTimeout seconds (the connection is discarded then).
+        """
+        db = self.acquire(timeout)
+        if receiveTimeout is not None:
+            db.conn.socket.setsockopt(zmq.RCVTIMEO, max(int(receiveTimeout * 1000), 1))
+        try:
+            yield db
+        except zmq.ZMQError:
+            #The REQ socket state is unknown, don't reuse it
+            self.release(db, broken=True)
+            raise
+        except:
+            self.release(db)
+            raise
+        else:
+            self.release(db)
+    def close(self):
+        "Close all idle connections and the ZMQ context"
+        with self.condition:
+            self.closed = True
+            while self.idle:
+                self._close(self.idle.pop()[0])
+        self.context.destroy(linger=0)
+    def stats(self):
+        "Get a dictionary of pool statistics"
+        return {"open": self.numConnections, "idle": len(self.idle), "maxSize": self.maxSize,
+                "created": self.numCreated, "discarded": self.numDiscarded}
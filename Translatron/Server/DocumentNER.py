@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chunked, parallel NER for full-length documents.
+
+The text is split at whitespace into tokens, which are annotated in chunks
+of chunkTokens tokens by a process pool. Every chunk also includes the
+following overlap tokens (the length of the longest multi-token name),
+but only keeps hits that start in the chunk itself, so every hit
+(including ones crossing a chunk boundary) is found exactly once.
+Overlapping hits are resolved by keeping the longest (leftmost) one.
+
+Hits are returned as [start, end, ID, DB] with character offsets into the
+text (in UTF-16 code units, like JavaScript string indices), so the client
+does not have to search for the hit text again.
+
+Workers match using the AliasAutomaton if one is given, else they query the
+entity index using their own database connection. The workers are forked,
+so they share the automaton of the server process (copy-on-write) instead
+of loading a copy each. Therefore the DocumentNER must be created before
+the server starts any threads.
+"""
+import gc
+import multiprocessing
+import re
+import time
+from YakDB.InvertedIndex import InvertedIndex
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+#Like the whitespace-gap RegexpTokenizer used for query NER
+_tokenRegex = re.compile(r"\S+")
+
+#Per-process matcher state: The automaton is set before the workers are forked, see initWorker()
+_automaton = None
+_db = None
+
+def filterNERToken(token):
+    """
+    Filter function to remove stuff that just clutters the display.
+    """
+    #Short numbers are NOT considered database IDs.
+    #NOTE: In reality, pretty much all numbers are Allergome database IDs, e.g. see
+    # http://www.allergome.org/script/dettaglio.php?id_molecule=14
+    if len(token) <= 5 and token.isdigit():
+        return False
+    return True
+
+def tokenSpans(text):
+    "Get the (start, end) character offsets of the whitespace-separated tokens of a text"
+    return [match.span() for match in _tokenRegex.finditer(text)]
+
+def utf16Offsets(text):
+    """
+    Get a function mapping character offsets to UTF-16 code unit offsets.
+    Only texts with characters outside the BMP need a mapping
+    """
+    if all(ord(ch) <= 0xFFFF for ch in text):
+        return lambda offset: offset
+    offsets, current = [], 0
+    for ch in text:
+        offsets.append(current)
+        current += 2 if ord(ch) > 0xFFFF else 1
+    offsets.append(current)
+    return offsets.__getitem__
+
+def findIndexSpans(db, queryTokens, tokenFilter=None):
+    """
+    Like AliasAutomaton.findSpans(), but using the entity index of a YakDBDocumentDatabase
+    """
+    searchFN = InvertedIndex.searchSingleTokenMultiExact
+    filteredTokens = [token for token in queryTokens if tokenFilter is None or tokenFilter(token)]
+    results = searchFN(db.entityIdx.index, frozenset(filteredTokens), level=b"aliases")
+    for idx, token in enumerate(queryTokens):
+        if results.get(token) and (tokenFilter is None or tokenFilter(token)):
+            #Remove the DB prefix of the ID, see findEntityNERHits()
+            yield idx, idx + 1, [(a.partition(b":")[2], b) for (a, b) in results[token]]
+    lowercaseTokens = [token.lower() for token in queryTokens]
+    ciResults = searchFN(db.entityIdx.index, frozenset(lowercaseTokens), level=b"cialiases")
+    for firstTokenHit, hits in ciResults.items():
+        startIndices = [i for i, token in enumerate(lowercaseTokens) if token == firstTokenHit]
+        for hit in hits:
+            hitLoc, _, hitStr = hit[1].rpartition(b"\x1D")
+            if not hitStr: continue #Ignore malformed entries
+            hitTokens = hitStr.lower().split()
+            for startIdx in startIndices:
+                if lowercaseTokens[startIdx:startIdx + len(hitTokens)] == hitTokens:
+                    yield startIdx, startIdx + len(hitTokens), [(hitStr, hitLoc)]
+
+def selectSpans(spans):
+    """
+    Reduce (start, end, hits) spans to non-overlapping (start, end, first hit) spans,
+    preferring longer hits. Hits of the same span found first take precedence.
+    """
+    firstHits = {}
+    for start, end, hits in spans:
+        if (start, end) not in firstHits:
+            firstHits[(start, end)] = hits[0]
+    selected, lastEnd = [], 0
+    for (start, end) in sorted(firstHits, key=lambda span: (span[0], -span[1])):
+        if start >= lastEnd:
+            selected.append((start, end, firstHits[(start, end)]))
+            lastEnd = end
+        elif end > lastEnd and selected and end - start > selected[-1][1] - selected[-1][0]:
+            #A longer hit starting inside the previous one replaces it
+            selected[-1] = (start, end, firstHits[(start, end)])
+            lastEnd = end
+    return selected
+
+def initWorker():
+    "Initialize the matcher of a NER worker process. Without an automaton, the entity index is used"
+    global _db
+    if _automaton is None:
+        from Translatron.DocumentDB import YakDBDocumentDatabase
+        _db = YakDBDocumentDatabase()
+
+def annotateChunk(task):
+    """
+    Find the hits in a (chunk start index, number of owned tokens, tokens) task.
+    Returns (start, end, hit) spans with absolute token indices
+    which start in the owned tokens.
+    """
+    chunkStart, numOwned, tokens = task
+    if _automaton is not None:
+        spans = _automaton.findSpans(tokens, filterNERToken)
+    else:
+        spans = findIndexSpans(_db, tokens, filterNERToken)
+    return [(chunkStart + start, chunkStart + end, hits) for start, end, hits in spans if start < numOwned]
+
+class DocumentNER(object):
+    """
+    Annotates long texts in overlapping chunks, in parallel if processes > 0.
+    """
+    def __init__(self, processes=0, chunkTokens=2000, automaton=None, overlap=None):
+        """
+        Keyword arguments:
+            processes: Number of worker processes, 0 to annotate in the calling thread
+                       (using automaton or the db passed to annotate())
+            automaton: The AliasAutomaton to match with, if any. Shared with the worker processes
+            overlap: Number of tokens of the next chunk included in every chunk.
+                     Default: The length of the longest automaton name, else 32
+        """
+        self.processes = processes
+        self.chunkTokens = chunkTokens
+        self.automaton = automaton
+        if overlap is None:
+            overlap = automaton.maxNameTokens() - 1 if automaton is not None else 32
+        self.overlap = overlap
+        self.pool = None
+        if processes > 0:
+            global _automaton
+            _automaton = automaton
+            #Fork (before any thread is started) to share the automaton. Reference counting
+            # still copies the pages of the objects a worker touches, but the garbage collector
+            # of the workers won't touch the frozen objects
+            gc.freeze()
+            try:
+                self.pool = multiprocessing.get_context("fork").Pool(processes, initializer=initWorker)
+            finally:
+                gc.unfreeze()
+    def chunks(self, tokens):
+        "Split tokens into (chunk start index, number of owned tokens, tokens incl. overlap) tasks"
+        for start in range(0, len(tokens), self.chunkTokens):
+            numOwned = min(self.chunkTokens, len(tokens) - start)
+            yield start, numOwned, tokens[start:start + numOwned + self.overlap]
+    def annotate(self, text, db=None, checkCancelled=None):
+        """
+        Find the entity hits in a text.
+        db is used for index lookups if there is neither a pool nor an automaton.
+        checkCancelled is called while annotating. It may raise an exception
+        to stop annotating, e.g. if the request has timed out.
+        Returns a list of [start, end, ID, DB] hits with UTF-16 character offsets.
+        """
+        startTime = time.time()
+        checkCancelled = checkCancelled or (lambda: None)
+        spans = tokenSpans(text)
+        tokens = [text[start:end].encode("utf-8") for start, end in spans]
+        tasks = list(self.chunks(tokens))
+        if self.pool is not None and len(tasks) > 1:
+            asyncResult = self.pool.map_async(annotateChunk, tasks)
+            while not asyncResult.ready():
+                checkCancelled()
+                asyncResult.wait(0.1)
+            chunkHits = asyncResult.get()
+        elif self.automaton is not None:
+            chunkHits = []
+            for chunkStart, numOwned, chunkTokens in tasks:
+                checkCancelled()
+                chunkHits.append([(chunkStart + start, chunkStart + end, hits) for start, end, hits
+                                  in self.automaton.findSpans(chunkTokens, filterNERToken) if start < numOwned])
+        else: #No automaton: Search the whole text in the entity index at once
+            chunkHits = [findIndexSpans(db, tokens, filterNERToken)]
+        offset = utf16Offsets(text)
+        result = [[offset(spans[start][0]), offset(spans[end - 1][1]), hit[0], hit[1]]
+                  for start, end, hit in selectSpans(span for hits in chunkHits for span in hits)]
+        # Measure timing
+        timeDiff = (time.time() - startTime) * 1000.0
+        print("Document NER for %d tokens in %d chunks took %.1f milliseconds" % (len(tokens), len(tasks), timeDiff))
+        return result
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Search result cache shared by all websocket connections.
+
+Results are cached per (query type, normalized query) in a LRU map which
+is bounded by the (approximate, JSON-serialized) size of the results.
+The whole cache is invalidated whenever the index generation
+(see DocumentDB.indexGenerationKey) changes, i.e. after every import,
+indexing or truncation run.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+class ResultCache(object):
+    """
+    Versioned LRU result cache.
+
+    The index generation is read using the generationFunction
+    at most every checkInterval seconds. It is called without holding
+    the cache lock, so other threads don't wait for the database.
+    """
+    def __init__(self, generationFunction, maxBytes=64*1024*1024, checkInterval=1.0):
+        self.generationFunction = generationFunction
+        self.maxBytes = maxBytes
+        self.checkInterval = checkInterval
+        #(qtype, normalized query) -> (result, size)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.lastCheck = None
+        self.lock = threading.Lock()
+        #Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    def _checkGeneration(self):
+        "Clear the cache if the index generation has changed"
+        with self.lock:
+            now = time.time()
+            if self.lastCheck is not None and now - self.lastCheck < self.checkInterval:
+                return
+            #Other threads don't check again while the generation is read
+            self.lastCheck = now
+        generation = self.generationFunction()
+        with self.lock:
+            if generation != self.generation:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.size = 0
+                self.generation = generation
+    def currentGeneration(self):
+        """
+        Get the index generation results computed from now on belong to.
+        Read it before computing a result and pass it to put()
+        """
+        self._checkGeneration()
+        with self.lock:
+            return self.generation
+    def get(self, qtype, query):
+        "Get a cached result or None"
+        self._checkGeneration()
+        with self.lock:
+            entry = self.entries.get((qtype, query))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((qtype, query))
+            self.hits += 1
+            return entry[0]
+    def put(self, qtype, query, result, size, generation):
+        """
+        Cache a result. size is its approximate size in bytes.
+        generation is the currentGeneration() read before the result has been computed.
+        Results of an older generation are not cached, because the index may have changed
+        while they were computed.
+        """
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            key = (qtype, query)
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (result, size)
+            self.size += size
+            while self.size > self.maxBytes:
+                _, (_, evictedSize) = self.entries.popitem(last=False)
+                self.size -= evictedSize
+                self.evictions += 1
+    def stats(self):
+        "Get a dictionary of cache statistics"
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries), "bytes": self.size,
+                "evictions": self.evictions, "invalidations": self.invalidations}
@@ -1,20 +1,35 @@
 #!/usr/bin/env python3
 from autobahn.asyncio.websocket import WebSocketServerProtocol, \
     WebSocketServerFactory
-from Translatron.DocumentDB import YakDBDocumentDatabase, documentSerializer
+from Translatron.DocumentDB import documentSerializer, decodeBytes
 from nltk.tokenize.regexp import RegexpTokenizer
-from nltk.tokenize import word_tokenize
+from Translatron.Indexing.Tokenizer import tokenize
+from Translatron.Server.ResultCache import ResultCache
+from Translatron.Server.AliasAutomaton import loadOrBuildAliasAutomaton
+from Translatron.Server.ConnectionPool import ConnectionPool
+from Translatron.Server.DocumentNER import DocumentNER, filterNERToken
 try:
     import simplejson as json
 except ImportError:
     import json
+import msgpack
 import threading
 import time
-from ansicolor import blue, yellow, red
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import asyncio
+except ImportError:
+    ## Trollius >= 0.3 was renamed
+    import trollius as asyncio
+from ansicolor import blue, red
 from YakDB.InvertedIndex import InvertedIndex
 from Translatron.Misc.UniprotMetadatabase import initializeMetaDatabase
 
 
+class RequestCancelled(Exception):
+    "Raised in the executor thread when a request shall not send any more replies"
+    pass
+
 def has_alpha_chars(string):
     return any((ch.isalnum() for ch in string))
 
@@ -22,51 +37,159 @@ def has_alpha_chars(string):
 # Initialize objects that will be passed onto the client upon request
 metaDB = initializeMetaDatabase()
 
+#Websocket subprotocols (wire formats) the client can negotiate:
+# msgpack frames (binary websocket messages) or JSON text messages with bytes as UTF-8 strings.
+# Clients that don't negotiate a subprotocol use JSON as well.
+msgpackProtocol = "translatron.msgpack"
+jsonProtocol = "translatron.json"
+
+#The pooled connection (db) and the cancellation event (cancelled)
+# of the request running in the current executor thread
+_threadLocal = threading.local()
+
 
 class TranslatronProtocol(WebSocketServerProtocol):
+    #Query tokenizer (see Tokenizer.tokenizers). Must match the one used for indexing
+    tokenizer = None
+    #ResultCache shared by all connections, None to disable caching
+    cache = None
+    #AliasAutomaton for database-free NER, None to use the entity index
+    nerAutomaton = None
+    #DocumentNER for (full-length) document NER requests
+    documentNER = None
+    #Executor running all database requests. Its number of threads limits the number of concurrent requests
+    executor = None
+    #Maximum time in seconds to wait for a request result, None for no limit
+    requestTimeout = None
+    #ConnectionPool shared by all connections
+    pool = None
+    #Default and maximum number of document search results per page
+    defaultPageSize = 20
+    maxPageSize = 100
+    #Number of documents per streamed result frame
+    chunkSize = 5
+    #Request types where a newer request (for the same "docid", if any) supersedes
+    # the older ones of the same connection that have not finished yet
+    supersededQtypes = frozenset(["docsearch", "ner", "documentner", "entitysearch"])
+
     def __init__(self):
         """Setup a new connection"""
-        print(yellow("Initializing new YakDB connection"))
-        self.db = YakDBDocumentDatabase()
         # Initialize NLTK objects
         self.nerTokenizer = RegexpTokenizer(r'\s+', gaps=True)
+        self.connectionClosed = False
+        #Whether the client negotiated msgpack frames
+        self.binary = False
+        #Cancellation events of unfinished requests by request ID and by supersede key
+        self.pendingRequests = {}
+        self.latestRequests = {}
+        #Running processRequest() tasks. The event loop only keeps weak references
+        self.tasks = set()
+
+    @property
+    def db(self):
+        "The pooled database connection of the request running in the current thread"
+        return _threadLocal.db
+
+    def checkCancelled(self):
+        "Raise RequestCancelled if the request running in the current thread has been cancelled or has timed out"
+        if _threadLocal.cancelled.is_set() or self.connectionClosed:
+            raise RequestCancelled()
 
     def onConnect(self, request):
-        pass
+        "Negotiate the wire format. msgpack is preferred if the client supports it"
+        if msgpackProtocol in request.protocols:
+            self.binary = True
+            return msgpackProtocol
+        if jsonProtocol in request.protocols:
+            return jsonProtocol
+        return None
+
+    def encodeFrame(self, obj):
+        "Encode a reply in the negotiated wire format"
+        if self.binary:
+            #bytes are packed as msgpack str, which the client decodes as UTF-8
+            return msgpack.packb(obj, use_bin_type=False, default=documentSerializer)
+        return json.dumps(decodeBytes(obj)).encode("utf-8")
 
     def onOpen(self):
         pass
 
-    def performDocumentSearch(self, query):
+    def documentSearchTokens(self, query):
+        "Get the normalized search tokens of a document search query"
+        queryTokens = map(str.lower, tokenize(query, self.tokenizer))
+        #Remove 1-token parts from the query -- they are way too general!
+        #Also remove exclusively-non-alnum tokens
+        return [tk for tk in queryTokens if (len(tk) > 1 and has_alpha_chars(tk))]
+
+    def performDocumentSearch(self, queryTokens, offset=0, limit=20):
         """
         Perform a token search on the document database.
         Search is performed in multi-token prefix (all must hit) mode.
-        Tokens with no hits at all are ignored entirely
+        Tokens with no hits at all are ignored entirely.
+        Returns (total number of hits, iterator of document lists) with the limit
+        best-ranked documents starting at offset. Documents are loaded chunk by chunk.
         """
         startTime = time.time()
-        queryTokens = map(str.lower, word_tokenize(query))
-        levels = [b"title", b"content", b"metadata"]
-        #Remove 1-token parts from the query -- they are way too general!
-        #Also remove exclusively-non-alnum tokens
-        queryTokens = [tk for tk in queryTokens if (len(tk) > 1 and has_alpha_chars(tk))]
-        results = self.db.searchDocumentsMultiTokenPrefix(queryTokens, levels=levels)
-        #Return only those paragraphs around the hit paragraph (or the first 3 pararaphs)
-        for hitLocation, doc in results.items():
-            (docId, docLoc) = InvertedIndex.splitEntityIdPart(hitLocation)
-            #Compute which paragraphs to display
-            minShowPar = 0
-            maxShowPar = 2
-            if docLoc.startswith(b"paragraph"):
-                paragraphNo = int(docLoc[9:])
-                minShowPar = max(0, paragraphNo - 1)
-                maxShowPar = min(len(doc[b"paragraphs"]), paragraphNo + 1)
-            #Modify documents
-            results[hitLocation][b"hitLocation"] = docLoc
-            results[hitLocation][b"paragraphs"] = doc[b"paragraphs"][minShowPar:maxShowPar]
+        total, hits = self.db.rankDocuments(queryTokens, offset=offset, limit=limit)
+        return total, self.iterateSearchResults(queryTokens, total, hits, startTime)
+
+    def iterateSearchResults(self, queryTokens, total, hits, startTime):
+        "Load ranked (document ID, hit location part, score) hits in chunks of chunkSize documents"
+        for i in range(0, len(hits), self.chunkSize):
+            chunkHits = hits[i:i + self.chunkSize]
+            #Results only contain document metadata, paragraphs are stored separately
+            docs = self.db.findDocumentMetadata([docId for docId, _, _ in chunkHits])
+            yield [self.trimSearchResult(docId, docLoc, score, doc)
+                   for (docId, docLoc, score), doc in zip(chunkHits, docs) if doc is not None]
         # Measure timing
         timeDiff = (time.time() - startTime) * 1000.0
-        print("Document search for %d tokens took %.1f milliseconds" % (len(queryTokens), timeDiff))
-        return results
+        print("Document search for %d tokens (%d hits) took %.1f milliseconds" % (len(queryTokens), total, timeDiff))
+
+    def trimSearchResult(self, docId, docLoc, score, doc):
+        "Add hit information to a search result and load only the paragraphs around the hit"
+        #Return only those paragraphs around the hit paragraph (or the first 3 pararaphs)
+        #Compute which paragraphs to display
+        numParagraphs = doc.pop(b"numParagraphs", None)
+        if numParagraphs is None: #Old format, document includes all paragraphs
+            numParagraphs = len(doc[b"paragraphs"])
+        minShowPar = 0
+        maxShowPar = min(numParagraphs, 2)
+        if docLoc.startswith(b"paragraph"):
+            paragraphNo = int(docLoc[9:])
+            minShowPar = max(0, paragraphNo - 1)
+            maxShowPar = min(numParagraphs, paragraphNo + 1)
+        #Modify documents
+        doc[b"hitLocation"] = docLoc
+        doc[b"score"] = score
+        if b"paragraphs" in doc:
+            doc[b"paragraphs"] = doc[b"paragraphs"][minShowPar:maxShowPar]
+        else: #Load only the paragraphs to display
+            doc[b"paragraphs"] = self.db.findParagraphs(docId, range(minShowPar, maxShowPar))
+        return doc
+
+    def cachedDocumentSearch(self, queryTokens, offset, limit):
+        """
+        Like performDocumentSearch(), but uses the shared result cache.
+        The page is cached after its last chunk has been loaded
+        """
+        cache = TranslatronProtocol.cache
+        if cache is None:
+            return self.performDocumentSearch(queryTokens, offset, limit)
+        key = (tuple(queryTokens), offset, limit)
+        generation = cache.currentGeneration()
+        cached = cache.get("docsearch", key)
+        if cached is not None:
+            total, results = cached
+            return total, (results[i:i + self.chunkSize] for i in range(0, len(results), self.chunkSize))
+        total, chunks = self.performDocumentSearch(queryTokens, offset, limit)
+        def cachingChunks():
+            results = []
+            for chunk in chunks:
+                results += chunk
+                yield chunk
+            cache.put("docsearch", key, (total, results),
+                      len(json.dumps(results, default=documentSerializer)), generation)
+        return total, cachingChunks()
 
     def uniquifyEntities(self, entities):
         """Remove duplicates from a list of entities (key: ["id"])"""
@@ -94,18 +217,29 @@ class TranslatronProtocol(WebSocketServerProtocol):
         """
         Filter function to remove stuff that just clutters the display.
         """
-        #Short numbers are NOT considered database IDs.
-        #NOTE: In reality, pretty much all numbers are Allergome database IDs, e.g. see
-        # http://www.allergome.org/script/dettaglio.php?id_molecule=14
-        if len(token) <= 5 and token.isdigit():
-            return False
-        return True
+        return filterNERToken(token)
 
     def performEntityNER(self, query):
         "Search a query text for entity/entity alias hits"
         startTime = time.time()
         tokens = self.nerTokenizer.tokenize(query)
         queryTokens = [s.encode("utf-8") for s in tokens]
+        if TranslatronProtocol.nerAutomaton is not None:
+            results = TranslatronProtocol.nerAutomaton.findHits(queryTokens, self.filterNERTokens)
+        else:
+            results = self.findEntityNERHits(queryTokens)
+        self.checkCancelled()
+        ret = self.reduceEntityNERHits(results)
+        # Measure timing
+        timeDiff = (time.time() - startTime) * 1000.0
+        print("NER for %d tokens took %.1f milliseconds" % (len(queryTokens), timeDiff))
+        return ret
+
+    def findEntityNERHits(self, queryTokens):
+        """
+        Find the entity alias hits in a list of query tokens using the entity index.
+        Returns {case-sensitive hit text: [(ID, DB) or (name, source)]}
+        """
         # Search for case-sensitive hits
         searchFN = InvertedIndex.searchSingleTokenMultiExact
         results = searchFN(self.db.entityIdx.index, frozenset(filter(self.filterNERTokens, queryTokens)), level=b"aliases")
@@ -124,6 +258,7 @@ class TranslatronProtocol(WebSocketServerProtocol):
         t2 = time.time()
         print("TX " + str(t2 - t1))
         for (firstTokenHit, hits) in ciResults.items():
+            self.checkCancelled()
             #Find all possible locations where the full hit could start, i.e. where the first token produced a hit
             possibleHitStartIndices = [i for i, x in enumerate(lowercaseQueryTokens) if x == firstTokenHit]
             #Iterate over all possible
@@ -148,6 +283,10 @@ class TranslatronProtocol(WebSocketServerProtocol):
                         results[csHit].append((hitStr, hitLoc))
         t3 = time.time()
         print("TY " + str(t3 - t2))
+        return results
+
+    def reduceEntityNERHits(self, results):
+        "Reduce the result of findEntityNERHits() to one hit per hit text, removing sub-hits"
         # TODO: Remove results which are subsets of other hits. This occurs only if we have multi-token results
         removeKeys = set() # Can't modify dict while iterating it, so aggregate keys to delete
         for key in results.keys():
@@ -165,54 +304,253 @@ class TranslatronProtocol(WebSocketServerProtocol):
         # Result: For each token with hits --> (DBID, Database name)
         # Just takes the first DBID.It is unlikely that different DBIDs are found, but we
         #   can only link to one using the highlighted label
-        ret =  {k: (v[0][0], v[0][1]) for k, v in results.items() if v}
-        # Measure timing
-        timeDiff = (time.time() - startTime) * 1000.0
-        print("NER for %d tokens took %.1f milliseconds" % (len(queryTokens), timeDiff))
-        return ret
+        return {k: (v[0][0], v[0][1]) for k, v in results.items() if v}
 
 
+    def cachedQuery(self, qtype, query, function):
+        """
+        Get the result of a query from the shared cache or, if it is not cached,
+        compute it by calling function and cache it. query must be normalized and hashable
+        """
+        cache = TranslatronProtocol.cache
+        if cache is None:
+            return function()
+        generation = cache.currentGeneration()
+        result = cache.get(qtype, query)
+        if result is None:
+            result = function()
+            cache.put(qtype, query, result, len(json.dumps(result, default=documentSerializer)), generation)
+        if (cache.hits + cache.misses) % 1000 == 0:
+            print("Result cache statistics: %s" % cache.stats())
+        return result
+
     def onMessage(self, payload, isBinary):
-        request = json.loads(payload.decode('utf8'))
+        if isBinary:
+            requests = msgpack.unpackb(payload, raw=False)
+        else:
+            requests = json.loads(payload.decode('utf8'))
+        #A frame contains either a single request or a list of requests
+        if isinstance(requests, dict):
+            requests = [requests]
+        for request in requests:
+            if request.get("qtype") == "cancel":
+                self.cancelRequests(request.get("ids", [request.get("id")]))
+                continue
+            cancelled = self.registerRequest(request)
+            #Do not block the event loop (and therefore all other clients) while waiting for the database
+            task = asyncio.ensure_future(self.processRequest(request, cancelled))
+            self.tasks.add(task)
+            task.add_done_callback(self.requestTaskDone)
+
+    def requestTaskDone(self, task):
+        "Forget a finished request task and report the exceptions processRequest() did not handle"
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(red("Websocket request task failed: %r" % task.exception(), bold=True))
+
+    def registerRequest(self, request):
+        """
+        Register a new request and cancel the requests it supersedes.
+        Returns the cancellation event of the request
+        """
+        cancelled = threading.Event()
+        if "id" in request:
+            self.pendingRequests[request["id"]] = cancelled
+        if request.get("qtype") in self.supersededQtypes:
+            key = (request["qtype"], request.get("docid"))
+            superseded = self.latestRequests.get(key)
+            if superseded is not None:
+                superseded.set()
+            self.latestRequests[key] = cancelled
+        return cancelled
+
+    def unregisterRequest(self, request, cancelled):
+        if self.pendingRequests.get(request.get("id")) is cancelled:
+            del self.pendingRequests[request["id"]]
+        key = (request.get("qtype"), request.get("docid"))
+        if self.latestRequests.get(key) is cancelled:
+            del self.latestRequests[key]
+
+    def cancelRequests(self, ids):
+        "Cancel the unfinished requests with the given IDs. Cancelled requests send no (further) replies"
+        for requestId in ids:
+            cancelled = self.pendingRequests.get(requestId)
+            if cancelled is not None:
+                cancelled.set()
+
+    async def processRequest(self, request, cancelled):
+        """
+        Run a request in the executor and send the reply.
+        If cancelled is set before the request has been started, it is dropped
+        """
+        loop = asyncio.get_event_loop()
+        startTime = time.time()
+        def send(frame):
+            "Send a frame from the executor thread"
+            if cancelled.is_set() or self.connectionClosed:
+                raise RequestCancelled()
+            loop.call_soon_threadsafe(self.sendMessage, frame, self.binary)
+        try:
+            reply = await asyncio.wait_for(loop.run_in_executor(
+                TranslatronProtocol.executor, self.handlePooledRequest, request, send, cancelled, startTime),
+                TranslatronProtocol.requestTimeout)
+        except asyncio.TimeoutError:
+            if cancelled.is_set(): #Superseded while waiting
+                return
+            cancelled.set()
+            print(red("Websocket request %s timed out after %.1f seconds"
+                      % (request.get("qtype"), TranslatronProtocol.requestTimeout), bold=True))
+            reply = self.errorReply(request, "timeout")
+        except RequestCancelled:
+            reply = None
+        except Exception as ex:
+            print(red("Websocket request %s failed: %s" % (request.get("qtype"), ex), bold=True))
+            reply = self.errorReply(request, "error")
+        finally:
+            self.unregisterRequest(request, cancelled)
+        if reply is not None and not cancelled.is_set():
+            self.sendMessage(reply, self.binary)
+
+    def errorReply(self, request, error):
+        "Encode an error reply. Like regular replies, it does not re-send the query"
+        request = {k: v for k, v in request.items() if k not in ("term", "query")}
+        request["error"] = error
+        return self.encodeFrame(request)
+
+    def handlePooledRequest(self, request, send, cancelled, startTime):
+        """
+        Perform a request using a connection from the pool unless it has been cancelled while queued.
+        Database requests fail once the request timeout (counted from startTime) has expired,
+        so timed out requests don't keep their executor thread and their connection.
+        """
+        if cancelled.is_set() or self.connectionClosed:
+            raise RequestCancelled()
+        remaining = None
+        if TranslatronProtocol.requestTimeout is not None:
+            remaining = max(TranslatronProtocol.requestTimeout - (time.time() - startTime), 0.001)
+        with TranslatronProtocol.pool.connection(remaining, receiveTimeout=remaining) as db:
+            _threadLocal.db, _threadLocal.cancelled = db, cancelled
+            try:
+                return self.handleRequest(request, send)
+            finally:
+                _threadLocal.db, _threadLocal.cancelled = None, None
+
+    def streamResults(self, request, chunks, send):
+        """
+        Send the result chunks of a request as separate frames with consecutive "chunk" numbers.
+        The caller returns the completion frame ("done": true).
+        """
+        for chunkNo, chunk in enumerate(chunks):
+            frame = dict(request, chunk=chunkNo, results=chunk)
+            send(self.encodeFrame(frame))
+        request["done"] = True
+
+    def handleRequest(self, request, send):
+        """
+        Perform a request (runs in an executor thread).
+        Streamed results are sent using send(encoded frame).
+        Returns the encoded (final) reply or None if no reply shall be sent
+        """
         # Perform action depending on query type
         qtype = request["qtype"]
         if qtype == "docsearch":
-            results = self.performDocumentSearch(request["term"])
-            del request["term"]
-            request["results"] = list(results.values())
+            queryTokens = self.documentSearchTokens(request.pop("term"))
+            offset = max(int(request.get("offset", 0)), 0)
+            limit = min(max(int(request.get("limit", self.defaultPageSize)), 0), self.maxPageSize)
+            request["offset"], request["limit"] = offset, limit
+            request["total"], chunks = self.cachedDocumentSearch(queryTokens, offset, limit)
+            #Hits whose documents can't be loaded are skipped, so the client can't count the results
+            request["nextOffset"] = min(offset + limit, request["total"])
+            self.streamResults(request, chunks, send)
         elif qtype == "ner":
-            results = self.performEntityNER(request["query"])
+            #The NER tokenizer splits at whitespace, so the normalized query yields the same results
+            query = " ".join(request["query"].split())
+            request["results"] = self.cachedQuery(qtype, query, lambda: self.performEntityNER(query))
             del request["query"]
-            request["results"] = results
+        elif qtype == "documentner":
+            #Results contain character offsets, so the text is not normalized
+            text = request.pop("query")
+            request["results"] = self.cachedQuery(qtype, text,
+                lambda: TranslatronProtocol.documentNER.annotate(text, self.db, self.checkCancelled))
         elif qtype == "metadb":
             # Send meta-database to generate
             request["results"] = metaDB
         elif qtype == "entitysearch":
-            request["entities"] = self.performEntitySearch(request["term"])
+            term = request["term"]
+            request["entities"] = self.cachedQuery(qtype, term, lambda: self.performEntitySearch(term))
             del request["term"]
         elif qtype == "getdocuments":
-            # Serve one or multiple documents by IDs
-            docIds = [s.encode() for s in request["query"]]
-            request["results"] = self.db.docIdx.findEntities(docIds)
-            del request["query"]
+            # Serve one or multiple documents by IDs, one document per frame
+            docIds = [s.encode() for s in request.pop("query")]
+            self.streamResults(request, (self.db.findDocuments([docId]) for docId in docIds), send)
         else:
             print(red("Unknown websocket request type: %s" % request["qtype"], bold=True))
-            return # Do not send reply
+            return None # Do not send reply
         #Return modified request object: Keeps custom K/V pairs but do not re-send query
-        self.sendMessage(json.dumps(request, default=documentSerializer).encode("utf-8"), False)
+        return self.encodeFrame(request)
 
     def onClose(self, wasClean, code, reason):
+        #Stop streaming replies of running requests
+        self.connectionClosed = True
         print("WebSocket connection closed: {0}".format(reason))
 
 
-def startWebsocketServer():
-    print(blue("Websocket server starting up..."))
+def createDocumentNER(nerAutomatonFile=None, nerProcesses=0, db=None):
+    """
+    Load the NER automaton from nerAutomatonFile (built using db if it does not exist), if any,
+    and start the nerProcesses document NER worker processes.
+    Call this before starting any threads, because the workers are forked (see DocumentNER).
+    """
+    automaton = None
+    if nerAutomatonFile:
+        if db is None:
+            from Translatron.DocumentDB import YakDBDocumentDatabase
+            db = YakDBDocumentDatabase()
+        automaton = loadOrBuildAliasAutomaton(nerAutomatonFile, db)
+    return DocumentNER(nerProcesses, automaton=automaton)
 
-    try:
-        import asyncio
-    except ImportError:
-        ## Trollius >= 0.3 was renamed
-        import trollius as asyncio
+def startWebsocketServer(tokenizer=None, cacheSize=64*1024*1024, nerAutomatonFile=None,
+                         maxConcurrentRequests=8, requestTimeout=30.0, maxConnections=None, nerProcesses=0,
+                         documentNER=None):
+    """
+    Start the websocket server. Does not return until the server is stopped.
+    cacheSize is the maximum size of the shared result cache in bytes (0 to disable caching).
+    If nerAutomatonFile is given, NER uses the AliasAutomaton from that file (built if it does not exist).
+    At most maxConcurrentRequests requests (of all clients) are processed concurrently,
+    each one for at most requestTimeout seconds (0 or None: no timeout).
+    maxConnections is the size of the YakDB connection pool (default: maxConcurrentRequests).
+    Document NER requests are annotated by nerProcesses worker processes (0: in the request thread).
+    If documentNER (see createDocumentNER()) is given, nerAutomatonFile and nerProcesses are ignored.
+    Queries are tokenized using tokenizer (default: the one the document index has been built with).
+    """
+    print(blue("Websocket server starting up..."))
+    TranslatronProtocol.executor = ThreadPoolExecutor(max_workers=maxConcurrentRequests)
+    TranslatronProtocol.requestTimeout = requestTimeout or None
+    #Open all connections now instead of during the websocket handshakes.
+    # Every executor thread uses one connection at a time
+    pool = ConnectionPool(maxConnections or maxConcurrentRequests)
+    pool.prefill()
+    TranslatronProtocol.pool = pool
+    #Queries must be tokenized like the indexed documents
+    with pool.connection() as db:
+        indexTokenizer = db.findIndexTokenizer()
+    if tokenizer is None:
+        tokenizer = indexTokenizer
+    elif indexTokenizer is not None and tokenizer != indexTokenizer:
+        print(red("Warning: Using the '%s' tokenizer for queries, but the document index has been built with '%s'"
+                  % (tokenizer, indexTokenizer), bold=True))
+    TranslatronProtocol.tokenizer = tokenizer
+    if documentNER is None:
+        with pool.connection() as db:
+            documentNER = createDocumentNER(nerAutomatonFile, nerProcesses, db)
+    TranslatronProtocol.nerAutomaton = documentNER.automaton
+    TranslatronProtocol.documentNER = documentNER
+    if cacheSize:
+        def findIndexGeneration():
+            #The cache is only used by requests, which already hold a pooled connection.
+            # Taking a second one could deadlock once all connections are in use
+            return _threadLocal.db.findIndexGeneration()
+        TranslatronProtocol.cache = ResultCache(findIndexGeneration, cacheSize)
 
     #Asyncio only setups an event loop in the main thread, else we need to
     if threading.current_thread().name != 'MainThread':
@@ -233,3 +571,6 @@ def startWebsocketServer():
     finally:
         server.close()
         loop.close()
+        TranslatronProtocol.executor.shutdown(wait=False)
+        pool.close()
+        TranslatronProtocol.documentNER.close()
@@ -5,9 +5,11 @@ Server wrapper
 import functools
 from threading import Thread
 from Translatron.Server.HTTPServer import startHTTPServer
-from Translatron.Server.WebsocketInterface import startWebsocketServer
+from Translatron.Server.WebsocketInterface import createDocumentNER, startWebsocketServer
 
-def startTranslatron(startWebsocket = True, startHTTP = True, join = True, http_port=8080):
+def startTranslatron(startWebsocket = True, startHTTP = True, join = True, http_port=8080, tokenizer=None,
+                     cacheSize=64*1024*1024, nerAutomatonFile=None, maxConcurrentRequests=8,
+                     requestTimeout=30.0, maxConnections=None, nerProcesses=0):
     """
     Start servers required for Translatron
 
@@ -15,11 +17,24 @@ def startTranslatron(startWebsocket = True, startHTTP = True, join = True, http_
         startWebsocket: Whether to start the websocket server
         startHTTP: Whether to start the CherryPy-based HTTP server
         join: Whether to wait for the server threads to exit
+        tokenizer: The query tokenizer name (see Tokenizer.tokenizers), None for the one of the document index
+        cacheSize: Maximum size of the search result cache in bytes, 0 to disable caching
+        nerAutomatonFile: Alias automaton file for database-free NER (see AliasAutomaton), None to disable
+        maxConcurrentRequests: Maximum number of websocket requests processed concurrently
+        requestTimeout: Maximum websocket request processing time in seconds, 0 or None for no limit
+        maxConnections: Size of the YakDB connection pool, None for maxConcurrentRequests
+        nerProcesses: Number of worker processes for document NER, 0 to annotate in the request thread
     """
     #Start websocket server
     wsThread = None
     if startWebsocket:
-        wsThread = Thread(target=startWebsocketServer)
+        #The NER workers are forked before any thread is started (see DocumentNER)
+        documentNER = createDocumentNER(nerAutomatonFile, nerProcesses)
+        wsThread = Thread(target=functools.partial(startWebsocketServer, tokenizer=tokenizer, cacheSize=cacheSize,
+                                                    maxConcurrentRequests=maxConcurrentRequests,
+                                                    requestTimeout=requestTimeout,
+                                                    maxConnections=maxConnections,
+                                                    documentNER=documentNER))
         wsThread.start()
     #Start HTTP server
     httpThread = None
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage ingest instrumentation.
+
+IngestStatistics collects timers (seconds spent per stage, e.g. read, parse, write)
+and counters (e.g. documents, parse errors). Worker processes send snapshots
+to the main process, which merges them. StatisticsReporter writes the
+merged statistics as JSON lines, periodically and once at the end:
+
+    {"command": "import-documents", "final": false, "elapsed": 10.0,
+     "timers": {"parse": 31.2, ...}, "counters": {"documents": 4711, ...}}
+"""
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from ansicolor import black
+
+__author__ = "Uli Köhler"
+__copyright__ = "Copyright 2015 Uli Köhler"
+__license__ = "Apache License v2.0"
+__version__ = "0.1"
+__maintainer__ = "Uli Köhler"
+__email__ = "ukoehler@techoverflow.net"
+__status__ = "Development"
+
+class IngestStatistics(object):
+    """
+    Timers and counters for the stages of an import or indexing run
+    """
+    def __init__(self):
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+    @contextmanager
+    def timer(self, stage):
+        "Context manager that adds the time spent in the block to the given stage"
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] += time.perf_counter() - startTime
+    def addTime(self, stage, seconds):
+        self.timers[stage] += seconds
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+    def snapshot(self):
+        "Get a (picklable, JSON-serializable) copy of the statistics"
+        return {"timers": dict(self.timers), "counters": dict(self.counters)}
+    def takeSnapshot(self):
+        "Get a snapshot and reset the statistics. Used to send deltas from worker processes"
+        snapshot = self.snapshot()
+        self.timers.clear()
+        self.counters.clear()
+        return snapshot
+    def merge(self, snapshot):
+        "Add a snapshot (e.g. from a worker process) to these statistics"
+        for stage, seconds in snapshot["timers"].items():
+            self.timers[stage] += seconds
+        for counter, n in snapshot["counters"].items():
+            self.counters[counter] += n
+
+class StatisticsReporter(object):
+    """
+    Writes IngestStatistics as JSON lines to a file (if any),
+    at most every interval seconds and once at the end.
+    """
+    def __init__(self, command, filename=None, interval=10.0):
+        self.command = command
+        self.interval = interval
+        self.startTime = time.time()
+        self.lastReport = self.startTime
+        self.outfile = open(filename, "a") if filename else None
+    def _write(self, statistics, final):
+        if self.outfile is None:
+            return
+        record = {"command": self.command, "time": time.time(),
+                  "elapsed": time.time() - self.startTime, "final": final}
+        record.update(statistics.snapshot())
+        self.outfile.write(json.dumps(record, sort_keys=True) + "\n")
+        self.outfile.flush()
+    def report(self, statistics):
+        "Write a periodic report if the interval has elapsed"
+        if time.time() - self.lastReport >= self.interval:
+            self.lastReport = time.time()
+            self._write(statistics, final=False)
+    def finish(self, statistics):
+        "Write the final report and print a human-readable summary"
+        self._write(statistics, final=True)
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+        print(black("Stage timing for %s (seconds, summed over all processes and threads):" % self.command, bold=True))
+        for stage, seconds in sorted(statistics.timers.items(), key=lambda item: -item[1]):
+            print("    %-12s %10.1f s" % (stage, seconds))
+        for counter, n in sorted(statistics.counters.items()):
+            print("    %-12s %10d" % (counter, n))
+
+def timedIterate(iterable, statistics, stage):
+    "Iterate over iterable, adding the time spent producing each item to the given stage"
+    iterator = iter(iterable)
+    while True:
+        startTime = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            statistics.addTime(stage, time.perf_counter() - startTime)
+        yield item
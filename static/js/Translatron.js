@@ -1,8 +1,16 @@
 var Translatron = angular.module('Translatron', ['ui.bootstrap'])
 
+/**
+ * Wire formats (websocket subprotocols) offered to the server, preferred first.
+ * translatron.msgpack uses binary msgpack frames (see msgpack.js),
+ * translatron.json uses JSON text messages.
+ */
+var wireProtocols = ["translatron.msgpack", "translatron.json"];
+
 function connectWebsocket() {
     console.info("Connecting to " + 'ws://' + window.location.hostname + ':9000')
-    var conn = new WebSocket('ws://' + window.location.hostname + ':9000');
+    var conn = new WebSocket('ws://' + window.location.hostname + ':9000', wireProtocols);
+    conn.binaryType = "arraybuffer";
     conn.onerror = function (error) {
         console.log(error);
         alert("Error while communicating with server: " + JSON.stringify(error));
@@ -10,6 +18,55 @@ function connectWebsocket() {
     return conn;
 }
 
+var lastRequestId = 0;
+
+/**
+ * Send a request object in the wire format negotiated for the connection.
+ * Every request gets a new ID (unless it already has one) which the server copies
+ * to all replies. Requests sent in the same event loop turn are batched into one frame.
+ * Returns the request ID.
+ */
+function sendRequest(conn, request) {
+    if(request.id === undefined) {
+        request.id = ++lastRequestId;
+    }
+    if(conn.pendingRequests === undefined) {
+        conn.pendingRequests = [];
+    }
+    conn.pendingRequests.push(request);
+    if(conn.pendingRequests.length == 1) {
+        setTimeout(function () {
+            var requests = conn.pendingRequests;
+            conn.pendingRequests = [];
+            var frame = requests.length == 1 ? requests[0] : requests;
+            if(conn.protocol == "translatron.msgpack") {
+                conn.send(msgpack.encode(frame));
+            } else {
+                conn.send(JSON.stringify(frame));
+            }
+        }, 0);
+    }
+    return request.id;
+}
+
+/**
+ * Tell the server to stop processing a request. It won't send any further replies for it.
+ * Outdated docsearch, ner and entitysearch requests are cancelled by the server automatically.
+ */
+function cancelRequest(conn, id) {
+    sendRequest(conn, {"qtype": "cancel", "id": id});
+}
+
+/**
+ * Decode a websocket message (msgpack binary frame or JSON text)
+ */
+function decodeResponse(message) {
+    if(message.data instanceof ArrayBuffer) {
+        return msgpack.decode(new Uint8Array(message.data));
+    }
+    return JSON.parse(message.data);
+}
+
 /**
  * Defines how NER highlight results are rendered,
  * depending on the source database. By default, labels are rendered
@@ -22,9 +79,35 @@ var dbToLabelColor = {
     "UniProt": "label-success",
 }
 
+function escapeHTML(text) {
+    return $("<div>").text(text).html();
+}
+
+/**
+ * Render a NER hit as label linking to the entity page
+ */
+function nerLabel(text, dbid, dbName) {
+    //Compute label color, i.e. highlight specific databases.
+    //NOTE: The server always takes the FIRST hit. Therefore there might be cases
+    // when the correct highlighting for an ID does not apply because a different
+    // database was the first one.
+    var labelColor = dbToLabelColor[dbName];
+    if(labelColor === undefined) {
+        labelColor = "label-default"
+    }
+    //Link to the entity page, with the search term set to the token name
+    var href = "/entities.html#" + encodeURI(dbid);
+    return '<a href="' + escapeHTML(href) + '" target="_blank"><span class="label '
+           + labelColor + ' ner-result">' + escapeHTML(text) + '</span></a>';
+}
+
 Translatron.controller('SearchCtrl', ["$scope", "$http", "$modal", "$log", function ($scope, $http, $modal, $log) {
     $scope.searchResults = [];
-    $scope.nerResults = {};
+    //Total number of hits of the current search. Results are loaded page by page
+    $scope.searchTotal = 0;
+    //Offset of the next page as returned by the server (skipped hits are not in searchResults)
+    $scope.searchNextOffset = 0;
+    $scope.searchPageSize = 20;
 
     /**
      * Rendering a large number of search results is quite slow.
@@ -32,13 +115,12 @@ Translatron.controller('SearchCtrl', ["$scope", "$http", "$modal", "$log", funct
      * Therefore, the apparent performance decreases significantly due to the single-threaded
      * nature of JavaScript.
      * 
-     * This counter is incremented for every search request made.
-     * It is decremented for every search results received.
-     * Only if the (pre-decremented) value is zero the search results are actually displayed.
+     * Every request gets a new ID which the server copies to all its result frames.
+     * Only frames of the last search request are displayed.
      * This ensures that (even though the server has the same load) only the last result
      * is displayed.
      */
-    $scope.searchRequestsInQueue = 0;
+    $scope.searchId = 0;
 
     /*
      * Setup websocket connection
@@ -46,52 +128,64 @@ Translatron.controller('SearchCtrl', ["$scope", "$http", "$modal", "$log", funct
     $scope.connection = connectWebsocket();
 
     $scope.connection.onmessage = function (message) {
-        var response = JSON.parse(message.data);
+        var response = decodeResponse(message);
         if(response.qtype =="docsearch") {
-            //See $scope.searchRequestsInQueue declaration for description on how we do this
-            $scope.searchRequestsInQueue--;
-            if($scope.searchRequestsInQueue > 0) {
-                return; //Ignore search results... render next one.
+            //See $scope.searchId declaration for description on how we do this
+            if(response.id != $scope.searchId) {
+                return; //Ignore results of outdated searches
             }
-
-            $scope.searchResults = response.results;
+            //Results are streamed in chunks, followed by a frame with done set
+            if(response.done) {
+                if(response.offset == 0 && response.total == 0) {
+                    $scope.searchResults = [];
+                }
+            } else if(response.offset == 0 && response.chunk == 0) { //First chunk of a new search
+                $scope.searchResults = response.results;
+            } else { //Next chunk or page of the current search
+                $scope.searchResults = $scope.searchResults.concat(response.results);
+            }
+            $scope.searchTotal = response.total;
+            $scope.searchNextOffset = response.nextOffset;
             $scope.$apply();
-        } else if (response.qtype == "ner") {
-            console.log(response.results)
-            jQuery.extend($scope.nerResults, response.results);
-            //Find the correct document for the query
-            var docElem = $(".results").find('[data-docid="' + response.docid + '"]')
-            var paragraphs = $(docElem).find(".paragraph")
-            //User jquery.highlight to find and (invisibly) mark the hit with .highlight
-            for (var key in response.results) {
-                paragraphs.highlight(key, {wordsOnly: true, caseSensitive: true})
-                var dbid = response.results[key][0]; //E.g. "Poisson Distribution"
-                var dbName = response.results[key][1]; //E.g. "MeSH"
-                //Compute label color, i.e. highlight specific databases.
-                //NOTE: The server always takes the FIRST hit. Therefore there might be cases
-                // when the correct highlighting for an ID does not apply because a different
-                // database was the first one.
-                var labelColor = dbToLabelColor[dbName];
-                if(labelColor === undefined) {
-                    labelColor = "label-default"
+        } else if (response.qtype == "documentner") {
+            //Hits are [start, end, ID, database] character offsets into the paragraphs joined by newlines
+            var doc = null;
+            for (var j = $scope.searchResults.length - 1; j >= 0; j--) {
+                if($scope.searchResults[j].id == response.docid) {
+                    doc = $scope.searchResults[j];
                 }
-                /** 
-                 * Process highlighted tags
-                 */
-                $(".highlight").each(function(index) {
-                    //Do not add label if NER was performed multiple times
-                    if($(this).parent().hasClass("label")) { //Only remove .highlight div
-                        $(this).replaceWith(this.innerHTML)
-                    } else { //We're not already inside a label. Add a label
-                        //Link to the entity page, with the search term set to the token name
-                        var href = "/entities.html#" + encodeURI(dbid);
-                        var elem = $('<a href="' + href + '" target="_blank"><span class="label '
-                                     + labelColor + ' ner-result">' + this.innerHTML + '</span></a>');
-                        $(this).replaceWith(elem)
+            }
+            if(doc === null) {
+                return; //Document is not displayed any more
+            }
+            var hits = response.results;
+            var paragraphs = $(".results").find('[data-docid="' + response.docid + '"]').find(".paragraph");
+            var hitIdx = 0;
+            var paragraphStart = 0;
+            for (var i = 0; i < doc.paragraphs.length; i++) {
+                var text = doc.paragraphs[i];
+                var paragraphEnd = paragraphStart + text.length;
+                var html = "";
+                var pos = 0;
+                for (; hitIdx < hits.length && hits[hitIdx][0] < paragraphEnd; hitIdx++) {
+                    var hit = hits[hitIdx];
+                    if(hit[1] > paragraphEnd) {
+                        continue; //Hits spanning multiple paragraphs are not displayed
                     }
-                });
+                    var start = hit[0] - paragraphStart;
+                    var end = hit[1] - paragraphStart;
+                    html += escapeHTML(text.substring(pos, start))
+                            + nerLabel(text.substring(start, end), hit[2], hit[3]);
+                    pos = end;
+                }
+                html += escapeHTML(text.substring(pos));
+                paragraphs.eq(i).html(html);
+                paragraphStart = paragraphEnd + 1;
             }
         } else if (response.qtype == "getdocuments") {
+            if(response.done) {
+                return; //Documents are streamed one per frame
+            }
             //Usually only one document
             for (var i = response.results.length - 1; i >= 0; i--) {
                 var result = response.results[i];
@@ -107,23 +201,36 @@ Translatron.controller('SearchCtrl', ["$scope", "$http", "$modal", "$log", funct
         }
     }
 
-    $scope.performSearch = function () {
+    $scope.performSearch = function (offset) {
+        if(!$scope.searchExpression) { //Search field cleared: Stop the running search
+            cancelRequest($scope.connection, $scope.searchId);
+            $scope.searchId = 0;
+            $scope.searchResults = [];
+            $scope.searchTotal = 0;
+            $scope.searchNextOffset = 0;
+            return;
+        }
         searchObj = {
             "qtype": "docsearch",
-            "term": $scope.searchExpression
+            "term": $scope.searchExpression,
+            "offset": offset || 0,
+            "limit": $scope.searchPageSize
         }
-        $scope.searchRequestsInQueue++;
-        $scope.connection.send(JSON.stringify(searchObj));
+        $scope.searchId = sendRequest($scope.connection, searchObj);
         //Result is handled in onmessage / onerror
     };
 
+    $scope.loadMoreResults = function () {
+        $scope.performSearch($scope.searchNextOffset);
+    };
+
     $scope.performNER = function (doc) {
         searchObj = {
-            "qtype": "ner",
+            "qtype": "documentner",
             "query": doc.paragraphs.join("\n"),
             "docid": doc.id
         }
-        $scope.connection.send(JSON.stringify(searchObj));
+        sendRequest($scope.connection, searchObj);
     }
 
     $scope.showFullDocument = function(doc) {
@@ -131,7 +238,7 @@ Translatron.controller('SearchCtrl', ["$scope", "$http", "$modal", "$log", funct
             "qtype": "getdocuments",
             "query": [doc.id]
         }
-        $scope.connection.send(JSON.stringify(searchObj));
+        sendRequest($scope.connection, searchObj);
         
     }
 }]);
@@ -202,7 +309,7 @@ Translatron.controller('EntityCtrl', ["$scope", "$http", "$modal", "$log", "$loc
     $scope.connection = connectWebsocket();
     //Immediately request meta database & process search expression from URL
     $scope.connection.onopen = function() {
-        $scope.connection.send(JSON.stringify({"qtype":"metadb"}));
+        sendRequest($scope.connection, {"qtype":"metadb"});
         // Raw hash part of URL: /entities.html#foobar -> foobar --> search expression
         var urlTerm = $location.path().substring(1)
         if(urlTerm) {
@@ -226,11 +333,11 @@ Translatron.controller('EntityCtrl', ["$scope", "$http", "$modal", "$log", "$loc
             "qtype": "entitysearch",
             "term": $scope.searchExpression
         }
-        $scope.connection.send(JSON.stringify(searchObj));
+        sendRequest($scope.connection, searchObj);
     }
 
     $scope.connection.onmessage = function (message) {
-        var response = JSON.parse(message.data);
+        var response = decodeResponse(message);
         if(response.qtype == "entitysearch") {
             $scope.searchResults = response.entities;
             $log.info($scope.searchResults)
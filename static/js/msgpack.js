@@ -0,0 +1,117 @@
+/**
+ * Minimal msgpack codec for the binary Translatron websocket protocol.
+ * Supports nil, booleans, integers, floats, str, bin, arrays and maps.
+ * str and bin values are both decoded to strings (UTF-8).
+ */
+var msgpack = (function () {
+    var utf8Decoder = new TextDecoder("utf-8");
+    var utf8Encoder = new TextEncoder();
+
+    function decode(bytes) {
+        var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        var pos = 0;
+        function str(length) {
+            var value = utf8Decoder.decode(bytes.subarray(pos, pos + length));
+            pos += length;
+            return value;
+        }
+        function array(length) {
+            var value = new Array(length);
+            for (var i = 0; i < length; i++) {
+                value[i] = next();
+            }
+            return value;
+        }
+        function map(length) {
+            var value = {};
+            for (var i = 0; i < length; i++) {
+                var key = next();
+                value[key] = next();
+            }
+            return value;
+        }
+        function next() {
+            var type = bytes[pos++];
+            var value;
+            if (type < 0x80) { return type; } //positive fixint
+            if (type < 0x90) { return map(type & 0x0F); }
+            if (type < 0xA0) { return array(type & 0x0F); }
+            if (type < 0xC0) { return str(type & 0x1F); }
+            if (type >= 0xE0) { return type - 0x100; } //negative fixint
+            switch (type) {
+                case 0xC0: return null;
+                case 0xC2: return false;
+                case 0xC3: return true;
+                case 0xC4: case 0xD9: return str(bytes[pos++]);
+                case 0xC5: case 0xDA: value = view.getUint16(pos); pos += 2; return str(value);
+                case 0xC6: case 0xDB: value = view.getUint32(pos); pos += 4; return str(value);
+                case 0xCA: value = view.getFloat32(pos); pos += 4; return value;
+                case 0xCB: value = view.getFloat64(pos); pos += 8; return value;
+                case 0xCC: return bytes[pos++];
+                case 0xCD: value = view.getUint16(pos); pos += 2; return value;
+                case 0xCE: value = view.getUint32(pos); pos += 4; return value;
+                case 0xCF: value = view.getUint32(pos) * 4294967296 + view.getUint32(pos + 4); pos += 8; return value;
+                case 0xD0: value = view.getInt8(pos); pos += 1; return value;
+                case 0xD1: value = view.getInt16(pos); pos += 2; return value;
+                case 0xD2: value = view.getInt32(pos); pos += 4; return value;
+                case 0xD3: value = view.getInt32(pos) * 4294967296 + view.getUint32(pos + 4); pos += 8; return value;
+                case 0xDC: value = view.getUint16(pos); pos += 2; return array(value);
+                case 0xDD: value = view.getUint32(pos); pos += 4; return array(value);
+                case 0xDE: value = view.getUint16(pos); pos += 2; return map(value);
+                case 0xDF: value = view.getUint32(pos); pos += 4; return map(value);
+            }
+            throw new Error("Unsupported msgpack type 0x" + type.toString(16));
+        }
+        return next();
+    }
+
+    function encode(obj) {
+        var out = [];
+        function header(length, fix, fixLimit, type8, type16, type32) {
+            if (length < fixLimit) {
+                out.push(fix | length);
+            } else if (type8 !== null && length < 0x100) {
+                out.push(type8, length);
+            } else if (length < 0x10000) {
+                out.push(type16, length >> 8, length & 0xFF);
+            } else {
+                out.push(type32, (length >>> 24) & 0xFF, (length >> 16) & 0xFF, (length >> 8) & 0xFF, length & 0xFF);
+            }
+        }
+        function next(value) {
+            if (value === null || value === undefined) {
+                out.push(0xC0);
+            } else if (value === false || value === true) {
+                out.push(value ? 0xC3 : 0xC2);
+            } else if (typeof value === "number") {
+                if (Number.isInteger(value) && value >= 0 && value < 0x100000000) {
+                    if (value < 0x80) { out.push(value); }
+                    else { out.push(0xCE, (value >>> 24) & 0xFF, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF); }
+                } else { //Negative and large numbers are encoded as float64
+                    var buffer = new DataView(new ArrayBuffer(8));
+                    buffer.setFloat64(0, value);
+                    out.push(0xCB);
+                    for (var i = 0; i < 8; i++) { out.push(buffer.getUint8(i)); }
+                }
+            } else if (typeof value === "string") {
+                var data = utf8Encoder.encode(value);
+                header(data.length, 0xA0, 32, 0xD9, 0xDA, 0xDB);
+                for (var i = 0; i < data.length; i++) { out.push(data[i]); }
+            } else if (Array.isArray(value)) {
+                header(value.length, 0x90, 16, null, 0xDC, 0xDD);
+                value.forEach(next);
+            } else {
+                var keys = Object.keys(value);
+                header(keys.length, 0x80, 16, null, 0xDE, 0xDF);
+                keys.forEach(function (key) {
+                    next(key);
+                    next(value[key]);
+                });
+            }
+        }
+        next(obj);
+        return new Uint8Array(out);
+    }
+
+    return {decode: decode, encode: encode};
+})();
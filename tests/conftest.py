@@ -0,0 +1,52 @@
+import os
+import sys
+import pytest
+
+#Run the tests against the Translatron package in this repository.
+# Modules like NLTKIndexer read stopwords.txt from the working directory.
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+os.chdir(repoDir)
+
+class MemoryConnection(object):
+    """
+    In-memory stand-in for a YakDB.Connection supporting the operations
+    used by YakDBDocumentDatabase. Tables opened with the NULAPPENDSET
+    merge operator merge put values into the existing NUL-separated set.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.mergeTables = set()
+    def openTable(self, tableNo, mergeOperator=None, **kwargs):
+        if mergeOperator == "NULAPPENDSET":
+            self.mergeTables.add(tableNo)
+    def table(self, tableNo):
+        return self.tables.setdefault(tableNo, {})
+    def put(self, tableNo, entries):
+        table = self.table(tableNo)
+        for key, value in entries.items():
+            if tableNo in self.mergeTables and table.get(key):
+                value = b"\x00".join(sorted(set(table[key].split(b"\x00")) | set(value.split(b"\x00"))))
+            table[key] = value
+    def read(self, tableNo, keys):
+        table = self.table(tableNo)
+        return [table.get(key) for key in keys]
+    def delete(self, tableNo, keys):
+        table = self.table(tableNo)
+        for key in keys:
+            table.pop(key, None)
+    def deleteRange(self, tableNo, startKey, endKey, limit=None):
+        table = self.table(tableNo)
+        for key in [key for key in table if (startKey is None or key >= startKey) and (endKey is None or key < endKey)]:
+            del table[key]
+    def scan(self, tableNo, startKey=None, endKey=None, limit=None, invert=False, **kwargs):
+        table = self.table(tableNo)
+        keys = sorted((key for key in table if (startKey is None or key >= startKey) and (endKey is None or key < endKey)),
+                      reverse=invert)
+        return [(key, table[key]) for key in keys[:limit]]
+
+@pytest.fixture
+def memoryDB():
+    "A YakDBDocumentDatabase on a MemoryConnection"
+    DocumentDB = pytest.importorskip("Translatron.DocumentDB")
+    return DocumentDB.YakDBDocumentDatabase(conn=MemoryConnection())
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk index builder: Merging sorted runs in several passes with a bounded fan-in.
+"""
+import os
+import pytest
+
+BulkIndexBuilder = pytest.importorskip("Translatron.Indexing.BulkIndexBuilder")
+
+def writeRuns(directory, numRuns, maxPostings=3):
+    "Write numRuns sorted runs with overlapping keys and duplicate postings"
+    runWriter = BulkIndexBuilder.SortedRunWriter(directory, "test", maxPostings)
+    for i in range(numRuns * maxPostings):
+        runWriter.add(b"key%d" % (i % 4), b"doc%d" % (i % 5))
+    runWriter.flush()
+    assert len(runWriter.runs) == numRuns
+    return runWriter.runs
+
+def test_multi_pass_merge_matches_single_pass(tmp_path):
+    runs = writeRuns(str(tmp_path), 11)
+    expected = list(BulkIndexBuilder.mergeRuns(runs))
+    assert [key for key, _ in expected] == [b"key0", b"key1", b"key2", b"key3"]
+    assert list(BulkIndexBuilder.mergeRuns(runs, maxFanIn=2)) == expected
+
+def test_multi_pass_merge_bounds_open_files(tmp_path, monkeypatch):
+    runs = writeRuns(str(tmp_path), 9)
+    openRuns, maxOpenRuns = [0], [0]
+    iterateRun = BulkIndexBuilder.iterateRun
+    def countingIterateRun(filename):
+        openRuns[0] += 1
+        maxOpenRuns[0] = max(maxOpenRuns[0], openRuns[0])
+        try:
+            for posting in iterateRun(filename):
+                yield posting
+        finally:
+            openRuns[0] -= 1
+    monkeypatch.setattr(BulkIndexBuilder, "iterateRun", countingIterateRun)
+    assert len(list(BulkIndexBuilder.mergeRuns(runs, maxFanIn=3))) == 4
+    assert maxOpenRuns[0] == 3
+    #Intermediate runs are deleted
+    assert sorted(os.listdir(str(tmp_path))) == sorted(os.path.basename(run) for run in runs)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Paragraph-granular document storage: Rewriting a document must not leave
+paragraph entries of the previous version behind.
+"""
+import pytest
+
+DocumentDB = pytest.importorskip("Translatron.DocumentDB")
+
+def document(numParagraphs, version):
+    return {"id": "pmc:1", "title": "Title", "paragraphs": ["%s paragraph %d" % (version, i) for i in range(numParagraphs)]}
+
+def paragraphKeys(db, docId=b"pmc:1"):
+    prefix = docId + b"\x1Eparagraph"
+    return sorted(key for key, _ in db.conn.scan(1, startKey=prefix, endKey=prefix + b"\xFF"))
+
+def test_rewrite_with_fewer_paragraphs(memoryDB):
+    memoryDB.writeDocument(document(12, "old"))
+    assert len(paragraphKeys(memoryDB)) == 12
+    memoryDB.writeDocument(document(3, "new"))
+    assert paragraphKeys(memoryDB) == sorted(DocumentDB.paragraphKey(b"pmc:1", i) for i in range(3))
+    assert memoryDB.findParagraphs(b"pmc:1", range(3)) == [b"new paragraph %d" % i for i in range(3)]
+    assert memoryDB.conn.read(1, [DocumentDB.paragraphKey(b"pmc:1", 10)]) == [None]
+
+def test_rewrite_with_more_paragraphs(memoryDB):
+    memoryDB.writeDocument(document(2, "old"))
+    memoryDB.writeDocument(document(11, "new"))
+    assert len(paragraphKeys(memoryDB)) == 11
+
+def test_rewrite_in_push_mode(memoryDB):
+    "PUSH connections can't read the previous version, so all of its paragraphs are deleted"
+    memoryDB.writeDocument(document(12, "old"))
+    memoryDB.mode = "PUSH"
+    memoryDB.writeDocument(document(3, "new"))
+    assert len(paragraphKeys(memoryDB)) == 3
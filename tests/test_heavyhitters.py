@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+High-frequency index keys: Keys moved by capPostings() must keep receiving
+all of their postings in the high-frequency table.
+"""
+import pytest
+
+HeavyHitters = pytest.importorskip("Translatron.Indexing.HeavyHitters")
+NLTKIndexer = pytest.importorskip("Translatron.Indexing.NLTKIndexer")
+Statistics = pytest.importorskip("Translatron.Statistics")
+
+def indexTitles(db, titles):
+    "Index {document ID: title tokens}"
+    NLTKIndexer.writePostings(db, db, {docId: [(tokens, docId, "title")] for docId, tokens in titles.items()},
+                              Statistics.IngestStatistics())
+
+def locations(db, tableNo, key):
+    value = db.conn.read(tableNo, [key])[0]
+    return set(value.split(b"\x00")) if value else set()
+
+def test_cap_moves_heavy_keys(memoryDB):
+    indexTitles(memoryDB, {b"d1": [b"cell", b"p53"], b"d2": [b"cell"], b"d3": [b"cell"]})
+    assert HeavyHitters.capPostings(memoryDB, 3, 7, maxPostings=2) == 1
+    assert locations(memoryDB, 3, b"title\x1Ecell") == set()
+    assert locations(memoryDB, 7, b"title\x1Ecell") == {b"d1", b"d2", b"d3"}
+    assert locations(memoryDB, 3, b"title\x1Ep53") == {b"d1"}
+
+def test_new_postings_of_moved_keys_go_to_heavy_table(memoryDB):
+    indexTitles(memoryDB, {b"d1": [b"cell"], b"d2": [b"cell"], b"d3": [b"cell"]})
+    HeavyHitters.capPostings(memoryDB, 3, 7, maxPostings=2)
+    indexTitles(memoryDB, {b"d4": [b"cell", b"p53"]})
+    assert locations(memoryDB, 3, b"title\x1Ecell") == set()
+    assert locations(memoryDB, 7, b"title\x1Ecell") == {b"d1", b"d2", b"d3", b"d4"}
+    assert locations(memoryDB, 3, b"title\x1Ep53") == {b"d4"}
+
+def test_cap_merges_late_postings_of_moved_keys(memoryDB):
+    "Postings written to the index table by a process that did not know the key was moved"
+    indexTitles(memoryDB, {b"d1": [b"cell"], b"d2": [b"cell"], b"d3": [b"cell"]})
+    HeavyHitters.capPostings(memoryDB, 3, 7, maxPostings=2)
+    memoryDB.conn.put(3, {b"title\x1Ecell": b"d5"})
+    assert HeavyHitters.capPostings(memoryDB, 3, 7, maxPostings=2) == 1
+    assert locations(memoryDB, 3, b"title\x1Ecell") == set()
+    assert locations(memoryDB, 7, b"title\x1Ecell") == {b"d1", b"d2", b"d3", b"d5"}
+
+def test_cap_records_keys_of_existing_heavy_table(memoryDB):
+    "High-frequency tables written before moved keys were recorded"
+    memoryDB.conn.put(7, {b"title\x1Ecell": b"d1\x00d2\x00d3"})
+    memoryDB.conn.put(3, {b"title\x1Ecell": b"d4"})
+    HeavyHitters.capPostings(memoryDB, 3, 7, maxPostings=2)
+    assert locations(memoryDB, 7, b"title\x1Ecell") == {b"d1", b"d2", b"d3", b"d4"}
+    assert b"title\x1Ecell" in memoryDB.findHeavyKeys(7)
+
+def test_misra_gries_keeps_heavy_hitters():
+    sketch = HeavyHitters.MisraGries(k=2)
+    for item in [b"a"] * 50 + [b"b"] * 30 + [bytes([i]) for i in range(40)]:
+        sketch.add(item)
+    assert [item for item, _ in sketch.mostCommon(2)] == [b"a", b"b"]
+
+def test_entity_aliases_are_not_capped(memoryDB):
+    "NER needs all names starting with a common token"
+    memoryDB.conn.put(4, {b"cialiases\x1Eprotein": b"e1\x00e2\x00e3", b"aliases\x1EGO:1": b"e1\x00e2\x00e3"})
+    assert HeavyHitters.capPostings(memoryDB, 4, 8, maxPostings=2) == 0
+    assert locations(memoryDB, 4, b"cialiases\x1Eprotein") == {b"e1", b"e2", b"e3"}
+    assert locations(memoryDB, 4, b"aliases\x1EGO:1") == {b"e1", b"e2", b"e3"}
+
+def test_cap_restores_moved_entity_aliases(memoryDB):
+    "Alias keys moved by earlier versions are moved back to the index table"
+    memoryDB.conn.put(8, {b"cialiases\x1Eprotein": b"e1\x00e2\x00e3"})
+    memoryDB.writeHeavyKeys(8, [b"cialiases\x1Eprotein"])
+    memoryDB.conn.put(4, {b"cialiases\x1Eprotein": b"e4"})
+    HeavyHitters.capPostings(memoryDB, 4, 8, maxPostings=2)
+    assert locations(memoryDB, 4, b"cialiases\x1Eprotein") == {b"e1", b"e2", b"e3", b"e4"}
+    assert locations(memoryDB, 8, b"cialiases\x1Eprotein") == set()
+    assert not memoryDB.findHeavyKeys(8, maxAge=0)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parity of the PMC import pipeline on the .nxml fixtures in fixtures/pmc:
+The XPath fast path and the parallel archive pipeline (TAR reader +
+worker processes) must produce the same documents as the sequential
+BeautifulSoup path.
+"""
+import glob
+import os
+import tarfile
+from multiprocessing import Pool
+import pytest
+
+PMC = pytest.importorskip("Translatron.DocumentImport.PMC")
+
+fixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pmc")
+fixtureFiles = sorted(glob.glob(os.path.join(fixtureDir, "*.nxml")))
+
+def readFixture(filename):
+    with open(filename, "rb") as infile:
+        return infile.read()
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+@pytest.mark.parametrize("filename", fixtureFiles, ids=os.path.basename)
+def test_fast_path_matches_soup(filename):
+    xml = readFixture(filename)
+    assert PMC.processPMCFileContent(xml) == PMC.processPMCFileContentSoup(xml)
+
+def test_fixtures_cover_both_paths():
+    "Some fixtures must be parsed by the fast path, others need the BeautifulSoup fallback"
+    usesFastPath = []
+    for filename in fixtureFiles:
+        try:
+            PMC.parsePMCXML(readFixture(filename))
+            usesFastPath.append(True)
+        except ValueError:
+            usesFastPath.append(False)
+    assert any(usesFastPath) and not all(usesFastPath)
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_parallel_pipeline_matches_sequential(tmp_path):
+    archive = str(tmp_path / "articles.test.tar.gz")
+    with tarfile.open(archive, "w:gz") as tarOut:
+        for filename in fixtureFiles:
+            tarOut.add(filename, arcname="Test_Journal/" + os.path.basename(filename))
+    contents = [filelike.read() for filelike in PMC.PMCTARParser(numWorkers=1).iteratePMCTarGZ(archive)]
+    assert len(contents) == len(fixtureFiles)
+    with Pool(2) as pool:
+        parallelDocs = pool.map(PMC.processPMCFileContent, contents)
+    sequentialDocs = [PMC.processPMCFileContentSoup(readFixture(filename)) for filename in fixtureFiles]
+    assert parallelDocs == sequentialDocs
+    #The unparseable fixture yields None in both paths
+    assert None in sequentialDocs and sum(doc is not None for doc in sequentialDocs) >= 4
+
+def importDocuments(db, contents):
+    """
+    Import raw XML documents in a single chunk using a PMCProcessorWorker on db.
+    Returns the number of documents skipped as unchanged
+    """
+    import queue
+    DocumentDB = pytest.importorskip("Translatron.DocumentDB")
+    resultQueue = queue.Queue()
+    worker = PMC.PMCProcessorWorker(None, resultQueue)
+    worker.db, worker.statistics = db, PMC.IngestStatistics()
+    worker.batch = DocumentDB.AdaptiveWriteBatch(worker.writeDocuments, DocumentDB.serializeDocument,
+                                                 statistics=worker.statistics)
+    worker.processChunk([("test.tar.gz", "member%d" % i, 0, data) for i, data in enumerate(contents)])
+    worker.flush()
+    numUnchanged = 0
+    while not resultQueue.empty():
+        numUnchanged += len(resultQueue.get()[3])
+    return numUnchanged
+
+def storedTitle(db, docId):
+    DocumentDB = pytest.importorskip("Translatron.DocumentDB")
+    value = db.conn.read(1, [docId])[0]
+    return None if value is None else DocumentDB.decodeBytes(DocumentDB.unpackValue(value))["title"]
+
+def test_reverted_document_is_reimported(memoryDB):
+    "A document changed from version A to B and back to A must end up as A"
+    versionA = readFixture(os.path.join(fixtureDir, "PMC1000001.nxml"))
+    versionB = versionA.replace(b"by PmrA</article-title>", b"by PmrA (corrected)</article-title>")
+    assert importDocuments(memoryDB, [versionA]) == 0
+    assert importDocuments(memoryDB, [versionA]) == 1
+    assert importDocuments(memoryDB, [versionB]) == 0
+    assert storedTitle(memoryDB, b"pmc:1000001").endswith("(corrected)")
+    assert importDocuments(memoryDB, [versionA]) == 0
+    assert storedTitle(memoryDB, b"pmc:1000001").endswith("by PmrA")
+
+def test_same_content_under_another_id_is_imported(memoryDB):
+    versionA = readFixture(os.path.join(fixtureDir, "PMC1000001.nxml"))
+    importDocuments(memoryDB, [versionA])
+    otherId = versionA.replace(b'"pmc">1000001<', b'"pmc">1000009<')
+    assert importDocuments(memoryDB, [otherId]) == 0
+    assert storedTitle(memoryDB, b"pmc:1000009") is not None
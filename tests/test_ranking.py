@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ranking on the string document index: The number of documents and the
+document lengths are read from the document state table.
+"""
+import pytest
+
+NLTKIndexer = pytest.importorskip("Translatron.Indexing.NLTKIndexer")
+Ranking = pytest.importorskip("Translatron.Indexing.Ranking")
+Statistics = pytest.importorskip("Translatron.Statistics")
+DocumentDB = pytest.importorskip("Translatron.DocumentDB")
+BulkIndexBuilder = pytest.importorskip("Translatron.Indexing.BulkIndexBuilder")
+HeavyHitters = pytest.importorskip("Translatron.Indexing.HeavyHitters")
+CompactPostings = pytest.importorskip("Translatron.Indexing.CompactPostings")
+
+def indexTitles(db, titles):
+    "Index {document ID: title tokens}"
+    NLTKIndexer.writePostings(db, db, {docId: [(tokens, docId, "title")] for docId, tokens in titles.items()},
+                              Statistics.IngestStatistics())
+
+titles = {b"d1": [b"cell"],
+          b"d2": [b"cell", b"membrane", b"protein", b"transport", b"kinase"],
+          b"d3": [b"p53"], b"d4": [b"p53"]}
+
+def test_document_statistics(memoryDB):
+    indexTitles(memoryDB, titles)
+    assert memoryDB.findDocumentLengths([b"d1", b"d2", b"d5"]) == [1, 5, None]
+    assert memoryDB.findDocumentStatistics() == (4, 2.0)
+
+def test_document_statistics_are_updated_with_lengths(memoryDB):
+    "Rewritten lengths replace their old value in the running statistics"
+    indexTitles(memoryDB, titles)
+    memoryDB.writeDocumentLengths({b"d2": 1, b"d5": 3})
+    assert memoryDB.findDocumentStatistics() == (5, 7 / 5.0)
+    memoryDB.removeDocumentLengths([b"d5", b"d6"])
+    assert memoryDB.findDocumentStatistics() == (4, 1.0)
+    #Only the statistics keys are read at query time
+    memoryDB.conn.delete(5, [key for key in memoryDB.conn.table(5) if key.startswith(DocumentDB.documentLengthPrefix)])
+    assert memoryDB.findDocumentStatistics() == (4, 1.0)
+
+def test_shorter_documents_rank_higher(memoryDB):
+    indexTitles(memoryDB, titles)
+    total, hits = Ranking.rankStringPostings(memoryDB, [b"cell"])
+    assert total == 2
+    assert [docId for docId, _, _ in hits] == [b"d1", b"d2"]
+    assert hits[0][2] > hits[1][2]
+    #The idf uses the number of indexed documents, not the document frequency
+    assert hits[0][2] == pytest.approx(Ranking.bm25(3.0, Ranking.idf(2, 4), 0.5))
+
+def test_removed_documents_are_not_counted(memoryDB):
+    indexTitles(memoryDB, titles)
+    NLTKIndexer.removeIndexedVersions(memoryDB, [b"d2"], Statistics.IngestStatistics())
+    assert memoryDB.findDocumentLengths([b"d2"]) == [None]
+    assert memoryDB.findDocumentStatistics() == (3, 1.0)
+
+def test_index_without_lengths(memoryDB):
+    "Indexes built by older versions have no document lengths"
+    indexTitles(memoryDB, titles)
+    memoryDB.clearState(DocumentDB.documentLengthPrefix)
+    memoryDB.clearState(DocumentDB.documentStatisticsPrefix)
+    assert memoryDB.findDocumentStatistics() == (None, None)
+    total, hits = Ranking.rankStringPostings(memoryDB, [b"cell"])
+    assert total == 2
+    assert hits[0][2] == hits[1][2]
+
+def buildCompactIndex(db, titles, runDirectory, maxPostings):
+    "Build the compact index of {document ID: title tokens} like the bulk index builder"
+    statistics = Statistics.IngestStatistics()
+    runWriter = BulkIndexBuilder.SortedRunWriter(runDirectory, "test")
+    for docId, tokens in titles.items():
+        for token in tokens:
+            runWriter.add(DocumentDB.indexKey("title", token), docId)
+    runWriter.flush()
+    docNumbers = BulkIndexBuilder.assignDocumentNumbers(db, statistics)
+    #The string index has already been written, so write a scratch copy
+    result = BulkIndexBuilder.writeMergedRuns(db.conn, 9, runWriter.runs, statistics, docNumbers,
+                                              maxPostings=maxPostings, heavyTableNo=10)
+    db.conn.put(5, {CompactPostings.docLengthsKey: CompactPostings.encodeDocLengths(result["docLengths"]),
+                    CompactPostings.compactIndexValidKey: b"build"})
+
+def test_index_paths_ignore_capped_keys(memoryDB, tmp_path):
+    "The compact and the string index return the same hits, ignoring keys moved to the high-frequency table"
+    titles = {b"d1": [b"cell", b"p53"], b"d2": [b"cell", b"p53"], b"d3": [b"cell"], b"d4": [b"kinase"]}
+    indexTitles(memoryDB, titles)
+    HeavyHitters.capPostings(memoryDB, 3, 7, maxPostings=2)
+    stringResult = memoryDB.rankDocuments([b"cell", b"p53"])
+    buildCompactIndex(memoryDB, titles, str(tmp_path), maxPostings=2)
+    assert memoryDB.compactDocIdx.isCurrent()
+    compactResult = memoryDB.rankDocuments([b"cell", b"p53"])
+    assert stringResult[0] == compactResult[0] == 2
+    assert [docId for docId, _, _ in stringResult[1]] == [docId for docId, _, _ in compactResult[1]] == [b"d1", b"d2"]
+    #Only capped tokens: No hits on both paths
+    assert Ranking.rankStringPostings(memoryDB, [b"cell"]) == (0, [])
+    assert memoryDB.rankDocuments([b"cell"]) == (0, [])
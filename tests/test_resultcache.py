@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Result cache: Results computed while the index generation changed must not
+be cached under the new generation.
+"""
+import pytest
+
+ResultCache = pytest.importorskip("Translatron.Server.ResultCache")
+
+def test_result_of_older_generation_is_not_cached():
+    generation = [b"1"]
+    cache = ResultCache.ResultCache(lambda: generation[0], checkInterval=0.0)
+    startGeneration = cache.currentGeneration()
+    #The index is rewritten while the result is computed
+    generation[0] = b"2"
+    assert cache.get("docsearch", "query") is None
+    cache.put("docsearch", "query", "stale", 10, startGeneration)
+    assert cache.get("docsearch", "query") is None
+    cache.put("docsearch", "query", "fresh", 10, cache.currentGeneration())
+    assert cache.get("docsearch", "query") == "fresh"
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parity of the regex tokenizer with nltk.word_tokenize on the sample corpus
+in fixtures/tokenizer (one text per line) and on the PMC fixtures:
+The regex tokenizer must return exactly the lowercase alphanumeric tokens
+of word_tokenize, i.e. the tokens that can pass NLTKIndexer.filterToken().
+"""
+import glob
+import os
+import pytest
+
+Tokenizer = pytest.importorskip("Translatron.Indexing.Tokenizer")
+nltk = pytest.importorskip("nltk")
+
+fixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def readCorpus():
+    with open(os.path.join(fixtureDir, "tokenizer", "corpus.txt"), encoding="utf-8") as infile:
+        return [line for line in infile.read().split("\n") if line]
+
+def nltkAlnumTokens(texts):
+    try:
+        return [[token for token in map(str.lower, tokens) if token.isalnum()]
+                for tokens in Tokenizer.nltkTokenizeBatch(texts)]
+    except LookupError: # punkt model not installed
+        pytest.skip("NLTK punkt model is not available")
+
+def assertParity(texts):
+    for text, nltkTokens, regexTokens in zip(texts, nltkAlnumTokens(texts), Tokenizer.regexTokenizeBatch(texts)):
+        assert regexTokens == nltkTokens, text
+
+def test_regex_matches_nltk_on_corpus():
+    assertParity(readCorpus())
+
+def test_regex_matches_nltk_on_pmc_fixtures():
+    PMC = pytest.importorskip("Translatron.DocumentImport.PMC")
+    texts = []
+    for filename in sorted(glob.glob(os.path.join(fixtureDir, "pmc", "*.nxml"))):
+        with open(filename, "rb") as infile:
+            doc = PMC.processPMCFileContent(infile.read())
+        if doc is not None:
+            texts += [doc["title"]] + doc["paragraphs"]
+    assertParity(texts)
+
+def test_batch_matches_single_texts():
+    "Tokenizing a batch must not let sentence ends or tokens leak across texts"
+    corpus = readCorpus()
+    assert Tokenizer.regexTokenizeBatch(corpus) == [Tokenizer.regexTokenizeBatch([text])[0] for text in corpus]